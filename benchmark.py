@@ -0,0 +1,563 @@
+import argparse
+import asyncio
+import base64
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import protocol
+from chat_client import upload_file
+
+# Headless benchmarks for the chat and file servers. By default each run
+# starts server.py in a child process on free ports inside a scratch
+# directory; pass --http-port (and --host/--port) to measure an existing
+# server. Results can be saved with --output and compared with --baseline.
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+CHUNK_SIZE = 64 * 1024
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not start listening on {host}:{port}")
+
+
+class LocalServer:
+    def __init__(self, server_args=()):
+        self.server_args = list(server_args)
+        self.host = '127.0.0.1'
+        self.port = free_port()
+        self.http_port = free_port()
+        self.workdir = tempfile.TemporaryDirectory(prefix='chat-bench-')
+        self.process = None
+
+    def __enter__(self):
+        command = [sys.executable, SERVER_SCRIPT, '--host', self.host,
+                   '--port', str(self.port), '--http-port', str(self.http_port)]
+        self.process = subprocess.Popen(command + self.server_args, cwd=self.workdir.name,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(self.host, self.port)
+        wait_for_port(self.host, self.http_port)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.workdir.cleanup()
+
+
+def upload(server, path, compress=False):
+    # One stream, the way chat_client uploads files of any size with
+    # transfer_streams=1; the file is shared under its own name
+    upload_file(f'http://{server.host}:{server.http_port}', 'bench', path, compress=compress, streams=1)
+
+
+def download_file(conn, filename, username='bench', gzip=False):
+    # Reads and discards the body, returning the number of bytes received.
+    # With gzip the body is inflated as it arrives (the count is still of
+    # bytes on the wire).
+    headers = {'X-Username': username}
+    if gzip:
+        headers['Accept-Encoding'] = 'gzip'
+    conn.request('GET', f'/{filename}', headers=headers)
+    response = conn.getresponse()
+    if response.status != 200:
+        response.read()
+        raise RuntimeError(f"Download failed: HTTP {response.status}")
+    decompressor = None
+    if response.getheader('Content-Encoding') == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    received = 0
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        received += len(chunk)
+        if decompressor:
+            decompressor.decompress(chunk)
+    return received
+
+
+def make_payload(folder, filename, size):
+    path = os.path.join(folder, filename)
+    with open(path, 'wb') as f:
+        block = os.urandom(min(size, 1024 * 1024))
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+    return path
+
+
+def measure_downloads(host, port, filename, clients, rounds):
+    # Every client keeps one connection open and downloads the file `rounds`
+    # times; throughput is the total received over the wall-clock time.
+    totals = [0] * clients
+    errors = []
+    start_barrier = threading.Barrier(clients + 1)
+
+    def worker(index):
+        conn = http.client.HTTPConnection(host, port)
+        try:
+            start_barrier.wait()
+            for _ in range(rounds):
+                totals[index] += download_file(conn, filename)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    if errors:
+        raise errors[0]
+    return sum(totals), elapsed
+
+
+def bench_transfers(args, server):
+    size = int(args.size_mb * 1024 * 1024)
+    filename = 'bench-payload.bin'
+    folder = tempfile.mkdtemp(prefix='chat-bench-')
+    path = make_payload(folder, filename, size)
+    results = {'size_mb': args.size_mb, 'rounds': args.rounds, 'download_mb_s': {}}
+    try:
+        started = time.perf_counter()
+        upload(server, path)
+        upload_time = time.perf_counter() - started
+        results['upload_mb_s'] = size / upload_time / 1e6
+        print(f"upload    1 client : {results['upload_mb_s']:8.1f} MB/s")
+
+        for clients in sorted({1, args.transfer_clients}):
+            received, elapsed = measure_downloads(server.host, server.http_port, filename,
+                                                  clients, args.rounds)
+            results['download_mb_s'][str(clients)] = received / elapsed / 1e6
+            print(f"download {clients:3d} client{'s' if clients > 1 else ' '}: "
+                  f"{received / elapsed / 1e6:8.1f} MB/s aggregate "
+                  f"({received / 1e6:.0f} MB in {elapsed:.2f}s)")
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+def make_sample(kind, size):
+    # Representative content for the compression benchmark: pasted logs,
+    # a CSV export, or random (already compressed) bytes
+    if kind == 'random':
+        return os.urandom(size)
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        if kind == 'log':
+            line = (f"2024-05-{i % 28 + 1:02d} 12:{i % 60:02d}:{i * 7 % 60:02d},{i % 1000:03d} INFO "
+                    f"[worker-{i % 8}] request {i} GET /api/items/{i * 31 % 9973} -> 200 in {i * 13 % 450} ms\n")
+        else:
+            line = f"{i},user{i % 517},{i * 3.14159 % 1000:.2f},{'yes' if i % 3 else 'no'},2024-05-{i % 28 + 1:02d}\n"
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return ''.join(lines).encode()[:size]
+
+
+COMPRESSION_SAMPLES = (('log', '.log'), ('csv', '.csv'), ('random', '.zip'))
+
+
+def bench_chat_compression(kind, messages, message_size):
+    # CPU cost and ratio of what the server does per connection: one zlib
+    # stream with a sync flush after every frame, inflated by the client
+    sample = make_sample(kind, messages * message_size)
+    if kind == 'random':
+        # Chat messages are text; base64 keeps the bytes random but valid
+        sample = base64.b64encode(sample)[:len(sample)]
+    frames = [protocol.encode_frame(sample[i:i + message_size]) for i in range(0, len(sample), message_size)]
+    compressor = protocol.Compressor()
+    started = time.perf_counter()
+    compressed = [compressor.compress(frame) for frame in frames]
+    compress_time = time.perf_counter() - started
+    decoder = protocol.DecompressingDecoder()
+    started = time.perf_counter()
+    for data in compressed:
+        decoder.feed(data)
+    decompress_time = time.perf_counter() - started
+    raw = sum(len(frame) for frame in frames)
+    wire = sum(len(data) for data in compressed)
+    return {
+        'raw_bytes': raw,
+        'wire_bytes': wire,
+        'saved_pct': (raw - wire) / raw * 100,
+        'compress_us_per_msg': compress_time / len(frames) * 1e6,
+        'decompress_us_per_msg': decompress_time / len(frames) * 1e6,
+    }
+
+
+def bench_compression(args, server):
+    size = int(args.compress_size_mb * 1024 * 1024)
+    results = {'chat': {}, 'transfers': {}}
+    for kind, extension in COMPRESSION_SAMPLES:
+        chat = results['chat'][kind] = bench_chat_compression(kind, args.chat_messages, args.message_size)
+        print(f"chat     {kind:6s}: {chat['saved_pct']:5.1f}% saved, "
+              f"{chat['compress_us_per_msg']:.1f} us compress + {chat['decompress_us_per_msg']:.1f} us "
+              f"decompress per {args.message_size}-byte message")
+
+    folder = tempfile.mkdtemp(prefix='chat-bench-')
+    try:
+        for kind, extension in COMPRESSION_SAMPLES:
+            filename = f"bench-sample{extension}"
+            path = os.path.join(folder, filename)
+            sample = make_sample(kind, size)
+            results['transfers'][kind] = {}
+            for gzip in (False, True):
+                # Different content for every upload, or the server would
+                # link the second one to the first without receiving it
+                with open(path, 'wb') as f:
+                    f.write((f"{kind} {gzip}\n".encode() + sample)[:size])
+                # Like the client, upload_file never gzips types that are
+                # compressed already
+                started = time.perf_counter()
+                upload(server, path, compress=gzip)
+                upload_time = time.perf_counter() - started
+                conn = http.client.HTTPConnection(server.host, server.http_port)
+                try:
+                    started = time.perf_counter()
+                    wire = download_file(conn, filename, gzip=gzip)
+                    download_time = time.perf_counter() - started
+                finally:
+                    conn.close()
+                encoding = 'gzip' if gzip else 'identity'
+                results['transfers'][kind][encoding] = {
+                    'upload_mb_s': size / upload_time / 1e6,
+                    'download_mb_s': size / download_time / 1e6,
+                    'download_wire_mb': wire / 1e6,
+                }
+                print(f"transfer {kind:6s} {encoding:8s}: upload {size / upload_time / 1e6:7.1f} MB/s, "
+                      f"download {size / download_time / 1e6:7.1f} MB/s, {wire / 1e6:7.2f} MB on the wire")
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def latency_summary(latencies):
+    # Percentiles in milliseconds; empty if nothing was delivered
+    latencies = sorted(latencies)
+    return {name: value * 1000 for name, value in (
+        ('p50', percentile(latencies, 0.50)),
+        ('p90', percentile(latencies, 0.90)),
+        ('p99', percentile(latencies, 0.99)),
+        ('max', latencies[-1] if latencies else None),
+    ) if value is not None}
+
+
+def process_rss(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def child_pids(pid):
+    # Direct children of pid, from the parent pid field of /proc/<pid>/stat
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces; the fields after it don't
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def server_rss(server):
+    # Resident memory of a locally started server in bytes, summed over
+    # its worker processes when it runs with --workers (Linux only)
+    if server.process is None or not os.path.isdir('/proc'):
+        return None
+    pids = [server.process.pid]
+    total = 0
+    while pids:
+        pid = pids.pop()
+        total += process_rss(pid) or 0
+        pids.extend(child_pids(pid))
+    return total or None
+
+
+class SimulatedClient:
+    # A headless chat client speaking protocol version 2. Benchmark
+    # messages carry their send time so every receiver can compute the
+    # fan-out latency (or, for private messages, the delivery latency);
+    # everything else is only counted.
+    MARKER = 'BENCH|'
+    PRIVATE_MARKER = 'BENCH_PM|'
+
+    def __init__(self, name, stats):
+        self.name = name
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port, limit=1024 * 1024)
+        self.writer.write(protocol.make_hello(self.name).encode())
+        self.decoder = protocol.FrameDecoder()
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError(f"{self.name}: server closed the connection")
+            messages = self.decoder.feed(data)
+            if messages:
+                if not messages[0].startswith("SERVER_INFO|"):
+                    raise ConnectionError(f"{self.name}: handshake failed: {messages[0]}")
+                self.handle(messages[1:])
+                return
+
+    def handle(self, messages):
+        now = time.perf_counter()
+        for message in messages:
+            self.stats.received += 1
+            if self.MARKER in message:
+                marker, latencies = self.MARKER, self.stats.latencies
+            elif self.PRIVATE_MARKER in message and '[PM from ' in message:
+                # The sender's "[PM to ...]" confirmation is not a delivery
+                marker, latencies = self.PRIVATE_MARKER, self.stats.private_latencies
+            else:
+                continue
+            sent = float(message[message.find(marker) + len(marker):])
+            latencies.append(now - sent)
+            self.stats.delivered += 1
+            if self.stats.delivered >= self.stats.expected:
+                self.stats.done.set()
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                self.handle(self.decoder.feed(data))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def send(self, text):
+        self.writer.write(protocol.encode_frame(text))
+
+    def close(self):
+        self.writer.close()
+
+
+class ChatStats:
+    def __init__(self):
+        self.received = 0
+        self.delivered = 0
+        self.expected = float('inf')
+        self.latencies = []
+        self.private_latencies = []
+        self.done = asyncio.Event()
+
+
+async def run_chat_benchmark(args, server):
+    stats = ChatStats()
+    clients = [SimulatedClient(f"bench{i}", stats) for i in range(args.clients)]
+    rss_before = server_rss(server)
+
+    # Join storm: everyone connects at once and waits for SERVER_INFO
+    started = time.perf_counter()
+    await asyncio.gather(*(client.connect(server.host, server.port) for client in clients))
+    join_time = time.perf_counter() - started
+    readers = [asyncio.ensure_future(client.read_loop()) for client in clients]
+    await asyncio.sleep(0.5)  # let the join announcements drain
+    rss_after = server_rss(server)
+    print(f"join storm     : {args.clients} clients in {join_time:.2f}s")
+
+    # Fan-out: a few senders post at a fixed total rate; each message goes to
+    # every other client, except for the share sent privately to one client
+    senders = clients[:max(1, min(args.senders, len(clients)))]
+    private_ratio = args.private_ratio if len(clients) > 1 else 0
+    private = [int((i + 1) * private_ratio) > int(i * private_ratio) for i in range(args.messages)]
+    stats.expected = (args.messages - sum(private)) * (len(clients) - 1) + sum(private)
+    interval = 1 / args.rate if args.rate else 0
+    started = time.perf_counter()
+    for i in range(args.messages):
+        sender = senders[i % len(senders)]
+        if private[i]:
+            # Anyone but the sender, spread over every client
+            recipient = clients[(clients.index(sender) + 1 + i % (len(clients) - 1)) % len(clients)]
+            sender.send(f"/pm {recipient.name} {SimulatedClient.PRIVATE_MARKER}{time.perf_counter()!r}")
+        else:
+            sender.send(f"{SimulatedClient.MARKER}{time.perf_counter()!r}")
+        if interval:
+            delay = started + (i + 1) * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif i % 100 == 99:
+            await asyncio.sleep(0)
+    try:
+        await asyncio.wait_for(stats.done.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+
+    for reader in readers:
+        reader.cancel()
+    for client in clients:
+        client.close()
+
+    results = {
+        'clients': args.clients,
+        'messages': args.messages,
+        'private_messages': sum(private),
+        'join_storm_s': join_time,
+        'deliveries': stats.delivered,
+        'delivery_ratio': stats.delivered / stats.expected if stats.expected else 1.0,
+        'deliveries_per_s': stats.delivered / elapsed,
+        'latency_ms': latency_summary(stats.latencies),
+        'private_latency_ms': latency_summary(stats.private_latencies),
+        'memory_per_connection_kb': ((rss_after - rss_before) / args.clients / 1024
+                                     if rss_before and rss_after else None),
+    }
+    print(f"fan-out        : {stats.delivered}/{stats.expected} deliveries in {elapsed:.2f}s "
+          f"({results['deliveries_per_s']:.0f}/s)")
+    print("latency (ms)   : " + "  ".join(f"{name} {value:.2f}" for name, value in results['latency_ms'].items()))
+    if results['private_latency_ms']:
+        print("pm latency (ms): " + "  ".join(f"{name} {value:.2f}"
+                                             for name, value in results['private_latency_ms'].items()))
+    if results['memory_per_connection_kb'] is not None:
+        print(f"memory         : {results['memory_per_connection_kb']:.1f} KB per connection")
+    return results
+
+
+def bench_chat(args, server):
+    return asyncio.run(run_chat_benchmark(args, server))
+
+
+def flatten(results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = dict(flatten(json.load(f)))
+    print(f"\nchange vs {baseline_path}:")
+    for key, value in flatten(results):
+        old = baseline.get(key)
+        if old:
+            print(f"  {key:40s} {old:12.2f} -> {value:12.2f} ({(value - old) / old * 100:+.1f}%)")
+
+
+class ExistingServer:
+    def __init__(self, host, port, http_port):
+        self.host = host
+        self.port = port
+        self.http_port = http_port
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the LAN chat servers")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--http-port', type=int,
+                        help="Benchmark an already running server instead of starting one")
+    parser.add_argument('--server-args', default='',
+                        help="Extra arguments for the local server, e.g. '--mode async'")
+    parser.add_argument('--output', help="Save the results as JSON")
+    parser.add_argument('--baseline', help="Compare against results saved earlier with --output")
+    parser.add_argument('benchmark', choices=['chat', 'transfers', 'compression', 'all'])
+
+    chat = parser.add_argument_group('chat')
+    chat.add_argument('--clients', type=int, default=200, help="Simulated chat clients")
+    chat.add_argument('--senders', type=int, default=5, help="Clients posting messages")
+    chat.add_argument('--messages', type=int, default=500, help="Messages to send")
+    chat.add_argument('--private-ratio', type=float, default=0.2,
+                      help="Share of the messages sent as /pm to a single client")
+    chat.add_argument('--rate', type=float, default=200, help="Messages per second (0 = as fast as possible)")
+    chat.add_argument('--timeout', type=float, default=30, help="Seconds to wait for deliveries")
+
+    transfers = parser.add_argument_group('transfers')
+    transfers.add_argument('--transfer-clients', type=int, default=8, help="Parallel downloaders")
+    transfers.add_argument('--rounds', type=int, default=4, help="Downloads per client")
+    transfers.add_argument('--size-mb', type=float, default=64)
+
+    compression = parser.add_argument_group('compression')
+    compression.add_argument('--compress-size-mb', type=float, default=16, help="Size of each sample file")
+    compression.add_argument('--chat-messages', type=int, default=5000, help="Chat messages per sample")
+    compression.add_argument('--message-size', type=int, default=200, help="Bytes per chat message")
+    args = parser.parse_args()
+
+    if args.http_port:
+        server = ExistingServer(args.host, args.port, args.http_port)
+    else:
+        server = LocalServer(args.server_args.split())
+
+    results = {
+        'started': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'server_args': args.server_args,
+    }
+    with server:
+        if args.benchmark in ('chat', 'all'):
+            results['chat'] = bench_chat(args, server)
+        if args.benchmark in ('transfers', 'all'):
+            results['transfers'] = bench_transfers(args, server)
+        if args.benchmark in ('compression', 'all'):
+            results['compression'] = bench_compression(args, server)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
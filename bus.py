@@ -0,0 +1,196 @@
+import json
+import os
+import socket
+import threading
+import protocol
+
+# Local message bus linking the worker processes of a sharded chat server.
+# The hub runs in the parent process on a Unix socket; every worker keeps
+# one connection to it. The hub owns the user directory, so claiming a
+# username is atomic across workers, and it relays broadcasts, channel
+# messages and private messages between workers. Messages are JSON objects
+# sent as protocol frames.
+
+CLAIM_TIMEOUT = 5
+
+
+def encode(op, **fields):
+    fields['op'] = op
+    return protocol.encode_frame(json.dumps(fields))
+
+
+def read_messages(sock):
+    # Yields decoded bus messages until the connection closes
+    decoder = protocol.FrameDecoder()
+    while True:
+        try:
+            data = sock.recv(65536)
+        except OSError:
+            return
+        if not data:
+            return
+        for message in decoder.feed(data):
+            yield json.loads(message)
+
+
+class MessageBus:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.workers = {}  # {worker socket: send lock}
+        self.users = {}  # {username: worker socket}
+        if os.path.exists(path):
+            os.remove(path)
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(path)
+        self.server_socket.listen()
+
+    def serve_forever(self):
+        while True:
+            worker, _ = self.server_socket.accept()
+            thread = threading.Thread(target=self.handle_worker, args=(worker,))
+            thread.daemon = True
+            thread.start()
+
+    def send(self, worker, payload):
+        send_lock = self.workers.get(worker)
+        if send_lock is None:
+            return
+        try:
+            with send_lock:
+                worker.sendall(payload)
+        except OSError:
+            pass
+
+    def send_others(self, sender, payload):
+        with self.lock:
+            workers = [worker for worker in self.workers if worker is not sender]
+        for worker in workers:
+            self.send(worker, payload)
+
+    def handle_worker(self, worker):
+        with self.lock:
+            self.workers[worker] = threading.Lock()
+            names = list(self.users)
+        self.send(worker, encode('users', names=names))
+        try:
+            for message in read_messages(worker):
+                self.handle_message(worker, message)
+        finally:
+            with self.lock:
+                del self.workers[worker]
+                released = [name for name, owner in self.users.items() if owner is worker]
+                for name in released:
+                    del self.users[name]
+            for name in released:
+                self.send_others(worker, encode('user_left', name=name))
+            worker.close()
+
+    def handle_message(self, worker, message):
+        op = message['op']
+        if op == 'claim':
+            name = message['name']
+            with self.lock:
+                ok = name not in self.users
+                if ok:
+                    self.users[name] = worker
+                names = list(self.users)
+            self.send(worker, encode('claimed', id=message['id'], ok=ok, names=names))
+            if ok:
+                self.send_others(worker, encode('user_joined', name=name))
+        elif op == 'release':
+            name = message['name']
+            with self.lock:
+                released = self.users.get(name) is worker
+                if released:
+                    del self.users[name]
+            if released:
+                self.send_others(worker, encode('user_left', name=name))
+        elif op == 'private':
+            with self.lock:
+                owner = self.users.get(message['to'])
+            if owner is not None:
+                self.send(owner, encode('private', **{key: value for key, value in message.items() if key != 'op'}))
+        else:
+            # broadcast / channel: every other worker delivers to its own clients
+            self.send_others(worker, encode(op, **{key: value for key, value in message.items() if key != 'op'}))
+
+
+class BusClient:
+    # A worker's connection to the hub. Incoming relays and directory
+    # changes (user_joined / user_left) are handed to handler(message) on a
+    # reader thread; the directory replica in `users` holds every username
+    # claimed on any worker.
+    def __init__(self, path, handler):
+        self.handler = handler
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.users = set()
+        self.next_id = 0
+        self.claims = {}  # {request id: [event, result]}
+        reader = threading.Thread(target=self.read_loop)
+        reader.daemon = True
+        reader.start()
+
+    def publish(self, op, **fields):
+        payload = encode(op, **fields)
+        with self.send_lock:
+            self.sock.sendall(payload)
+
+    def claim(self, name):
+        # Blocks until the hub accepts or rejects the username. Returns the
+        # list of all users on success, None if the name is taken.
+        with self.lock:
+            self.next_id += 1
+            request_id = self.next_id
+            waiter = self.claims[request_id] = [threading.Event(), None]
+        try:
+            self.publish('claim', id=request_id, name=name)
+            if not waiter[0].wait(CLAIM_TIMEOUT):
+                raise ConnectionError("Message bus did not answer")
+        finally:
+            with self.lock:
+                del self.claims[request_id]
+        return waiter[1]
+
+    def release(self, name):
+        with self.lock:
+            self.users.discard(name)
+        self.publish('release', name=name)
+
+    def is_online(self, name):
+        with self.lock:
+            return name in self.users
+
+    def names(self):
+        with self.lock:
+            return list(self.users)
+
+    def read_loop(self):
+        for message in read_messages(self.sock):
+            op = message['op']
+            if op == 'claimed':
+                with self.lock:
+                    if message['ok']:
+                        self.users.update(message['names'])
+                    waiter = self.claims.get(message['id'])
+                if waiter:
+                    waiter[1] = message['names'] if message['ok'] else None
+                    waiter[0].set()
+            elif op == 'users':
+                with self.lock:
+                    self.users.update(message['names'])
+            elif op == 'user_joined':
+                with self.lock:
+                    self.users.add(message['name'])
+                self.handler(message)
+            elif op == 'user_left':
+                with self.lock:
+                    self.users.discard(message['name'])
+                self.handler(message)
+            else:
+                self.handler(message)
+        # Losing the hub leaves this worker unable to keep usernames unique
+        os._exit(1)
@@ -0,0 +1,959 @@
+import asyncio
+import bisect
+import functools
+import hashlib
+import io
+import json
+import os
+import socket
+import threading
+import time
+import queue
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import requests
+from requests.adapters import HTTPAdapter
+import protocol
+from protocol import DEFAULT_CHANNEL, TRANSFER_STREAMS, PRESENCE_JOIN, PRESENCE_LEAVE, PRESENCE_AWAY
+
+# Headless client for the chat and file servers. ChatClient runs a receive
+# thread and hands every incoming message to a callback (or queues it for
+# iteration); AsyncChatClient does the same with asyncio streams and an
+# async iterator. Both track who is online and do uploads/downloads over
+# the HTTP server. Nothing here imports Tk, so bots and scripts start fast.
+
+# Public messages replayed by the server when joining
+HISTORY_REPLAY = 100
+
+# Files at least this big are hashed first so the upload can be skipped
+# when the server already stores identical content
+DEDUP_MIN_SIZE = 1024 * 1024
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Tries per part of a parallel transfer before giving up on the file
+PART_ATTEMPTS = 3
+
+# Tries per request while the server answers 503 (every transfer slot
+# taken), waiting as long as its Retry-After asks in between
+BUSY_ATTEMPTS = 5
+
+# Heartbeat intervals without hearing from the server before the
+# connection is given up as dead
+MISSED_HEARTBEATS = 3
+
+# Seconds to wait for the server's handshake reply
+CONNECT_TIMEOUT = 10
+
+# Backoff between attempts to resume a lost session
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 5
+
+# Event kinds
+MESSAGE = 'message'
+PRIVATE = 'private'
+FILE = 'file'
+SERVER = 'server'
+JOIN = 'join'
+LEAVE = 'leave'
+CHANNEL_JOINED = 'channel_joined'
+CHANNEL_LEFT = 'channel_left'
+CHANNEL_LIST = 'channel_list'
+PRESENCE = 'presence'  # data: the PRESENCE_* op, or PRESENCE_SNAPSHOT
+PRESENCE_SNAPSHOT = 'snapshot'
+SEARCH = 'search'  # data: {'query', 'page', 'more', 'results'}
+
+
+class ChatError(Exception):
+    pass
+
+
+class UsernameTaken(ChatError):
+    pass
+
+
+class AccessDenied(ChatError):
+    pass
+
+
+def file_sha256(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Event:
+    # One incoming chat line. `live` is False for history replayed from
+    # before we joined (and for lines added locally); only live join/leave
+    # events change who is online. `data` carries the member list of
+    # CHANNEL_JOINED, the {channel: members} counts of CHANNEL_LIST, the
+    # op of PRESENCE and the reply of SEARCH.
+    def __init__(self, kind, text, live=True, user=None, filename=None,
+                 channel=DEFAULT_CHANNEL, data=None):
+        self.kind = kind
+        self.text = text
+        self.live = live
+        self.user = user
+        self.filename = filename
+        self.channel = channel
+        self.data = data
+
+    def __repr__(self):
+        return f"Event({self.kind!r}, {self.text!r}, channel={self.channel!r}, live={self.live})"
+
+
+def parse_event(message, live=True, channel=DEFAULT_CHANNEL):
+    if message.startswith('\n[') and 'SERVER:' in message:
+        if 'uploaded file' in message or 'sent you a private file' in message:
+            return Event(FILE, message, live, filename=message.split("'")[1], channel=channel)
+        return Event(SERVER, message, live, channel=channel)
+    if message.startswith('\n') and message.endswith(" joined the chat!"):
+        return Event(JOIN, message, live, user=message.split()[0])
+    if message.startswith('\n') and message.endswith(" left the chat!"):
+        return Event(LEAVE, message, live, user=message.split()[0])
+    if '[PM' in message:
+        return Event(PRIVATE, message, live)
+    return Event(MESSAGE, message, live, channel=channel)
+
+
+def format_search_results(reply):
+    # One line per hit, in the server's ranking order
+    results = reply['results']
+    if not results:
+        return f"No results for '{reply['query']}'"
+    lines = [f"Results for '{reply['query']}' (page {reply['page']}):"]
+    for result in results:
+        when = datetime.fromtimestamp(result['timestamp']).strftime("%Y-%m-%d %H:%M")
+        if result['kind'] == 'file':
+            lines.append(f"  [{when}] file {result['text']} from {result['sender'] or 'unknown'}")
+        elif result['kind'] == 'private':
+            lines.append(f"  [{when}] PM {result['sender']} -> {result['recipient']}: {result['snippet']}")
+        else:
+            lines.append(f"  [{when}] #{result['channel']} {result['sender']}: {result['snippet']}")
+    if reply['more']:
+        lines.append(f"  More: /search {reply['query']} page={reply['page'] + 1}")
+    return "\n".join(lines)
+
+
+def gzip_chunks(f, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    compressor = zlib.compressobj(protocol.TRANSFER_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in iter(lambda: f.read(chunk_size), b''):
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def make_session(streams=TRANSFER_STREAMS):
+    # Keeps one connection per parallel stream alive between requests and
+    # transfers
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=streams))
+    return session
+
+
+class TransferProgress:
+    # Adds up the bytes moved by every stream of a transfer and reports the
+    # running total as callback(done, total); total is None when unknown.
+    # The callback runs on the transfer threads, and an exception raised
+    # from it stops the transfer.
+    def __init__(self, total, callback=None, done=0):
+        self.total = total
+        self.callback = callback
+        self.done = done
+        self.lock = threading.Lock()
+        self.report()
+
+    def add(self, count):
+        with self.lock:
+            self.done += count
+            self.report()
+
+    def report(self):
+        if self.callback:
+            self.callback(self.done, self.total)
+
+
+class ProgressReader:
+    # File wrapper that requests streams with a Content-Length while the
+    # bytes it hands out are counted
+    def __init__(self, f, size, progress):
+        self.f = f
+        self.size = size
+        self.progress = progress
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.progress.add(len(data))
+        return data
+
+
+def retry_after(response):
+    try:
+        return max(int(response.headers.get('Retry-After', 1)), 0)
+    except ValueError:
+        return 1
+
+
+def send_when_free(request):
+    # Sends request() again while the server is busy; returns the last
+    # response
+    for attempt in range(BUSY_ATTEMPTS):
+        response = request()
+        if response.status_code != 503 or attempt == BUSY_ATTEMPTS - 1:
+            return response
+        response.close()
+        time.sleep(retry_after(response))
+
+
+def run_parts(streams, func, jobs):
+    # Runs func(*job) for every job on up to `streams` threads; the first
+    # failure is raised once the others have finished
+    with ThreadPoolExecutor(max_workers=streams) as pool:
+        futures = [pool.submit(func, *job) for job in jobs]
+    for future in futures:
+        future.result()
+
+
+def upload_file(base_url, username, filepath, recipient='all', channel=None, compress=False,
+                session=None, streams=TRANSFER_STREAMS, progress=None):
+    # compress gzips compressible files on the way; only use it with a
+    # server that announced compression support in its handshake. Files of
+    # PARALLEL_MIN_SIZE and up are sent as parts over `streams` connections.
+    http = session or requests
+    filename = os.path.basename(filepath)
+    size = os.path.getsize(filepath)
+    headers = {
+        'X-Filename': filename,
+        'X-Username': username,
+        'X-Recipient': recipient,
+        # Lets the server refuse an upload over quota before it is sent
+        'X-Upload-Size': str(size)
+    }
+    if channel:
+        headers['X-Channel'] = channel
+    compress = compress and protocol.is_compressible(filename) and size >= protocol.MIN_COMPRESS_SIZE
+
+    content_hash = None
+    if size >= DEDUP_MIN_SIZE:
+        content_hash = file_sha256(filepath)
+        response = http.post(base_url, headers={**headers, 'X-Content-Hash': content_hash, 'X-Link-Only': '1'})
+        if response.status_code == 200:
+            TransferProgress(size, progress, size)
+            return
+        if response.status_code in (413, 507):
+            raise ChatError(response.text)
+        headers['X-Content-Hash'] = content_hash
+
+    if streams > 1 and size >= protocol.PARALLEL_MIN_SIZE:
+        upload_parts(http, base_url, headers, filepath, size, compress, streams, progress)
+        return
+
+    # Passing the open file lets requests stream it with a Content-Length
+    # instead of loading it into memory; a generator is sent chunked
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+
+    def post():
+        # The file is read again from the start on every try
+        tracker = TransferProgress(size, progress)
+        with open(filepath, 'rb') as f:
+            reader = ProgressReader(f, size, tracker)
+            return http.post(base_url, data=gzip_chunks(reader) if compress else reader, headers=headers)
+
+    response = send_when_free(post)
+    if response.status_code != 200:
+        raise ChatError(response.text)
+
+
+def upload_parts(http, base_url, headers, filepath, size, compress, streams, progress):
+    # Every part carries its own hash and is written in place by the
+    # server; the last request shares the assembled file
+    part_headers = {key: value for key, value in headers.items() if key != 'X-Content-Hash'}
+    part_headers['X-Upload-Id'] = uuid.uuid4().hex
+    tracker = TransferProgress(size, progress)
+    run_parts(streams, upload_part, [
+        (http, base_url, part_headers, filepath, offset, length, compress, tracker)
+        for offset, length in protocol.part_ranges(size)
+    ])
+    response = http.post(base_url, headers={**headers, 'X-Upload-Id': part_headers['X-Upload-Id'],
+                                            'X-Upload-Complete': '1'})
+    if response.status_code != 200:
+        raise ChatError(response.text)
+
+
+def upload_part(http, base_url, headers, filepath, offset, length, compress, progress):
+    # Lets the progress callback stop the transfer before the part starts
+    progress.add(0)
+    with open(filepath, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    headers = {**headers, 'X-Part-Offset': str(offset), 'X-Part-Hash': hashlib.sha256(data).hexdigest()}
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+        data = b''.join(gzip_chunks(io.BytesIO(data)))
+
+    for attempt in range(PART_ATTEMPTS):
+        try:
+            response = http.post(base_url, data=data, headers=headers)
+        except requests.ConnectionError:
+            if attempt == PART_ATTEMPTS - 1:
+                raise
+            continue
+        if response.status_code == 200:
+            progress.add(length)
+            return
+        if response.status_code == 503:
+            time.sleep(retry_after(response))
+        elif response.text != 'Part hash mismatch':
+            raise ChatError(response.text)
+    raise ChatError(f"Part at byte {offset} failed after {PART_ATTEMPTS} attempts")
+
+
+def check_download(response):
+    if response.status_code == 403:
+        raise AccessDenied("This file was not shared with you.")
+    if response.status_code not in (200, 206):
+        raise ChatError(f"HTTP {response.status_code}")
+
+
+def partial_download_paths(folder, filename):
+    # Where an unfinished download and the ETag of its version are kept
+    partial_path = f"{os.path.join(folder, filename)}.part"
+    return partial_path, f"{partial_path}.etag"
+
+
+def download_file(base_url, username, filename, folder, session=None, streams=TRANSFER_STREAMS,
+                  progress=None):
+    # Downloads into <folder>/<filename> and returns the path. Files of
+    # PARALLEL_MIN_SIZE and up are fetched as byte ranges over `streams`
+    # connections. An interrupted download is resumed; If-Range makes the
+    # server send the whole file again if it changed in the meantime.
+    http = session or requests
+    os.makedirs(folder, exist_ok=True)
+    url = f"{base_url}/{filename}"
+    file_path = os.path.join(folder, filename)
+    partial_path, etag_path = partial_download_paths(folder, filename)
+
+    if streams > 1:
+        # Identity, so the server reports the stored size
+        response = http.head(url, headers={'X-Username': username, 'Accept-Encoding': 'identity'})
+        check_download(response)
+        size = int(response.headers.get('Content-Length', 0))
+        if size >= protocol.PARALLEL_MIN_SIZE and response.headers.get('Accept-Ranges') == 'bytes':
+            download_parts(http, url, username, partial_path, etag_path, streams, progress)
+            os.replace(partial_path, file_path)
+            os.remove(etag_path)
+            return file_path
+
+    headers = {'X-Username': username}
+    if os.path.exists(partial_path) and os.path.exists(etag_path):
+        with open(etag_path, 'r') as f:
+            headers['If-Range'] = f.read().strip()
+        headers['Range'] = f"bytes={os.path.getsize(partial_path)}-"
+        # Ranges refer to the stored bytes, never a compressed stream
+        headers['Accept-Encoding'] = 'identity'
+
+    with send_when_free(lambda: http.get(url, headers=headers, stream=True)) as response:
+        if response.status_code == 416:
+            # The partial copy no longer matches the server's file
+            os.remove(partial_path)
+            os.remove(etag_path)
+            return download_file(base_url, username, filename, folder, session, 1, progress)
+        check_download(response)
+
+        if 'ETag' in response.headers:
+            with open(etag_path, 'w') as f:
+                f.write(response.headers['ETag'])
+        resumed = response.status_code == 206
+        done = os.path.getsize(partial_path) if resumed else 0
+        total = None
+        if 'Content-Length' in response.headers and 'Content-Encoding' not in response.headers:
+            total = done + int(response.headers['Content-Length'])
+        tracker = TransferProgress(total, progress, done)
+        with open(partial_path, 'ab' if resumed else 'wb') as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                tracker.add(len(chunk))
+
+    os.replace(partial_path, file_path)
+    if os.path.exists(etag_path):
+        os.remove(etag_path)
+    return file_path
+
+
+def download_parts(http, url, username, partial_path, etag_path, streams, progress):
+    # Fetches the part hashes, then every part still missing from the
+    # preallocated partial file
+    response = send_when_free(lambda: http.get(f"{url}?parts", headers={'X-Username': username}))
+    check_download(response)
+    manifest = response.json()
+    size, etag = manifest['size'], manifest['etag']
+    ranges = protocol.part_ranges(size, manifest['part_size'])
+
+    # A partial copy of the same version keeps every part that still
+    # matches its hash
+    resume = False
+    if os.path.exists(partial_path) and os.path.exists(etag_path) and os.path.getsize(partial_path) == size:
+        with open(etag_path, 'r') as f:
+            resume = f.read().strip() == etag
+    if not resume:
+        with open(partial_path, 'wb') as f:
+            protocol.preallocate(f, size)
+        with open(etag_path, 'w') as f:
+            f.write(etag)
+
+    jobs = []
+    done = 0
+    with open(partial_path, 'rb') as f:
+        for (offset, length), expected in zip(ranges, manifest['parts']):
+            if resume:
+                f.seek(offset)
+                if hashlib.sha256(f.read(length)).hexdigest() == expected:
+                    done += length
+                    continue
+            jobs.append((offset, length, expected))
+
+    headers = {'X-Username': username, 'If-Range': etag, 'Accept-Encoding': 'identity'}
+    tracker = TransferProgress(size, progress, done)
+    run_parts(streams, download_part, [(http, url, headers, partial_path) + job + (tracker,) for job in jobs])
+
+
+def download_part(http, url, headers, partial_path, offset, length, expected, progress):
+    progress.add(0)
+    headers = {**headers, 'Range': f"bytes={offset}-{offset + length - 1}"}
+    for attempt in range(PART_ATTEMPTS):
+        digest = hashlib.sha256()
+        received = 0
+        try:
+            with http.get(url, headers=headers, stream=True) as response:
+                if response.status_code == 503:
+                    time.sleep(retry_after(response))
+                    continue
+                check_download(response)
+                if response.status_code != 206:
+                    # If-Range did not match: the file was replaced
+                    raise ChatError("The file changed on the server during the download")
+                with open(partial_path, 'r+b') as f:
+                    f.seek(offset)
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        received += len(chunk)
+                        progress.add(len(chunk))
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+            if attempt == PART_ATTEMPTS - 1:
+                raise
+        if received == length and digest.hexdigest() == expected:
+            return
+        progress.add(-received)
+    raise ChatError(f"Part at byte {offset} failed its checksum after {PART_ATTEMPTS} attempts")
+
+
+class UserIndex:
+    # Online users kept in sorted order, plus who is away. Changes are a
+    # binary search and a list insert or delete, and return the position
+    # they touched so a view of the list can be patched instead of rebuilt.
+    def __init__(self, names=()):
+        self.reset(names)
+
+    def reset(self, names, away=()):
+        self.names = sorted(set(names))
+        self.away = set(away).intersection(self.names)
+
+    def position(self, name):
+        index = bisect.bisect_left(self.names, name)
+        if index < len(self.names) and self.names[index] == name:
+            return index
+        return None
+
+    def add(self, name):
+        # The new position, or None if the name was already listed
+        index = bisect.bisect_left(self.names, name)
+        if index < len(self.names) and self.names[index] == name:
+            return None
+        self.names.insert(index, name)
+        return index
+
+    def remove(self, name):
+        # The old position, or None if the name was not listed
+        index = self.position(name)
+        if index is not None:
+            del self.names[index]
+            self.away.discard(name)
+        return index
+
+    def set_away(self, name, away):
+        if away and name in self:
+            self.away.add(name)
+        else:
+            self.away.discard(name)
+
+    def __contains__(self, name):
+        return self.position(name) is not None
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+class BaseChatClient:
+    # State and message handling shared by the threaded and asyncio clients
+    resumable = False  # asks for heartbeats and a session it can resume
+    def __init__(self, host, port=5555, username=None, history=HISTORY_REPLAY,
+                 download_folder='downloads', compression=True, transfer_streams=TRANSFER_STREAMS):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.history = history
+        self.download_folder = download_folder
+        self.http_port = None
+        self.online_users = UserIndex()
+        self.presence_seq = None  # last presence update applied, once the server sends them
+        self.resync_due = False  # a presence update was missed; ask for a snapshot
+        self.replies = []  # owed to the server by the receive loop (PONG)
+        self.heartbeat_interval = None
+        self.session_token = None
+        self.resume_grace = 0
+        self.rejoining = False  # reconnecting after the connection was lost
+        self.channels = {DEFAULT_CHANNEL}
+        self.users_lock = threading.Lock()
+        self.decoder = protocol.FrameDecoder()
+        self.compression = compression  # after the handshake: the method in use, or None
+        self.compressor = None
+        self.transfer_streams = transfer_streams
+        self.session = make_session(transfer_streams)
+
+    def hello(self):
+        # History is not replayed again on a reconnect
+        options = {'history': self.history} if self.history and not self.rejoining else {}
+        options['presence'] = 1
+        if self.resumable:
+            options['heartbeat'] = 1
+            options['session'] = 1
+            if self.session_token:
+                options['resume'] = self.session_token
+        if self.compression:
+            options['compress'] = ','.join(protocol.COMPRESSION_METHODS)
+        return protocol.make_hello(self.username, **options).encode()
+
+    def read_server_info(self, data):
+        # Feeds handshake bytes; returns None until SERVER_INFO is complete,
+        # then the messages that followed it
+        first = self.decoder.feed(data, max_messages=1)
+        if not first:
+            return None
+        self.handle_server_info(first[0])
+        if self.compression:
+            # Whatever followed SERVER_INFO is already compressed
+            leftover = bytes(self.decoder.buffer)
+            self.decoder = protocol.DecompressingDecoder()
+            self.compressor = protocol.Compressor()
+            return self.decoder.feed(leftover)
+        return self.decoder.feed(b'')
+
+    def encode(self, text):
+        frame = protocol.encode_frame(text)
+        return self.compressor.compress(frame) if self.compressor else frame
+
+    def handle_server_info(self, response):
+        if response == "USERNAME_TAKEN":
+            raise UsernameTaken(f"Username {self.username!r} is already taken")
+        if not response.startswith("SERVER_INFO|"):
+            raise ChatError(f"Unexpected handshake reply: {response}")
+        parts = response.split("|")
+        self.http_port = int(parts[1])
+        if len(parts) > 2 and self.presence_seq is None:
+            # Once presence updates flow they keep the list current, also
+            # across a reconnect
+            with self.users_lock:
+                self.online_users.reset(user for user in parts[2].split(",") if user)
+        self.compression = parts[4] if len(parts) > 4 and parts[4] else None
+        self.heartbeat_interval = float(parts[5]) if len(parts) > 5 and parts[5] else None
+
+    def make_event(self, message):
+        # Returns None for stale presence updates and heartbeats, which
+        # change nothing
+        if message == "PING":
+            self.replies.append("PONG")
+            return None
+        if message == "PONG":
+            return None
+        if message.startswith("SESSION|"):
+            _, token, resumed, grace = message.split("|", 3)
+            return self.start_session(token, resumed == '1', float(grace))
+        if message.startswith("PRESENCE|"):
+            _, seq, op, user = message.split("|", 3)
+            return self.apply_presence(int(seq), op, user)
+        if message.startswith("PRESENCE_SNAPSHOT|"):
+            _, seq, users, away = message.split("|", 3)
+            return self.apply_presence_snapshot(int(seq), users.split(","), away.split(","))
+        if message.startswith("SEARCH_RESULTS|"):
+            reply = json.loads(message.split("|", 1)[1])
+            return Event(SEARCH, format_search_results(reply), data=reply)
+        if message.startswith("HISTORY|"):
+            # Replayed from before we joined
+            return parse_event(message.split("|", 2)[2], live=False)
+        if message.startswith("CHANNEL|"):
+            _, channel, text = message.split("|", 2)
+            return parse_event(text, channel=channel)
+        if message.startswith("CHANNEL_JOINED|"):
+            _, channel, members = message.split("|", 2)
+            self.channels.add(channel)
+            return Event(CHANNEL_JOINED, f"You joined #{channel}", channel=channel,
+                         data=[member for member in members.split(",") if member])
+        if message.startswith("CHANNEL_LEFT|"):
+            channel = message.split("|", 1)[1]
+            self.channels.discard(channel)
+            return Event(CHANNEL_LEFT, f"You left #{channel}", channel=channel)
+        if message.startswith("CHANNELS|"):
+            counts = {}
+            for entry in message.split("|", 1)[1].split(","):
+                channel, _, count = entry.rpartition(":")
+                if channel:
+                    counts[channel] = int(count)
+            text = "Channels: " + ", ".join(f"#{channel} ({count})" for channel, count in counts.items())
+            return Event(CHANNEL_LIST, text, data=counts)
+        event = parse_event(message)
+        if self.presence_seq is None:
+            # A server without structured presence: follow the join/leave lines
+            if event.kind == JOIN:
+                with self.users_lock:
+                    self.online_users.add(event.user)
+            elif event.kind == LEAVE:
+                with self.users_lock:
+                    self.online_users.remove(event.user)
+        return event
+
+    def apply_presence(self, seq, op, user):
+        with self.users_lock:
+            if self.presence_seq is None or seq <= self.presence_seq:
+                return None
+            if seq != self.presence_seq + 1:
+                # Something in between was dropped; apply this one anyway
+                # and let a snapshot repair the rest
+                self.resync_due = True
+            self.presence_seq = seq
+            if op == PRESENCE_JOIN:
+                self.online_users.add(user)
+            elif op == PRESENCE_LEAVE:
+                self.online_users.remove(user)
+            else:
+                self.online_users.set_away(user, op == PRESENCE_AWAY)
+        return Event(PRESENCE, '', user=user, data=op)
+
+    def apply_presence_snapshot(self, seq, users, away):
+        with self.users_lock:
+            if self.presence_seq is not None and seq < self.presence_seq and not self.rejoining:
+                # Older than updates already applied
+                return None
+            self.presence_seq = seq
+            self.resync_due = False
+            self.online_users.reset((user for user in users if user), away)
+        return Event(PRESENCE, '', data=PRESENCE_SNAPSHOT)
+
+    def start_session(self, token, resumed, grace):
+        rejoining = self.rejoining
+        self.session_token = token
+        self.resume_grace = grace
+        self.rejoining = False
+        if not rejoining:
+            return None
+        if resumed:
+            return Event(SERVER, "Reconnected")
+        # The old session had expired: we joined again, so get back into
+        # our channels
+        for channel in sorted(self.channels - {DEFAULT_CHANNEL}):
+            self.replies.append(f"/join {channel}")
+        return Event(SERVER, "Reconnected (session expired, rejoined)")
+
+    def take_replies(self):
+        replies, self.replies = self.replies, []
+        if self.resync_due:
+            self.resync_due = False
+            replies.append("/presence")
+        return replies
+
+    def users(self):
+        # Everyone online except ourselves, sorted
+        with self.users_lock:
+            return [user for user in self.online_users if user != self.username]
+
+    def is_away(self, user):
+        with self.users_lock:
+            return user in self.online_users.away
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.http_port}"
+
+    @staticmethod
+    def private_message(recipient, text):
+        return f"/pm {recipient} {text}"
+
+    @staticmethod
+    def channel_message(text, channel=None):
+        if channel and channel != DEFAULT_CHANNEL:
+            return f"/say {channel} {text}"
+        return text
+
+
+class ChatClient(BaseChatClient):
+    # Blocking client. on_event is called with every Event from the receive
+    # thread; without it, events are queued and can be iterated over. A
+    # lost connection is resumed in the background while the server still
+    # holds the session; on_disconnect is only called once that fails.
+    resumable = True
+
+    def __init__(self, host, port=5555, username=None, on_event=None, on_disconnect=None, **kwargs):
+        super().__init__(host, port, username, **kwargs)
+        self.events = queue.Queue()
+        self.on_event = on_event or self.events.put
+        self.on_disconnect = on_disconnect
+        self.socket = None
+        self.send_lock = threading.Lock()
+        self.closing = False
+
+    def connect(self):
+        pending = self.open_connection()
+        receive_thread = threading.Thread(target=self.receive_messages, args=(pending,))
+        receive_thread.daemon = True
+        receive_thread.start()
+
+    def open_connection(self):
+        # Handshakes on a new socket and returns the messages that came
+        # with SERVER_INFO
+        sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        self.decoder = protocol.FrameDecoder()
+        self.compressor = None
+        try:
+            sock.sendall(self.hello())
+            pending = None
+            while pending is None:
+                data = sock.recv(65536)
+                if not data:
+                    raise ConnectionError("Server closed the connection")
+                pending = self.read_server_info(data)
+        except:
+            sock.close()
+            raise
+        # recv() times out after a heartbeat interval of silence
+        sock.settimeout(self.heartbeat_interval)
+        with self.send_lock:
+            self.socket = sock
+        return pending
+
+    def receive_messages(self, messages):
+        while True:
+            self.read_messages(messages)
+            if self.closing or not self.session_token:
+                break
+            messages = self.reconnect()
+            if messages is None:
+                break
+        self.events.put(None)
+        if self.on_disconnect:
+            self.on_disconnect()
+
+    def read_messages(self, messages):
+        # Returns when the connection is lost
+        missed = 0
+        try:
+            while True:
+                for message in messages:
+                    event = self.make_event(message)
+                    if event is not None:
+                        self.on_event(event)
+                    for reply in self.take_replies():
+                        self.send_raw(reply)
+                try:
+                    data = self.socket.recv(65536)
+                except socket.timeout:
+                    missed += 1
+                    if missed >= MISSED_HEARTBEATS:
+                        return
+                    self.send_raw("PING")
+                    messages = []
+                    continue
+                if not data:
+                    return
+                missed = 0
+                messages = self.decoder.feed(data)
+        except (OSError, ValueError, zlib.error):
+            pass
+
+    def reconnect(self):
+        # Tries to resume the session until the server's grace period runs
+        # out. Returns the first messages of the new connection, or None.
+        self.socket.close()
+        self.rejoining = True
+        self.on_event(Event(SERVER, "Connection lost, reconnecting..."))
+        deadline = time.monotonic() + self.resume_grace
+        delay = RECONNECT_DELAY
+        while not self.closing and time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            try:
+                return self.open_connection()
+            except (OSError, ChatError):
+                # Server unreachable, or the name is still held elsewhere
+                pass
+        self.rejoining = False
+        return None
+
+    def __iter__(self):
+        # Yields queued events until the connection closes
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            yield event
+
+    def send_raw(self, text):
+        with self.send_lock:
+            self.socket.sendall(self.encode(text))
+
+    def send(self, text, channel=None):
+        self.send_raw(self.channel_message(text, channel))
+
+    def send_private(self, recipient, text):
+        self.send_raw(self.private_message(recipient, text))
+
+    def join_channel(self, channel):
+        self.send_raw(f"/join {channel}")
+
+    def leave_channel(self, channel):
+        self.send_raw(f"/leave {channel}")
+
+    def list_channels(self):
+        self.send_raw("/channels")
+
+    def set_away(self, away=True):
+        self.send_raw("/away" if away else "/back")
+
+    def search(self, text, page=1):
+        # The reply arrives as a SEARCH event
+        self.send_raw(f"/search {text}" + (f" page={page}" if page > 1 else ""))
+
+    def upload(self, filepath, recipient='all', channel=None, progress=None):
+        # progress(done, total) is called from the transfer threads
+        upload_file(self.base_url, self.username, filepath, recipient, channel, bool(self.compression),
+                    self.session, self.transfer_streams, progress)
+
+    def download(self, filename, folder=None, progress=None):
+        return download_file(self.base_url, self.username, filename, folder or self.download_folder,
+                             self.session, self.transfer_streams, progress)
+
+    def close(self):
+        self.closing = True
+        self.session.close()
+        if self.socket:
+            try:
+                # Ends the session instead of leaving it to be resumed
+                self.send_raw("/quit")
+            except OSError:
+                pass
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+
+
+class AsyncChatClient(BaseChatClient):
+    # asyncio client: `async for event in client` yields Events until the
+    # connection closes. Transfers run in the default executor.
+    def __init__(self, host, port=5555, username=None, **kwargs):
+        super().__init__(host, port, username, **kwargs)
+        self.reader = None
+        self.writer = None
+        self.pending = []
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            self.writer.write(self.hello())
+            pending = None
+            while pending is None:
+                data = await self.reader.read(65536)
+                if not data:
+                    raise ConnectionError("Server closed the connection")
+                pending = self.read_server_info(data)
+            self.pending = pending
+        except:
+            self.writer.close()
+            raise
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            while not self.pending:
+                try:
+                    data = await self.reader.read(65536)
+                except ConnectionError:
+                    data = b''
+                if not data:
+                    raise StopAsyncIteration
+                self.pending = self.decoder.feed(data)
+            event = self.make_event(self.pending.pop(0))
+            for reply in self.take_replies():
+                await self.send_raw(reply)
+            if event is not None:
+                return event
+
+    async def send_raw(self, text):
+        self.writer.write(self.encode(text))
+        await self.writer.drain()
+
+    async def send(self, text, channel=None):
+        await self.send_raw(self.channel_message(text, channel))
+
+    async def send_private(self, recipient, text):
+        await self.send_raw(self.private_message(recipient, text))
+
+    async def join_channel(self, channel):
+        await self.send_raw(f"/join {channel}")
+
+    async def leave_channel(self, channel):
+        await self.send_raw(f"/leave {channel}")
+
+    async def list_channels(self):
+        await self.send_raw("/channels")
+
+    async def set_away(self, away=True):
+        await self.send_raw("/away" if away else "/back")
+
+    async def search(self, text, page=1):
+        await self.send_raw(f"/search {text}" + (f" page={page}" if page > 1 else ""))
+
+    async def run_in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+    async def upload(self, filepath, recipient='all', channel=None, progress=None):
+        await self.run_in_executor(upload_file, self.base_url, self.username, filepath, recipient, channel,
+                                   bool(self.compression), self.session, self.transfer_streams, progress)
+
+    async def download(self, filename, folder=None, progress=None):
+        return await self.run_in_executor(download_file, self.base_url, self.username, filename,
+                                          folder or self.download_folder, self.session,
+                                          self.transfer_streams, progress)
+
+    async def close(self):
+        self.session.close()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
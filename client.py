@@ -1,15 +1,28 @@
 import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
+from tkinter import ttk, filedialog, messagebox, simpledialog
 from ttkthemes import ThemedTk
-import socket
-import threading
 import os
-import requests
 import json
 from datetime import datetime
 import customtkinter as ctk
 from PIL import Image, ImageTk
 import webbrowser
+import queue
+import threading
+from chat_client import ChatClient, UserIndex, UsernameTaken, AccessDenied, parse_event, FILE, SERVER, PRIVATE, JOIN, LEAVE, CHANNEL_JOINED, CHANNEL_LEFT, CHANNEL_LIST, PRESENCE, PRESENCE_SNAPSHOT, SEARCH, HISTORY_REPLAY
+from protocol import DEFAULT_CHANNEL, PRESENCE_JOIN, PRESENCE_LEAVE
+from discovery import discover
+from transfers import TransferManager, UPLOAD, QUEUED, RUNNING, PAUSED, DONE, FAILED, CANCELLED, FINISHED_STATES
+
+# Incoming messages are rendered in batches from the Tk thread every
+# RENDER_INTERVAL_MS, and the message area keeps at most
+# MAX_SCROLLBACK_LINES lines
+RENDER_INTERVAL_MS = 50
+MAX_RENDER_BATCH = 500
+MAX_SCROLLBACK_LINES = 5000
+
+# Tags used to render each kind of event
+EVENT_TAGS = {SERVER: 'server', PRIVATE: 'private', CHANNEL_JOINED: 'server', CHANNEL_LEFT: 'server', CHANNEL_LIST: 'server', SEARCH: 'server'}
 
 class ChatGUI:
     def __init__(self):
@@ -21,11 +34,18 @@ class ChatGUI:
         # Initialize client properties
         self.host = '127.0.0.1'
         self.chat_port = 5555
-        self.http_port = None
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.client = None
         self.username = None
         self.download_folder = 'downloads'
-        self.online_users = set()
+        self.incoming = queue.Queue()  # chat_client.Event objects from the receive thread
+        self.shown_users = UserIndex()  # the names in users_listbox, in the same order
+        self.transfers = None  # TransferManager, once connected
+        self.transfer_updates = queue.Queue()  # Transfers whose state or progress changed
+        self.transfer_rows = {}  # {transfer id: (row, label, progress bar, pause button, retry button)}
+        self.file_link_count = 0
+        self.background_results = queue.Queue()  # (callback, result, error) from worker threads
+        self.discovered_servers = []  # DiscoveredServer, least loaded first
+        self.search_channel = DEFAULT_CHANNEL  # tab the last /search was typed in
         
         if not os.path.exists(self.download_folder):
             os.makedirs(self.download_folder)
@@ -36,6 +56,8 @@ class ChatGUI:
         
         # Show login frame first
         self.show_login_frame()
+        self.window.after(RENDER_INTERVAL_MS, self.process_incoming)
+        self.scan_servers()
         
     def create_login_frame(self):
         self.login_frame = ttk.Frame(self.window, padding="20")
@@ -58,8 +80,20 @@ class ChatGUI:
         self.server_entry.insert(0, "127.0.0.1")
         self.server_entry.pack(side='left', fill='x', expand=True, padx=5)
         
+        # Servers found on the LAN
+        discovery_frame = ttk.Frame(self.login_frame)
+        discovery_frame.pack(fill='x', pady=10)
+        ttk.Label(discovery_frame, text="On this network:").pack(side='left', anchor='n', padx=5)
+        self.servers_listbox = tk.Listbox(discovery_frame, height=4, exportselection=False)
+        self.servers_listbox.pack(side='left', fill='x', expand=True, padx=5)
+        self.servers_listbox.bind('<<ListboxSelect>>', self.select_server)
+        self.servers_listbox.bind('<Double-Button-1>', lambda e: self.connect_to_server())
+        self.scan_button = ttk.Button(discovery_frame, text="Scan", command=self.scan_servers)
+        self.scan_button.pack(side='left', anchor='n', padx=5)
+        
         # Connect button
-        ttk.Button(self.login_frame, text="Connect", command=self.connect_to_server).pack(pady=20)
+        self.connect_button = ttk.Button(self.login_frame, text="Connect", command=self.connect_to_server)
+        self.connect_button.pack(pady=20)
         
         # Status label
         self.login_status = ttk.Label(self.login_frame, text="")
@@ -72,12 +106,11 @@ class ChatGUI:
         left_panel = ttk.Frame(self.chat_frame)
         left_panel.pack(side='left', fill='both', expand=True)
         
-        # Message area
-        self.message_area = tk.Text(left_panel, wrap='word', state='disabled')
-        self.message_area.pack(fill='both', expand=True, padx=5, pady=5)
-        self.message_area.tag_configure('server', foreground='gray')
-        self.message_area.tag_configure('private', foreground='blue')
-        self.message_area.tag_configure('file', foreground='green', underline=1)
+        # One message area per channel, in tabs
+        self.notebook = ttk.Notebook(left_panel)
+        self.notebook.pack(fill='both', expand=True, padx=5, pady=5)
+        self.channel_tabs = {}  # {channel: Text widget}
+        self.add_channel_tab(DEFAULT_CHANNEL)
         
         # Input area
         input_frame = ttk.Frame(left_panel)
@@ -89,6 +122,13 @@ class ChatGUI:
         
         ttk.Button(input_frame, text="Send", command=self.send_message).pack(side='left')
         ttk.Button(input_frame, text="File", command=self.show_file_dialog).pack(side='left', padx=5)
+        ttk.Button(input_frame, text="Join", command=self.show_join_dialog).pack(side='left')
+        ttk.Button(input_frame, text="Leave", command=self.leave_current_channel).pack(side='left', padx=5)
+
+        # One row per file transfer; shown once the first one starts
+        self.transfers_frame = ttk.LabelFrame(left_panel, text="Transfers", padding=5)
+        ttk.Button(self.transfers_frame, text="Clear finished",
+                   command=self.clear_finished_transfers).pack(anchor='e')
         
         # Create right panel for users list
         right_panel = ttk.Frame(self.chat_frame, width=200)
@@ -97,6 +137,9 @@ class ChatGUI:
         
         # Users list with search
         ttk.Label(right_panel, text="Online Users").pack(fill='x')
+        self.away_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(right_panel, text="Away", variable=self.away_var,
+                        command=lambda: self.client.set_away(self.away_var.get())).pack(anchor='w')
         self.user_search = ttk.Entry(right_panel)
         self.user_search.pack(fill='x', pady=5)
         self.user_search.bind('<KeyRelease>', self.filter_users)
@@ -122,6 +165,38 @@ class ChatGUI:
         
         self.users_listbox.bind('<Button-3>', self.show_user_menu)
         
+    def add_channel_tab(self, channel):
+        message_area = tk.Text(self.notebook, wrap='word', state='disabled')
+        message_area.tag_configure('server', foreground='gray')
+        message_area.tag_configure('private', foreground='blue')
+        message_area.tag_configure('file', foreground='green', underline=1)
+        self.notebook.add(message_area, text=f"#{channel}")
+        self.channel_tabs[channel] = message_area
+        return message_area
+
+    def remove_channel_tab(self, channel):
+        message_area = self.channel_tabs.pop(channel, None)
+        if message_area is not None:
+            self.notebook.forget(message_area)
+            message_area.destroy()
+
+    def current_channel(self):
+        selected = self.notebook.select()
+        for channel, message_area in self.channel_tabs.items():
+            if str(message_area) == selected:
+                return channel
+        return DEFAULT_CHANNEL
+
+    def show_join_dialog(self):
+        channel = simpledialog.askstring("Join Channel", "Channel name:", parent=self.window)
+        if channel and channel.strip():
+            self.client.join_channel(channel.strip())
+
+    def leave_current_channel(self):
+        channel = self.current_channel()
+        if channel != DEFAULT_CHANNEL:
+            self.client.leave_channel(channel)
+
     def show_login_frame(self):
         self.chat_frame.pack_forget()
         self.login_frame.pack(fill='both', expand=True)
@@ -130,123 +205,269 @@ class ChatGUI:
         self.login_frame.pack_forget()
         self.chat_frame.pack(fill='both', expand=True)
         
+    def run_in_background(self, func, callback):
+        # Runs func on a worker thread so the window stays responsive;
+        # callback(result, error) is then called on the Tk thread
+        def work():
+            try:
+                result, error = func(), None
+            except Exception as e:
+                result, error = None, e
+            self.background_results.put((callback, result, error))
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    def process_background_results(self):
+        try:
+            while True:
+                callback, result, error = self.background_results.get_nowait()
+                callback(result, error)
+        except queue.Empty:
+            pass
+
+    def scan_servers(self):
+        self.scan_button.config(state='disabled')
+        self.run_in_background(discover, self.show_servers)
+
+    def show_servers(self, servers, error):
+        self.scan_button.config(state='normal')
+        self.discovered_servers = servers or []
+        self.servers_listbox.delete(0, tk.END)
+        for server in self.discovered_servers:
+            users = f"{server.users} user{'s' if server.users != 1 else ''}"
+            self.servers_listbox.insert(tk.END, f"{server.name} ({server.address}, {users})")
+        if self.discovered_servers:
+            # Least loaded first
+            self.servers_listbox.selection_set(0)
+            self.select_server()
+
+    def select_server(self, event=None):
+        selection = self.servers_listbox.curselection()
+        if not selection:
+            return
+        server = self.discovered_servers[selection[0]]
+        self.server_entry.delete(0, tk.END)
+        self.server_entry.insert(0, server.address)
+
     def connect_to_server(self):
         self.username = self.username_entry.get().strip()
-        self.host = self.server_entry.get().strip()
+        address = self.server_entry.get().strip()
         
         if not self.username:
             self.login_status.config(text="Please enter a username")
             return
+
+        # "host" or "host:port"
+        host, _, port = address.rpartition(':')
+        if host and port.isdigit():
+            self.host, self.chat_port = host, int(port)
+        else:
+            self.host, self.chat_port = address, 5555
             
+        self.client = ChatClient(self.host, self.chat_port, self.username,
+                                 on_event=self.incoming.put, on_disconnect=self.on_disconnect,
+                                 history=HISTORY_REPLAY, download_folder=self.download_folder)
+        self.connect_button.config(state='disabled')
+        self.login_status.config(text=f"Connecting to {address}...")
+        self.run_in_background(self.client.connect, self.on_connected)
+
+    def on_connected(self, result, error):
+        self.connect_button.config(state='normal')
+        if isinstance(error, UsernameTaken):
+            self.login_status.config(text="Username already taken")
+            return
+        if error is not None:
+            self.login_status.config(text=f"Connection error: {str(error)}")
+            return
+
+        self.login_status.config(text="")
+        self.transfers = TransferManager(self.client, on_update=self.transfer_updates.put)
+        self.update_users_list()
+        self.show_chat_frame()
+
+    def on_disconnect(self):
+        print("Disconnected from server")
+
+    def process_incoming(self):
+        # Drain queued messages in one batch per tick so a busy channel
+        # costs one redraw instead of one per message
+        batch = []
         try:
-            self.socket.connect((self.host, self.chat_port))
-            self.socket.send(self.username.encode())
-            
-            response = self.socket.recv(1024).decode()
-            if response == "USERNAME_TAKEN":
-                self.login_status.config(text="Username already taken")
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            while len(batch) < MAX_RENDER_BATCH:
+                batch.append(self.incoming.get_nowait())
+        except queue.Empty:
+            pass
+
+        if batch:
+            if self.client.presence_seq is not None:
+                # Structured presence: patch the list one change at a time
+                for event in batch:
+                    if event.kind == PRESENCE:
+                        self.apply_presence(event)
+            elif any(event.live and event.kind in (JOIN, LEAVE) for event in batch):
+                # The client already applied join/leave lines to its user list
+                self.update_users_list()
+            self.render_messages(batch)
+
+        self.process_transfer_updates()
+        self.process_background_results()
+        self.window.after(RENDER_INTERVAL_MS, self.process_incoming)
+
+    def process_transfer_updates(self):
+        # Several updates of one transfer only need one redraw
+        changed = {}
+        try:
+            while True:
+                transfer = self.transfer_updates.get_nowait()
+                changed[transfer.id] = transfer
+        except queue.Empty:
+            pass
+        for transfer in changed.values():
+            self.update_transfer_row(transfer)
+
+    def add_transfer_row(self, transfer):
+        if not self.transfer_rows:
+            self.transfers_frame.pack(fill='x', padx=5, pady=(0, 5))
+        row = ttk.Frame(self.transfers_frame)
+        row.pack(fill='x', pady=2)
+        label = ttk.Label(row, width=50)
+        label.pack(side='left')
+        bar = ttk.Progressbar(row, maximum=100)
+        bar.pack(side='left', fill='x', expand=True, padx=5)
+        pause_button = ttk.Button(row, text="Pause", width=7, command=lambda: self.toggle_pause(transfer))
+        pause_button.pack(side='left')
+        ttk.Button(row, text="Cancel", width=7,
+                   command=lambda: self.transfers.cancel(transfer)).pack(side='left', padx=2)
+        retry_button = ttk.Button(row, text="Retry", width=7, command=lambda: self.transfers.retry(transfer))
+        retry_button.pack(side='left')
+        self.transfer_rows[transfer.id] = (row, label, bar, pause_button, retry_button)
+        return self.transfer_rows[transfer.id]
+
+    def update_transfer_row(self, transfer):
+        row = self.transfer_rows.get(transfer.id)
+        if row is None:
+            if transfer.state in FINISHED_STATES:
+                # Cleared from the list already
                 return
-                
-            if response.startswith("SERVER_INFO|"):
-                parts = response.split("|")
-                self.http_port = int(parts[1])
-                if len(parts) > 2:
-                    self.online_users = set(parts[2].split(","))
-                    self.update_users_list()
-                
-                # Start receive thread
-                receive_thread = threading.Thread(target=self.receive_messages)
-                receive_thread.daemon = True
-                receive_thread.start()
-                
-                # Show chat frame
-                self.show_chat_frame()
-                
-        except Exception as e:
-            self.login_status.config(text=f"Connection error: {str(e)}")
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            
-    def receive_messages(self):
-        while True:
-            try:
-                message = self.socket.recv(1024).decode()
-                if message:
-                    # Update users list for join/leave messages
-                    if "joined the chat!" in message:
-                        username = message.split()[0].strip()
-                        self.online_users.add(username)
-                        self.update_users_list()
-                    elif "left the chat!" in message:
-                        username = message.split()[0].strip()
-                        self.online_users.discard(username)
-                        self.update_users_list()
-                    
-                    # Add message to chat area
-                    self.add_message(message)
-            except:
-                print("Disconnected from server")
-                break
-                
-    def add_message(self, message):
-        self.message_area.config(state='normal')
-
-        # Determine message type and apply appropriate tag
-        if message.startswith('\n[') and 'SERVER:' in message:
-            if 'uploaded file' in message or 'sent you a private file' in message:
-                # Extract filename from the message and create a clickable link
-                filename = message.split("'")[1]  # Extract filename using split
-                self.message_area.insert('end', message + '\n', 'file')
-                self.message_area.tag_bind('file', '<Button-1>', lambda e, file=filename: self.handle_file_click(file))
-            else:
-                self.message_area.insert('end', message + '\n', 'server')
-        elif '[PM' in message:
-            self.message_area.insert('end', message + '\n', 'private')
+            row = self.add_transfer_row(transfer)
+        _, label, bar, pause_button, retry_button = row
+
+        if transfer.state == RUNNING and transfer.total:
+            status = f"{int(transfer.fraction * 100)}%"
+        elif transfer.state == RUNNING:
+            status = f"{transfer.done / (1024 * 1024):.1f} MB"
+        elif transfer.state == DONE and transfer.result:
+            status = f"saved to {transfer.result}"
+        elif transfer.state == FAILED and isinstance(transfer.error, AccessDenied):
+            status = "access denied, this file was not shared with you"
+        elif transfer.state == FAILED:
+            status = f"failed: {transfer.error}"
         else:
-            self.message_area.insert('end', message + '\n')
+            status = transfer.state
+        direction = "Upload" if transfer.kind == UPLOAD else "Download"
+        label.config(text=f"{direction} {transfer.name}: {status}")
+        bar['value'] = transfer.fraction * 100
 
-        self.message_area.config(state='disabled')
-        self.message_area.see('end')
+        pause_button.config(text="Resume" if transfer.state == PAUSED else "Pause",
+                            state='normal' if transfer.state in (QUEUED, RUNNING, PAUSED) else 'disabled')
+        retry_button.config(state='normal' if transfer.state in (FAILED, CANCELLED) else 'disabled')
 
-    def handle_file_click(self, filename):
-        try:
-            file_url = f"http://{self.host}:{self.http_port}/{filename}"
-            headers = {'X-Username': self.username}
-
-            response = requests.get(file_url, headers=headers)
-
-            if response.status_code == 200:
-                file_path = os.path.join(self.download_folder, filename)
-                with open(file_path, 'wb') as f:
-                    f.write(response.content)
-                messagebox.showinfo("Success", f"File downloaded to {file_path}")
-            elif response.status_code == 403:
-                messagebox.showerror("Error", "Access denied. This file was not shared with you.")
+    def toggle_pause(self, transfer):
+        if transfer.state == PAUSED:
+            self.transfers.resume(transfer)
+        else:
+            self.transfers.pause(transfer)
+
+    def clear_finished_transfers(self):
+        for transfer in self.transfers.list_transfers():
+            if transfer.state in FINISHED_STATES:
+                self.transfers.forget(transfer)
+                row = self.transfer_rows.pop(transfer.id, None)
+                if row:
+                    row[0].destroy()
+        if not self.transfer_rows:
+            self.transfers_frame.pack_forget()
+
+    def add_message(self, message, channel=DEFAULT_CHANNEL):
+        self.incoming.put(parse_event(message, live=False, channel=channel))
+
+    def render_messages(self, events):
+        # Each event goes to its channel's tab, opening or closing tabs as
+        # channels are joined and left
+        touched = set()
+        for event in events:
+            if event.kind == PRESENCE:
+                continue
+            if event.kind == SEARCH:
+                event.channel = self.search_channel
+            if event.kind == CHANNEL_LEFT:
+                self.remove_channel_tab(event.channel)
+                touched.discard(event.channel)
+                continue
+            message_area = self.channel_tabs.get(event.channel)
+            if message_area is None:
+                if event.kind != CHANNEL_JOINED:
+                    continue
+                message_area = self.add_channel_tab(event.channel)
+                self.notebook.select(message_area)
+            if event.channel not in touched:
+                message_area.config(state='normal')
+                touched.add(event.channel)
+
+            if event.kind == FILE:
+                # Make the notification a clickable download link
+                self.file_link_count += 1
+                link_tag = f"file-{self.file_link_count}"
+                message_area.insert('end', event.text + '\n', ('file', link_tag))
+                message_area.tag_bind(link_tag, '<Button-1>', lambda e, file=event.filename: self.handle_file_click(file))
             else:
-                messagebox.showerror("Error", f"Error downloading file: HTTP {response.status_code}")
-        except Exception as e:
-            messagebox.showerror("Error", f"Error downloading file: {str(e)}")
+                message_area.insert('end', event.text + '\n', EVENT_TAGS.get(event.kind, ()))
+
+        for channel in touched:
+            message_area = self.channel_tabs[channel]
+            self.trim_scrollback(message_area)
+            message_area.config(state='disabled')
+            message_area.see('end')
+
+    def trim_scrollback(self, message_area):
+        # Keep memory and redraw cost flat over long sessions
+        line_count = int(message_area.index('end-1c').split('.')[0])
+        excess = line_count - MAX_SCROLLBACK_LINES
+        if excess <= 0:
+            return
+        message_area.delete('1.0', f'{excess + 1}.0')
+        for tag in message_area.tag_names():
+            if tag.startswith('file-') and not message_area.tag_ranges(tag):
+                message_area.tag_delete(tag)
+
+    def handle_file_click(self, filename):
+        self.download_file(filename)
 
-        
     def send_message(self):
         message = self.message_input.get().strip()
         if not message:
             return
 
+        if message.startswith("/search "):
+            # Results are shown in the open tab
+            self.search_channel = self.current_channel()
+            self.client.search(message[8:])
         # Check if a user is selected from the right-side user list for private message
-        if self.users_listbox.curselection():
+        elif self.users_listbox.curselection():
             recipient = self.users_listbox.get(self.users_listbox.curselection())
-            self.socket.send(f"/pm {recipient} {message}".encode())
+            self.client.send_private(recipient, message)
 
             # Do not manually display the message here, as it will be shown when received from the server
 
         else:
-            # Send public message if no user is selected
-            self.socket.send(message.encode())
+            # Send to the channel of the open tab if no user is selected
+            channel = self.current_channel()
+            self.client.send(message, channel)
 
             # Display the public message sent by the user
             timestamp = datetime.now().strftime("%H:%M:%S")
-            self.add_message(f"[{timestamp}] You: {message}")
+            self.add_message(f"[{timestamp}] You: {message}", channel)
 
         # Clear the input box and deselect the user
         self.message_input.delete(0, 'end')
@@ -261,80 +482,57 @@ class ChatGUI:
                 recipient = self.users_listbox.get(self.users_listbox.curselection())
                 self.send_file(filepath, recipient)
             else:
-                # Send to all
-                self.send_file(filepath)
+                # Send to everyone in the open tab's channel
+                self.send_file(filepath, channel=self.current_channel())
                 
-    def send_file(self, filepath, recipient='all'):
-        try:
-            if not os.path.exists(filepath):
-                messagebox.showerror("Error", "File does not exist")
-                return
-
-            filename = os.path.basename(filepath)
-            
-            upload_url = f"http://{self.host}:{self.http_port}"
-            
-            with open(filepath, 'rb') as f:
-                file_data = f.read()
-            
-            headers = {
-                'X-Filename': filename,
-                'X-Username': self.username,
-                'X-Recipient': recipient
-            }
-            
-            response = requests.post(
-                upload_url,
-                data=file_data,
-                headers=headers
-            )
-            
-            if response.status_code != 200:
-                messagebox.showerror("Error", f"Error uploading file: {response.text}")
-                
-        except Exception as e:
-            messagebox.showerror("Error", f"Error uploading file: {str(e)}")
+    def send_file(self, filepath, recipient='all', channel=None):
+        if not os.path.exists(filepath):
+            messagebox.showerror("Error", "File does not exist")
+            return
+        # Progress and the outcome show up in the transfers list
+        self.transfers.upload(filepath, recipient, channel)
             
     def download_file(self, filename):
-        try:
-            file_url = f"http://{self.host}:{self.http_port}/{filename}"
-            
-            headers = {
-                'X-Username': self.username
-            }
-            
-            response = requests.get(file_url, headers=headers)
-            
-            if response.status_code == 200:
-                file_path = os.path.join(self.download_folder, filename)
-                
-                with open(file_path, 'wb') as f:
-                    f.write(response.content)
-                
-                messagebox.showinfo("Success", 
-                                  f"File downloaded to {file_path}")
-            elif response.status_code == 403:
-                messagebox.showerror("Error", 
-                                   "Access denied. This file was not shared with you.")
-            else:
-                messagebox.showerror("Error", 
-                                   f"Error downloading file: HTTP {response.status_code}")
-                
-        except Exception as e:
-            messagebox.showerror("Error", f"Error downloading file: {str(e)}")
+        self.transfers.download(filename)
             
     def update_users_list(self):
+        # Rebuilds the whole list; used on connect, for snapshots and when
+        # the search term changes
+        search_term = self.user_search.get().lower()
+        self.shown_users.reset(user for user in self.client.users() if search_term in user.lower())
         self.users_listbox.delete(0, 'end')
-        for user in sorted(self.online_users):
-            if user != self.username:  # Don't show current user
-                self.users_listbox.insert('end', user)
+        for position, user in enumerate(self.shown_users):
+            self.users_listbox.insert('end', user)
+            self.show_away(position, user)
+
+    def apply_presence(self, event):
+        # One insert, delete or recolour per change instead of a rebuild
+        if event.data == PRESENCE_SNAPSHOT:
+            self.update_users_list()
+            return
+        user = event.user
+        if user == self.username:
+            return
+        if event.data == PRESENCE_JOIN:
+            if self.user_search.get().lower() in user.lower():
+                position = self.shown_users.add(user)
+                if position is not None:
+                    self.users_listbox.insert(position, user)
+                    self.show_away(position, user)
+        elif event.data == PRESENCE_LEAVE:
+            position = self.shown_users.remove(user)
+            if position is not None:
+                self.users_listbox.delete(position)
+        else:
+            position = self.shown_users.position(user)
+            if position is not None:
+                self.show_away(position, user)
+
+    def show_away(self, position, user):
+        self.users_listbox.itemconfig(position, foreground='gray' if self.client.is_away(user) else '')
                 
     def filter_users(self, event=None):
-        search_term = self.user_search.get().lower()
-        self.users_listbox.delete(0, 'end')
-        for user in sorted(self.online_users):
-            if user != self.username and search_term in user.lower():
-                self.users_listbox.insert('end', user)
+        self.update_users_list()
                 
     def show_user_menu(self, event):
         try:
@@ -361,7 +559,7 @@ class ChatGUI:
         def send():
             message = message_entry.get().strip()
             if message:
-                self.socket.send(f"/pm {recipient} {message}".encode())
+                self.client.send_private(recipient, message)
                 dialog.destroy()
                 
         ttk.Button(dialog, text="Send", command=send).pack(pady=10)
@@ -0,0 +1,148 @@
+import json
+import socket
+import struct
+import threading
+import time
+import uuid
+
+# Finding chat servers on the LAN without typing an IP. Servers listen on
+# DISCOVERY_PORT, joined to MULTICAST_GROUP, and answer every probe with a
+# unicast announcement: a JSON object naming the server, its chat and HTTP
+# ports and how many users it has. They also multicast the announcement
+# every ANNOUNCE_INTERVAL seconds for anyone listening. A client sends one
+# probe to the group and the subnet broadcast address and collects the
+# answers for SCAN_TIMEOUT seconds.
+
+MULTICAST_GROUP = '239.255.77.77'
+DISCOVERY_PORT = 5557
+SERVICE = 'lan-chat'
+PROBE = json.dumps({'service': SERVICE, 'op': 'probe'}).encode()
+ANNOUNCE_INTERVAL = 10
+SCAN_TIMEOUT = 0.5
+
+
+class DiscoveredServer:
+    def __init__(self, host, info):
+        self.host = host
+        self.id = info['id']
+        self.name = info.get('name') or host
+        self.port = int(info['port'])
+        self.http_port = int(info['http_port'])
+        self.users = int(info.get('users', 0))
+        self.workers = max(int(info.get('workers', 1)), 1)
+
+    @property
+    def load(self):
+        # Users per chat worker process
+        return self.users / self.workers
+
+    @property
+    def address(self):
+        return self.host if self.port == 5555 else f"{self.host}:{self.port}"
+
+    def __repr__(self):
+        return f"DiscoveredServer({self.name!r}, {self.host}:{self.port}, users={self.users})"
+
+
+def discover(timeout=SCAN_TIMEOUT, port=DISCOVERY_PORT):
+    # Returns the servers that answered within `timeout` seconds, least
+    # loaded first
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        sent = False
+        # Loopback last, so a local server is found even without a network
+        for target in (MULTICAST_GROUP, '<broadcast>', '127.0.0.1'):
+            try:
+                sock.sendto(PROBE, (target, port))
+                sent = True
+            except OSError:
+                pass
+        if not sent:
+            return []
+
+        servers = {}  # {server id: DiscoveredServer}
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, (host, _) = sock.recvfrom(65536)
+            except socket.timeout:
+                break
+            except OSError:
+                continue
+            try:
+                info = json.loads(data)
+                if info.get('service') != SERVICE or info.get('op') != 'announce':
+                    continue
+                server = DiscoveredServer(host, info)
+            except (ValueError, KeyError, TypeError):
+                continue
+            known = servers.get(server.id)
+            # The same server may answer on several addresses; prefer one
+            # that works from other machines too
+            if known is None or known.host.startswith('127.') and not host.startswith('127.'):
+                servers[server.id] = server
+        return sorted(servers.values(), key=lambda server: (server.load, server.name))
+    finally:
+        sock.close()
+
+
+class Announcer:
+    # Answers discovery probes for one chat server. info() returns the
+    # current fields to announce (port, http_port, users, workers).
+    def __init__(self, name, info, port=DISCOVERY_PORT, interval=ANNOUNCE_INTERVAL):
+        self.name = name
+        self.info = info
+        self.port = port
+        self.interval = interval
+        self.id = uuid.uuid4().hex
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Several servers on one machine can all listen
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', port))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        try:
+            membership = struct.pack('4s4s', socket.inet_aton(MULTICAST_GROUP), socket.inet_aton('0.0.0.0'))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError:
+            # No multicast route; broadcast and loopback probes still work
+            pass
+
+    def announcement(self):
+        fields = dict(self.info(), service=SERVICE, op='announce', id=self.id, name=self.name)
+        return json.dumps(fields).encode()
+
+    def start(self):
+        for target in (self.serve, self.announce_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(65536)
+            except OSError:
+                return
+            try:
+                message = json.loads(data)
+            except ValueError:
+                continue
+            if isinstance(message, dict) and message.get('service') == SERVICE and message.get('op') == 'probe':
+                try:
+                    self.sock.sendto(self.announcement(), address)
+                except OSError:
+                    pass
+
+    def announce_loop(self):
+        while True:
+            try:
+                self.sock.sendto(self.announcement(), (MULTICAST_GROUP, self.port))
+            except OSError:
+                pass
+            time.sleep(self.interval)
@@ -0,0 +1,182 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+# Public chat history. The newest messages are kept in a ring buffer so
+# replaying the hot tail never touches the disk; everything is also appended
+# to a log split into segments named after their first timestamp, each with
+# a sparse "<timestamp> <byte offset>" index so a range can be read by
+# seeking instead of scanning.
+
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+
+
+class MessageLog:
+    def __init__(self, folder='history', memory_size=1000, segment_bytes=8 * 1024 * 1024,
+                 index_bytes=64 * 1024):
+        self.folder = folder
+        self.segment_bytes = segment_bytes
+        self.index_bytes = index_bytes
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=memory_size)  # (timestamp, text)
+        self.segments = []  # first timestamp (ms) of each segment, oldest first
+        self.indexes = {}  # {segment: [(timestamp, offset), ...]}
+        self.current = None
+        self.current_index = None
+        self.current_size = 0
+        self.last_indexed = 0
+
+        os.makedirs(folder, exist_ok=True)
+        for name in sorted(os.listdir(folder)):
+            if name.endswith(SEGMENT_SUFFIX):
+                segment = int(name[:-len(SEGMENT_SUFFIX)])
+                self.segments.append(segment)
+                self.indexes[segment] = self.read_index(segment)
+        if self.segments:
+            self.open_segment(self.segments[-1])
+            self.recent.extend(self.last(self.recent.maxlen))
+
+    def segment_path(self, segment, suffix=SEGMENT_SUFFIX):
+        return os.path.join(self.folder, f"{segment:013d}{suffix}")
+
+    def read_index(self, segment):
+        index = []
+        path = self.segment_path(segment, INDEX_SUFFIX)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    timestamp, offset = line.split()
+                    index.append((float(timestamp), int(offset)))
+        return index
+
+    def open_segment(self, segment):
+        if self.current:
+            self.current.close()
+            self.current_index.close()
+        self.current = open(self.segment_path(segment), 'ab')
+        self.current_index = open(self.segment_path(segment, INDEX_SUFFIX), 'a')
+        self.current_size = self.current.tell()
+        index = self.indexes.setdefault(segment, [])
+        self.last_indexed = index[-1][1] if index else -self.index_bytes
+
+    def append(self, text, timestamp=None):
+        timestamp = timestamp or time.time()
+        line = (json.dumps([timestamp, text]) + '\n').encode()
+        with self.lock:
+            if self.current is None or (self.current_size and self.current_size + len(line) > self.segment_bytes):
+                segment = int(timestamp * 1000)
+                if self.segments and segment <= self.segments[-1]:
+                    segment = self.segments[-1] + 1
+                self.segments.append(segment)
+                self.open_segment(segment)
+            if self.current_size - self.last_indexed >= self.index_bytes:
+                self.indexes[self.segments[-1]].append((timestamp, self.current_size))
+                self.current_index.write(f"{timestamp!r} {self.current_size}\n")
+                self.current_index.flush()
+                self.last_indexed = self.current_size
+            self.current.write(line)
+            self.current.flush()
+            self.current_size += len(line)
+            self.recent.append((timestamp, text))
+
+    def snapshot(self):
+        # Segments and how far each may be read, fixed while holding the lock
+        # so the actual reads can run without blocking appends
+        with self.lock:
+            limits = [None] * len(self.segments)
+            if limits:
+                limits[-1] = self.current_size
+            return list(zip(self.segments, limits))
+
+    def read_segment(self, segment, start=0, limit=None):
+        with open(self.segment_path(segment), 'rb') as f:
+            f.seek(start)
+            data = f.read() if limit is None else f.read(max(limit - start, 0))
+        for line in data.splitlines():
+            try:
+                timestamp, text = json.loads(line)
+            except ValueError:
+                continue
+            yield timestamp, text
+
+    def last(self, count):
+        # The newest `count` messages, oldest first
+        count = max(count, 0)
+        with self.lock:
+            if count <= len(self.recent):
+                return list(self.recent)[len(self.recent) - count:]
+        entries = list(islice(self.iter_backwards(), count))
+        entries.reverse()
+        return entries
+
+    def since(self, timestamp, count):
+        # Up to the newest `count` messages after `timestamp`, oldest first
+        count = max(count, 0)
+        with self.lock:
+            if self.recent and self.recent[0][0] <= timestamp:
+                entries = [entry for entry in self.recent if entry[0] > timestamp]
+                return entries[-count:] if count else []
+        entries = list(islice(self.iter_backwards(timestamp), count))
+        entries.reverse()
+        return entries
+
+    def recent_since(self, timestamp):
+        # Messages after `timestamp` that are still in memory, oldest first;
+        # never touches the disk
+        entries = []
+        with self.lock:
+            for entry in reversed(self.recent):
+                if entry[0] <= timestamp:
+                    break
+                entries.append(entry)
+        entries.reverse()
+        return entries
+
+    def iter_backwards(self, after=None):
+        # Logged messages newest first, stopping at the first one not after
+        # `after`. Segments are read from the end one indexed block (about
+        # index_bytes) at a time, so the cost depends on how many messages
+        # are taken, not on the size of the log.
+        for segment, limit in reversed(self.snapshot()):
+            if limit is None:
+                limit = os.path.getsize(self.segment_path(segment))
+            starts = sorted({0} | {offset for _, offset in list(self.indexes.get(segment, []))})
+            end = limit
+            for start in reversed(starts):
+                if start >= end:
+                    continue
+                for entry in reversed(list(self.read_segment(segment, start, end))):
+                    if after is not None and entry[0] <= after:
+                        return
+                    yield entry
+                end = start
+
+    def iter_since(self, timestamp):
+        # Every logged message after `timestamp`, oldest first, read one
+        # segment at a time
+        snapshot = self.snapshot()
+        starts = [segment for segment, limit in snapshot]
+        first = max(bisect.bisect_right(starts, int(timestamp * 1000)) - 1, 0)
+        for position, (segment, limit) in enumerate(snapshot[first:]):
+            offset = 0
+            if position == 0:
+                # Seek to the last indexed entry at or before the timestamp
+                index = self.indexes.get(segment, [])
+                slot = bisect.bisect_right([entry[0] for entry in index], timestamp) - 1
+                if slot >= 0:
+                    offset = index[slot][1]
+            for entry in self.read_segment(segment, offset, limit):
+                if entry[0] > timestamp:
+                    yield entry
+
+    def close(self):
+        with self.lock:
+            if self.current:
+                self.current.close()
+                self.current_index.close()
+                self.current = None
@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Private messages and file notifications for users who are offline, kept
+# in SQLite until the user next connects and then delivered in one batch.
+# Calls may wait up to 10 seconds for another worker's write lock, so the
+# asyncio server makes them from an executor thread.
+# Only users who have connected before get a mailbox. Each one holds at
+# most `max_messages` messages and `max_bytes` of text, and messages older
+# than `expiry` seconds are dropped. Worker processes share one database
+# file, so a message can be left on any worker and picked up on another.
+
+DB_NAME = 'mailboxes.db'
+MAILBOX_SIZE = 200
+MAILBOX_BYTES = 1024 * 1024
+MAILBOX_EXPIRY = 7 * 24 * 3600
+PURGE_INTERVAL = 3600
+
+# Outcomes of deposit()
+STORED = 'stored'
+UNKNOWN = 'unknown'  # never connected, so probably a typo
+FULL = 'full'
+
+
+class MailboxStore:
+    def __init__(self, folder, max_messages=MAILBOX_SIZE, max_bytes=MAILBOX_BYTES, expiry=MAILBOX_EXPIRY):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.expiry = expiry
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        # Other workers may hold the write lock for a moment
+        self.db = sqlite3.connect(os.path.join(folder, DB_NAME), timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, last_seen REAL)")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                recipient TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                message TEXT NOT NULL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient, id)")
+        self.db.commit()
+
+    def start(self):
+        thread = threading.Thread(target=self.purge_loop)
+        thread.daemon = True
+        thread.start()
+
+    def purge_loop(self):
+        while True:
+            try:
+                self.purge()
+            except Exception as e:
+                # Try again next time rather than never purging again
+                print(f"Error purging expired messages: {e}")
+            time.sleep(PURGE_INTERVAL)
+
+    def purge(self):
+        with self.lock:
+            self.db.execute("DELETE FROM messages WHERE timestamp < ?", (time.time() - self.expiry,))
+            self.db.commit()
+
+    def deposit(self, recipient, message):
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM users WHERE name = ?", (recipient,)).fetchone() is None:
+                return UNKNOWN
+            count, size = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(message)), 0) FROM messages WHERE recipient = ? AND timestamp >= ?",
+                (recipient, time.time() - self.expiry)).fetchone()
+            if count >= self.max_messages or size + len(message) > self.max_bytes:
+                return FULL
+            self.db.execute("INSERT INTO messages (recipient, timestamp, message) VALUES (?, ?, ?)",
+                            (recipient, time.time(), message))
+            self.db.commit()
+            return STORED
+
+    def take(self, username):
+        # Records that username has connected and returns the waiting
+        # messages as (id, message), oldest first. They stay in the mailbox
+        # until discard() confirms they were handed to the connection.
+        now = time.time()
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO users (name, last_seen) VALUES (?, ?)", (username, now))
+                return self.db.execute(
+                    "SELECT id, message FROM messages WHERE recipient = ? AND timestamp >= ? ORDER BY id",
+                    (username, now - self.expiry)).fetchall()
+
+    def discard(self, username, last_id):
+        # Empties the mailbox up to and including message last_id
+        with self.lock:
+            self.db.execute("DELETE FROM messages WHERE recipient = ? AND id <= ?", (username, last_id))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,344 @@
+import json
+import os
+import re
+import sqlite3
+import stat
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+# Index of the files shared through the HTTP server. Lookups are plain dict
+# reads; every change is written through to a SQLite database in the upload
+# folder so the index survives restarts. Legacy "<file>.meta" JSON sidecars
+# are imported the first time they are seen. An optional SearchIndex is kept
+# in step with every change.
+#
+# Uploads are stored once per distinct content under .blobs/<sha256>; each
+# shared name maps to a blob and a blob is deleted when no name refers to it
+# any more. Files from before content addressing keep living under their own
+# name (their record has no hash).
+#
+# For quotas the store keeps the bytes each user has shared and the bytes
+# actually on disk (shared content counted once). Download times are kept
+# in memory and written out by flush_access(), not on every download.
+
+DB_NAME = '.metadata.db'
+BLOB_DIR = '.blobs'
+
+COLUMNS = ('name', 'sender', 'recipient', 'timestamp', 'size', 'hash', 'accessed')
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Paths the HTTP server answers itself (see FileTransferHandler.do_GET). A
+# file with one of these names could never be downloaded, so it is shared
+# as "name (2)" instead.
+RESERVED_NAMES = ('metrics', 'search')
+
+
+def is_valid_hash(digest):
+    return bool(digest) and re.fullmatch(r'[0-9a-f]{64}', digest) is not None
+
+
+def record_time(record):
+    # When the record was shared, as a Unix time (None if unknown)
+    try:
+        return datetime.strptime(record['timestamp'], TIMESTAMP_FORMAT).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def is_shared_file(name):
+    # Only plain file names are shared: nothing with a directory part or a
+    # way out of the folder. Dot-files (the database, in-progress uploads)
+    # and sidecars are never served or listed, nor are reserved names.
+    if name in RESERVED_NAMES:
+        return False
+    if not name or name.startswith('.') or name.endswith('.meta') or '..' in name or '\0' in name:
+        return False
+    if '/' in name or os.sep in name or (os.altsep and os.altsep in name):
+        return False
+    return not os.path.isabs(name) and not os.path.splitdrive(name)[0]
+
+
+class MetadataStore:
+    def __init__(self, folder, index=None):
+        self.folder = folder
+        self.index = index
+        self.blob_folder = os.path.join(folder, BLOB_DIR)
+        self.lock = threading.RLock()
+        self.files = {}  # {filename: record}
+        self.refcounts = Counter()  # {hash: number of names pointing at it}
+        self.usage = Counter()  # {sender: bytes of the files they share}
+        self.stored_bytes = 0  # on disk, each blob counted once
+        self.accessed = set()  # names whose access time is not written yet
+        os.makedirs(self.blob_folder, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(folder, DB_NAME), check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY,
+                sender TEXT,
+                recipient TEXT NOT NULL,
+                timestamp TEXT,
+                size INTEGER
+            )""")
+        self.add_missing_columns({'hash': 'TEXT', 'accessed': 'REAL'})
+        self.db.commit()
+        self.load()
+
+    def add_missing_columns(self, columns):
+        existing = {row[1] for row in self.db.execute("PRAGMA table_info(files)")}
+        for column, column_type in columns.items():
+            if column not in existing:
+                self.db.execute(f"ALTER TABLE files ADD COLUMN {column} {column_type}")
+
+    def load(self):
+        invalid = []
+        renamed = []
+        for row in self.db.execute(f"SELECT {', '.join(COLUMNS)} FROM files"):
+            record = dict(zip(COLUMNS, row))
+            if record['name'] in RESERVED_NAMES:
+                # Shared before the name became a route
+                invalid.append((record['name'],))
+                renamed.append(record)
+                continue
+            if not is_shared_file(record['name']):
+                # Imported by older versions from outside the folder
+                invalid.append((record['name'],))
+                continue
+            self.files[record['name']] = record
+            self.retain(record)
+        if invalid:
+            self.db.executemany("DELETE FROM files WHERE name = ?", invalid)
+            self.db.commit()
+        for record in renamed:
+            self.rename_reserved(record)
+
+        # Pick up files (and their sidecars) that predate the database
+        imported = []
+        for name in os.listdir(self.folder):
+            if name not in self.files and is_shared_file(name):
+                record = self.read_legacy(name)
+                if record:
+                    self.files[name] = record
+                    self.retain(record)
+                    imported.append(record)
+        if imported:
+            self.write(imported)
+        if self.index:
+            self.index.sync_files(self.files)
+
+    def rename_reserved(self, record):
+        name = self.unique_name(record['name'], record['sender'], record['recipient'])
+        if not record['hash']:
+            # Content from before content addressing lives under its name
+            try:
+                os.replace(os.path.join(self.folder, record['name']), os.path.join(self.folder, name))
+            except OSError:
+                return
+        record['name'] = name
+        self.files[name] = record
+        self.retain(record)
+        self.write([record])
+
+    def read_legacy(self, name):
+        # Only regular files directly inside the folder; symlinks are not
+        # followed
+        file_path = os.path.join(self.folder, name)
+        try:
+            if not stat.S_ISREG(os.lstat(file_path).st_mode):
+                return None
+        except OSError:
+            return None
+        if not self.contains(file_path):
+            return None
+        record = {
+            'name': name,
+            'sender': None,
+            'recipient': 'all',
+            'timestamp': datetime.fromtimestamp(os.path.getmtime(file_path)).strftime(TIMESTAMP_FORMAT),
+            'size': os.path.getsize(file_path),
+            'hash': None,
+            'accessed': None,
+        }
+        meta_path = f"{file_path}.meta"
+        if os.path.exists(meta_path):
+            try:
+                with open(meta_path, 'r') as f:
+                    metadata = json.load(f)
+                record.update({key: metadata[key] for key in ('sender', 'recipient', 'timestamp') if key in metadata})
+            except (OSError, ValueError):
+                pass
+        return record
+
+    def write(self, records):
+        with self.lock:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO files ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                [tuple(record[column] for column in COLUMNS) for record in records])
+            self.db.commit()
+
+    def get(self, name):
+        record = self.files.get(name)
+        if record is None and is_shared_file(name):
+            # A file copied into the folder by hand while the server runs
+            record = self.read_legacy(name)
+            if record:
+                with self.lock:
+                    self.files[name] = record
+                    self.retain(record)
+                self.write([record])
+                if self.index:
+                    self.index.add_file(record)
+        return record
+
+    def contains(self, path):
+        # True if path resolves to an entry directly inside the folder or
+        # the blob folder
+        parent = os.path.dirname(os.path.realpath(path))
+        return parent in (os.path.realpath(self.folder), os.path.realpath(self.blob_folder))
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_folder, digest)
+
+    def path_for(self, record):
+        if record['hash']:
+            return self.blob_path(record['hash'])
+        return os.path.join(self.folder, record['name'])
+
+    def has_blob(self, digest):
+        return self.refcounts[digest] > 0 or os.path.exists(self.blob_path(digest))
+
+    def unique_name(self, name, sender, recipient):
+        # Re-sharing a name with the same audience replaces it; anyone else
+        # gets "name (2).ext" instead of overwriting somebody's file
+        existing = self.files.get(name)
+        if name not in RESERVED_NAMES and (existing is None or
+                                           (existing['sender'], existing['recipient']) == (sender, recipient)):
+            return name
+        stem, ext = os.path.splitext(name)
+        counter = 2
+        while f"{stem} ({counter}){ext}" in self.files:
+            counter += 1
+        return f"{stem} ({counter}){ext}"
+
+    def add(self, name, sender, recipient, digest, size, temp_path=None):
+        # Maps name to the blob with the given hash. temp_path, if given, is a
+        # freshly uploaded copy of the content that becomes the blob unless an
+        # identical one is already stored.
+        with self.lock:
+            name = self.unique_name(name, sender, recipient)
+            if temp_path:
+                if self.has_blob(digest):
+                    os.remove(temp_path)
+                else:
+                    os.replace(temp_path, self.blob_path(digest))
+            record = {
+                'name': name,
+                'sender': sender,
+                'recipient': recipient,
+                'timestamp': datetime.now().strftime(TIMESTAMP_FORMAT),
+                'size': size,
+                'hash': digest,
+                'accessed': time.time(),
+            }
+            self.retain(record)
+            self.release(self.files.get(name))
+            self.files[name] = record
+            self.write([record])
+            if self.index:
+                self.index.add_file(record)
+            return record
+
+    def retain(self, record):
+        # Caller holds self.lock. Counts a new reference to the record's
+        # content.
+        size = record['size'] or 0
+        self.usage[record['sender']] += size
+        digest = record['hash']
+        if digest:
+            if self.refcounts[digest] == 0:
+                self.stored_bytes += size
+            self.refcounts[digest] += 1
+        else:
+            self.stored_bytes += size
+
+    def release(self, record):
+        # Drops one reference to the record's content, deleting it when it
+        # was the last one
+        if record is None:
+            return
+        size = record['size'] or 0
+        self.usage[record['sender']] -= size
+        if self.usage[record['sender']] <= 0:
+            del self.usage[record['sender']]
+        digest = record['hash']
+        if digest:
+            self.refcounts[digest] -= 1
+            if self.refcounts[digest] <= 0:
+                del self.refcounts[digest]
+                paths = [self.blob_path(digest)]
+            else:
+                return
+        else:
+            path = os.path.join(self.folder, record['name'])
+            paths = [path, f"{path}.meta"]
+        self.stored_bytes -= size
+        for path in paths:
+            # Never delete anything outside the folder, whatever the record says
+            if os.path.exists(path) and self.contains(path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    # The record is gone either way; an unreferenced blob
+                    # left behind is deleted later as an orphan
+                    print(f"Error deleting {path}: {e}")
+
+    def touch(self, name):
+        # Marks a file as just downloaded
+        record = self.files.get(name)
+        if record is not None:
+            record['accessed'] = time.time()
+            self.accessed.add(name)
+
+    def flush_access(self):
+        with self.lock:
+            names, self.accessed = self.accessed, set()
+            rows = [(self.files[name]['accessed'], name) for name in names if name in self.files]
+            if rows:
+                self.db.executemany("UPDATE files SET accessed = ? WHERE name = ?", rows)
+                self.db.commit()
+
+    def last_used(self, record):
+        return record['accessed'] or record_time(record) or 0
+
+    def remove(self, name, record=None):
+        # With a record, only removes the name if it still refers to that
+        # record: a caller holding an older lookup must not delete a file
+        # shared again under the same name since
+        with self.lock:
+            current = self.files.get(name)
+            if current is None or (record is not None and current is not record):
+                return False
+            del self.files[name]
+            self.accessed.discard(name)
+            self.release(current)
+            self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+            self.db.commit()
+            if self.index:
+                self.index.remove_file(name)
+            return True
+
+    @staticmethod
+    def can_access(record, username):
+        return record['recipient'] == 'all' or record['recipient'] == username
+
+    def list_files(self, username, query=None):
+        # Files visible to username, newest first, optionally filtered by a
+        # case-insensitive substring of the name
+        query = query.lower() if query else None
+        records = [
+            record for record in list(self.files.values())
+            if self.can_access(record, username) and (not query or query in record['name'].lower())
+        ]
+        records.sort(key=lambda record: record['timestamp'] or '', reverse=True)
+        return records
@@ -0,0 +1,206 @@
+import bisect
+import threading
+
+# Minimal in-process metrics exposed in the Prometheus text format on the
+# HTTP server's /metrics route. Instruments are created once up front and
+# updated from the hot paths, so an update is a lock and an addition;
+# NullMetrics hands out instruments that do nothing when metrics are
+# disabled.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+THROUGHPUT_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}  # {label values: child instrument}
+
+    def labels(self, *values):
+        # Look children up once and keep them; the lookup is not meant for
+        # every update
+        values = tuple(str(value) for value in values)
+        with self.lock:
+            child = self.children.get(values)
+            if child is None:
+                child = self.children[values] = self.make_child()
+            return child
+
+    def make_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        # Yields (suffix, label values, extra labels, value)
+        with self.lock:
+            children = list(self.children.items())
+        for values, child in children:
+            yield from child.samples(values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self.samples():
+            labels = format_labels(list(zip(self.labelnames, values)) + list(extra))
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return '\n'.join(lines)
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, values):
+        yield '', values, (), self.value
+
+
+class Counter(Metric):
+    # Exposed as <name>_total, in the samples and in HELP/TYPE alike
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        if not name.endswith('_total'):
+            name += '_total'
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            self.default = self.labels()
+            self.inc = self.default.inc
+
+    def make_child(self):
+        return CounterChild()
+
+
+class Gauge(Metric):
+    # Gauges are read at scrape time from a callback, so nothing has to be
+    # kept up to date on the hot path
+    kind = 'gauge'
+
+    def __init__(self, name, help, func):
+        super().__init__(name, help)
+        self.func = func
+
+    def samples(self):
+        yield '', (), (), self.func()
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[slot] += 1
+            self.sum += value
+
+    def samples(self, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield '_bucket', values, (('le', format_value(float(bound))),), cumulative
+        yield '_sum', values, (), total
+        yield '_count', values, (), cumulative
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            self.default = self.labels()
+            self.observe = self.default.observe
+
+    def make_child(self):
+        return HistogramChild(self.buckets)
+
+
+class Metrics:
+    enabled = True
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, func):
+        return self.register(Gauge(name, help, func))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+class NullInstrument:
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+NULL_INSTRUMENT = NullInstrument()
+
+
+class NullMetrics:
+    # Same interface as Metrics; every instrument is a shared no-op
+    enabled = False
+
+    def counter(self, name, help, labelnames=()):
+        return NULL_INSTRUMENT
+
+    def gauge(self, name, help, func):
+        return NULL_INSTRUMENT
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return NULL_INSTRUMENT
+
+    def render(self):
+        return ''
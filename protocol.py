@@ -0,0 +1,237 @@
+import codecs
+import os
+import re
+import struct
+import zlib
+
+# Wire protocol shared by server.py and client.py.
+#
+# Version 1 (legacy): the client sends its bare username, every message is a
+# raw UTF-8 send and each recv() is treated as one message.
+#
+# Version 2: the client opens with "HELLO|<version>|<username>[|key=value...]"
+# ending in a newline and, from then on, every message in both directions is
+# a frame: a 4-byte big-endian payload length followed by UTF-8 text.
+#
+# The server reads the HELLO up to its newline, however it arrives, and
+# hands any frames sent right behind it to the frame decoder. Clients from
+# before the newline still get in: a bare version 1 username is taken as
+# soon as it arrives, and a HELLO without a newline once HELLO_TIMEOUT
+# seconds pass without more bytes.
+
+PROTOCOL_VERSION = 2
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+HELLO_PREFIX = b'HELLO|'
+HELLO_TERMINATOR = b'\n'
+MAX_HELLO_SIZE = 4096
+HELLO_TIMEOUT = 1
+
+# Compression is negotiated in the handshake: the client lists what it
+# supports with "compress=zlib" and the server names the method it picked in
+# SERVER_INFO. Everything after SERVER_INFO then travels, in both directions,
+# as one zlib stream per direction, flushed (Z_SYNC_FLUSH) after every write.
+COMPRESSION_METHODS = ('zlib',)
+COMPRESSION_LEVEL = 6
+
+# gzip level for file transfers; level 1 still outpaces a LAN link on one core
+TRANSFER_COMPRESSION_LEVEL = 1
+
+# Smaller file transfers are never compressed
+MIN_COMPRESS_SIZE = 1024
+
+# Files of these types are already compressed; transferring them with a
+# Content-Encoding would only cost CPU
+COMPRESSED_EXTENSIONS = {
+    '.7z', '.apk', '.avi', '.br', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic', '.jar',
+    '.jpeg', '.jpg', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.odt', '.ogg', '.pdf', '.png',
+    '.pptx', '.rar', '.tgz', '.webm', '.webp', '.woff2', '.xlsx', '.xz', '.zip', '.zst',
+}
+
+# Large files are transferred as TRANSFER_PART_SIZE byte ranges over several
+# connections at once. Each part is checked against its own SHA-256, so a
+# corrupted or interrupted part is sent again on its own.
+TRANSFER_PART_SIZE = 8 * 1024 * 1024
+TRANSFER_STREAMS = 4
+PARALLEL_MIN_SIZE = 2 * TRANSFER_PART_SIZE
+
+# Every client is always in the default channel; messages sent without a
+# channel go there and are delivered unprefixed, exactly as before channels
+# existed. Other channels are opt-in ("/join <name>", "/leave <name>",
+# "/say <name> <text>", "/channels") and their traffic is delivered as
+# "CHANNEL|<name>|<text>".
+DEFAULT_CHANNEL = 'general'
+CHANNEL_NAME = re.compile(r'[A-Za-z0-9_-]{1,32}')
+
+# Clients that send "presence=1" in HELLO get structured presence instead
+# of having to read "joined the chat!" lines: a
+# "PRESENCE_SNAPSHOT|<seq>|<user,...>|<away user,...>" right after
+# SERVER_INFO, periodically and in reply to "/presence", and one
+# "PRESENCE|<seq>|<op>|<user>" per change in between. Sequence numbers go
+# up by one per change, so a gap means an update was lost and the client
+# should ask for a snapshot. "/away" and "/back" set the sender's status.
+PRESENCE_JOIN = 'join'
+PRESENCE_LEAVE = 'leave'
+PRESENCE_AWAY = 'away'
+PRESENCE_BACK = 'back'
+
+# Clients that send "heartbeat=1" in HELLO are told the server's heartbeat
+# interval as the last SERVER_INFO field. Either side may send "PING" after
+# that long without hearing from the other and gets "PONG" back; the server
+# drops heartbeat clients that stay silent for its idle timeout. With
+# "session=1" the server also sends "SESSION|<token>|0|<grace seconds>": a
+# client that loses its connection can reconnect with "resume=<token>"
+# within the grace period and gets "SESSION|<token>|1|<grace seconds>" after
+# everything it missed, instead of leaving and joining again. "/quit" ends a
+# session for good.
+
+# "/search <words> [page=<n>]" is answered with one
+# "SEARCH_RESULTS|<json>" message: {"query", "page", "more", "results"},
+# each result a {"kind", "sender", "recipient", "channel", "timestamp",
+# "text", "snippet"} object with the matched words marked *like this*.
+
+
+def encode_frame(message):
+    data = message.encode() if isinstance(message, str) else message
+    return HEADER.pack(len(data)) + data
+
+
+def encode_frames(messages):
+    return b''.join(encode_frame(message) for message in messages)
+
+
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data, max_messages=None):
+        # Returns every complete message in the buffer (at most max_messages);
+        # partial frames and anything past the limit are kept in the buffer.
+        self.buffer += data
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size and len(messages) != max_messages:
+            (length,) = HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError(f"Frame of {length} bytes exceeds limit")
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            messages.append(self.buffer[offset + HEADER.size:end].decode())
+            offset = end
+        del self.buffer[:offset]
+        return messages
+
+
+class DecompressingDecoder:
+    # Inflates a compressed stream before handing it to a FrameDecoder.
+    # Output is produced in bounded steps so a tiny, highly compressed
+    # input can't balloon past the frame size limit in one go.
+    def __init__(self, frames=None):
+        self.frames = frames or FrameDecoder()
+        self.decompressor = zlib.decompressobj()
+
+    def feed(self, data):
+        messages = []
+        while data:
+            chunk = self.decompressor.decompress(data, 256 * 1024)
+            messages.extend(self.frames.feed(chunk))
+            data = self.decompressor.unconsumed_tail
+        return messages
+
+
+class Compressor:
+    def __init__(self, level=COMPRESSION_LEVEL):
+        self.compressor = zlib.compressobj(level)
+
+    def compress(self, data):
+        # Flushed so the peer can decode everything written so far
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class LegacyDecoder:
+    # Version 1 has no message boundaries; decode incrementally so a
+    # multibyte character split across reads does not raise.
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def feed(self, data):
+        text = self.decoder.decode(data)
+        return [text] if text else []
+
+
+def make_decoder(version):
+    return FrameDecoder() if version >= 2 else LegacyDecoder()
+
+
+def encode_message(message, version):
+    return encode_frame(message) if version >= 2 else message.encode()
+
+
+def normalize_channel(name):
+    # Returns the channel name without a leading '#', or None if invalid
+    name = name.strip().lstrip('#')
+    return name if CHANNEL_NAME.fullmatch(name) else None
+
+
+def choose_compression(options):
+    # The first method the client offered that we support, or None
+    for method in options.get('compress', '').split(','):
+        if method in COMPRESSION_METHODS:
+            return method
+    return None
+
+
+def is_compressible(filename):
+    return os.path.splitext(filename)[1].lower() not in COMPRESSED_EXTENSIONS
+
+
+def part_ranges(size, part_size=TRANSFER_PART_SIZE):
+    # (offset, length) of every part of a file of `size` bytes
+    return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+
+
+def preallocate(f, size):
+    # Reserves the full size up front so parts can be written in place in
+    # any order without fragmenting the file
+    f.truncate(size)
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass
+
+
+def make_hello(username, version=PROTOCOL_VERSION, **options):
+    fields = ["HELLO", str(version), username]
+    fields.extend(f"{key}={value}" for key, value in options.items())
+    return "|".join(fields) + HELLO_TERMINATOR.decode()
+
+
+def split_hello(buffer):
+    # Returns (handshake, bytes received after it) once buffer holds the
+    # whole handshake, or None while more is expected. Raises ValueError
+    # if a HELLO runs past MAX_HELLO_SIZE without its newline.
+    end = buffer.find(HELLO_TERMINATOR)
+    if end != -1:
+        return bytes(buffer[:end]), bytes(buffer[end + 1:])
+    if not HELLO_PREFIX.startswith(bytes(buffer[:len(HELLO_PREFIX)])):
+        # A version 1 client's username, sent in one piece
+        return bytes(buffer), b''
+    if len(buffer) > MAX_HELLO_SIZE:
+        raise ValueError("Handshake too long")
+    return None
+
+
+def parse_hello(text):
+    # Returns (version, username, options); anything that is not a HELLO
+    # line is a version 1 client sending its bare username.
+    text = text.rstrip("\r\n")
+    if not text.startswith("HELLO|"):
+        return 1, text, {}
+    fields = text.split("|")
+    if len(fields) < 3 or not fields[1].isdigit():
+        return 1, text, {}
+    options = dict(field.split("=", 1) for field in fields[3:] if "=" in field)
+    return int(fields[1]), fields[2], options
@@ -0,0 +1,164 @@
+import os
+import shutil
+import threading
+import time
+from metadata import is_valid_hash, record_time
+from metrics import NULL_INSTRUMENT
+
+# Keeps the shared files folder within bounds. Uploads are checked against
+# a maximum file size, a per-user quota (bytes of the files a user shares),
+# a global one (bytes on disk, shared content counted once) and the free
+# disk space before their body is read.
+# A sweeper thread removes files older than the TTL and, with evict_lru,
+# the least recently downloaded files while the folder is above HIGH_WATER
+# of the global quota. It also deletes leftovers: .meta sidecars whose file
+# is gone, temporary uploads abandoned by a crash and unreferenced blobs.
+# Files are removed one at a time, at most SWEEP_LIMIT per pass, so
+# transfers never wait long for the metadata lock.
+
+SWEEP_INTERVAL = 60
+
+# Default limit on the size of one shared file
+MAX_UPLOAD_SIZE = 16 * 1024 ** 3
+SWEEP_LIMIT = 200
+HIGH_WATER = 0.9
+
+# Temporary uploads and unreferenced blobs untouched for this long are
+# leftovers (an active upload writes to its file at least every hour)
+ORPHAN_AGE = 2 * 3600
+
+
+def format_size(size):
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'bytes' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+class StorageManager:
+    def __init__(self, store, user_quota=0, storage_quota=0, ttl=0, evict_lru=False,
+                 removed_counter=NULL_INSTRUMENT, max_upload_size=MAX_UPLOAD_SIZE):
+        self.store = store
+        self.max_upload_size = max_upload_size  # bytes, 0 = unlimited
+        self.user_quota = user_quota  # bytes, 0 = unlimited
+        self.storage_quota = storage_quota  # bytes, 0 = unlimited
+        self.ttl = ttl  # seconds, 0 = keep files forever
+        self.evict_lru = evict_lru
+        self.removed_counter = removed_counter
+
+    def check_upload(self, username, size, digest=None, reserved=None):
+        # Returns None if sharing `size` more bytes is allowed, otherwise an
+        # HTTP status and message. Content the server already holds takes
+        # no extra disk space. reserved is given while the content is still
+        # to be received: the bytes promised to unfinished uploads, which
+        # must fit on the disk along with it.
+        store = self.store
+        if self.max_upload_size and size > self.max_upload_size:
+            return 413, f"File too large: the limit is {format_size(self.max_upload_size)}"
+        if self.user_quota and store.usage[username] + size > self.user_quota:
+            total = store.usage[username] + size
+            return 413, f"Quota exceeded: this would bring your shared files to {format_size(total)} of {format_size(self.user_quota)}"
+        new_bytes = 0 if digest and store.has_blob(digest) else size
+        if self.storage_quota and new_bytes and store.stored_bytes + new_bytes > self.storage_quota:
+            return 507, "Server storage is full"
+        if reserved is not None and new_bytes:
+            try:
+                free = shutil.disk_usage(store.blob_folder).free
+            except OSError:
+                free = None
+            if free is not None and reserved + new_bytes > free:
+                return 507, "Not enough disk space on the server"
+        return None
+
+    def start(self):
+        thread = threading.Thread(target=self.sweep_loop)
+        thread.daemon = True
+        thread.start()
+
+    def sweep_loop(self):
+        while True:
+            try:
+                finished = self.sweep()
+            except Exception as e:
+                # A failed pass (a full disk, a locked database) must not
+                # stop the sweeper for good
+                print(f"Error sweeping shared files: {e}")
+                finished = True
+            # Come back sooner while there is a backlog
+            time.sleep(SWEEP_INTERVAL if finished else 1)
+
+    def sweep(self):
+        # One pass; returns False if it stopped at SWEEP_LIMIT
+        self.store.flush_access()
+        budget = SWEEP_LIMIT
+        budget -= self.remove(self.expired(), 'ttl', budget)
+        if budget and self.evict_lru:
+            budget -= self.evict_least_recently_used(budget)
+        if budget:
+            budget -= self.remove_orphans(budget)
+        return budget > 0
+
+    def expired(self):
+        if not self.ttl:
+            return []
+        cutoff = time.time() - self.ttl
+        return [record for record in list(self.store.files.values())
+                if (record_time(record) or cutoff) < cutoff]
+
+    def remove(self, records, reason, budget):
+        # The records are a snapshot: a name shared again since is skipped
+        removed = 0
+        for record in records[:budget]:
+            if self.store.remove(record['name'], record):
+                self.removed_counter.labels(reason).inc()
+                removed += 1
+        return removed
+
+    def evict_least_recently_used(self, budget):
+        if not self.storage_quota:
+            return 0
+        target = self.storage_quota * HIGH_WATER
+        if self.store.stored_bytes <= target:
+            return 0
+        records = sorted(list(self.store.files.values()), key=self.store.last_used)
+        removed = 0
+        for record in records:
+            if self.store.stored_bytes <= target or removed >= budget:
+                break
+            removed += self.remove([record], 'lru', 1)
+        return removed
+
+    def remove_orphans(self, budget):
+        store = self.store
+        cutoff = time.time() - ORPHAN_AGE
+        leftovers = []
+        with os.scandir(store.folder) as entries:
+            for entry in entries:
+                # A sidecar whose file was deleted by hand
+                if entry.name.endswith('.meta') and not os.path.exists(entry.path[:-len('.meta')]):
+                    leftovers.append(entry.path)
+        with os.scandir(store.blob_folder) as entries:
+            for entry in entries:
+                if entry.name.startswith('.upload-') or is_valid_hash(entry.name):
+                    try:
+                        stale = entry.stat().st_mtime < cutoff
+                    except OSError:
+                        continue
+                    if stale:
+                        leftovers.append(entry.path)
+        removed = 0
+        for path in leftovers[:budget]:
+            with store.lock:
+                # A blob may have been shared again since the scan
+                name = os.path.basename(path)
+                if is_valid_hash(name) and store.refcounts[name] > 0:
+                    continue
+                if not store.contains(path):
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+            self.removed_counter.labels('orphan').inc()
+            removed += 1
+        return removed
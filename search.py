@@ -0,0 +1,209 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from metadata import record_time
+
+# Full-text index over public and channel messages, private messages and
+# shared file names, in SQLite FTS5 tables. Messages are queued and written
+# in batches every FLUSH_INTERVAL seconds (and before every search) so
+# indexing never adds a disk write to the broadcast path; file records are
+# written as they change. Results are ranked by bm25, newest first on ties,
+# and come PAGE_SIZE at a time.
+#
+# Messages go to the index in the given folder, which is per worker. File
+# names go to a second database attached from files_folder: with --workers
+# every worker attaches the same one, written only by the worker serving
+# files, so all of them can find files.
+
+DB_NAME = 'search.db'
+FILES_DB_NAME = 'search-files.db'
+FLUSH_INTERVAL = 0.5
+PAGE_SIZE = 20
+
+# Entry kinds
+MESSAGE = 'message'
+PRIVATE = 'private'
+FILE = 'file'
+
+# "[12:34:56] alice: hello" as broadcast by the server
+CHAT_LINE = re.compile(r'\[\d\d:\d\d:\d\d\] ([^:\s][^:]*): (.*)', re.DOTALL)
+
+
+def parse_chat_line(text):
+    # Returns (sender, text) for a user's message; None for joins, leaves
+    # and server notices, which are not worth finding again
+    match = CHAT_LINE.fullmatch(text.strip())
+    if match is None or match.group(1) == 'SERVER':
+        return None
+    return match.group(1), match.group(2)
+
+
+def make_query(text):
+    # Every word must match, as a prefix; FTS5 operators in user input are
+    # treated as plain words
+    words = re.findall(r'\w+', text)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def file_timestamp(record):
+    return record_time(record) or time.time()
+
+
+class SearchIndex:
+    def __init__(self, folder, files_folder=None):
+        self.lock = threading.Lock()
+        self.pending = []  # message rows waiting for the next flush
+        self.db = sqlite3.connect(os.path.join(folder, DB_NAME), check_same_thread=False)
+        self.db.execute("ATTACH DATABASE ? AS shared", (os.path.join(files_folder or folder, FILES_DB_NAME),))
+        for schema in ('main', 'shared'):
+            self.db.execute(f"PRAGMA {schema}.journal_mode=WAL")
+            self.db.execute(f"PRAGMA {schema}.synchronous=NORMAL")
+        # Raises sqlite3.OperationalError if SQLite was built without FTS5
+        self.db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS entries USING fts5(
+                body, kind UNINDEXED, sender UNINDEXED, recipient UNINDEXED,
+                channel UNINDEXED, timestamp UNINDEXED, tokenize='unicode61 remove_diacritics 2'
+            )""")
+        self.db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS shared.files USING fts5(
+                body, sender UNINDEXED, recipient UNINDEXED, timestamp UNINDEXED,
+                tokenize='unicode61 remove_diacritics 2'
+            )""")
+        # Row of each file's entry, so a removed file can be dropped without
+        # scanning the index
+        self.db.execute("CREATE TABLE IF NOT EXISTS shared.file_rows (name TEXT PRIMARY KEY, row INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)")
+        if self.db.execute("SELECT 1 FROM main.sqlite_master WHERE name = 'file_rows'").fetchone():
+            # Files were indexed with the messages before; the server that
+            # shares them indexes them again into the shared database
+            self.db.execute(f"DELETE FROM entries WHERE kind = '{FILE}'")
+            self.db.execute("DROP TABLE main.file_rows")
+        self.db.commit()
+        row = self.db.execute("SELECT value FROM state WHERE key = 'history'").fetchone()
+        # Newest logged public message already indexed
+        self.history_mark = row[0] if row else 0
+
+    def start(self):
+        thread = threading.Thread(target=self.flush_loop)
+        thread.daemon = True
+        thread.start()
+
+    def flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                # Public messages missed here are picked up again from the
+                # history on the next start
+                print(f"Error updating the search index: {e}")
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            rows, self.pending = self.pending, []
+            self.db.executemany(
+                "INSERT INTO entries (body, kind, sender, recipient, channel, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                rows)
+            public = [row[5] for row in rows if row[4] is not None]
+            if public:
+                self.history_mark = max(self.history_mark, max(public))
+                self.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('history', ?)",
+                                (self.history_mark,))
+            self.db.commit()
+
+    def add_public(self, line, channel, timestamp=None):
+        parsed = parse_chat_line(line)
+        if parsed is None:
+            return
+        sender, text = parsed
+        with self.lock:
+            self.pending.append((text, MESSAGE, sender, None, channel, timestamp or time.time()))
+
+    def add_private(self, sender, recipient, text):
+        with self.lock:
+            self.pending.append((text, PRIVATE, sender, recipient, None, time.time()))
+
+    def catch_up(self, history, channel, until):
+        # Indexes public messages logged while the index was not running
+        # (or before it existed), up to `until`, when live indexing took over
+        for timestamp, text in history.iter_since(self.history_mark):
+            if timestamp > until:
+                break
+            self.add_public(text, channel, timestamp)
+        self.flush()
+
+    def add_file(self, record):
+        with self.lock:
+            self.delete_file(record['name'])
+            cursor = self.db.execute(
+                "INSERT INTO files (body, sender, recipient, timestamp) VALUES (?, ?, ?, ?)",
+                (record['name'], record['sender'], record['recipient'], file_timestamp(record)))
+            self.db.execute("INSERT INTO file_rows (name, row) VALUES (?, ?)", (record['name'], cursor.lastrowid))
+            self.db.commit()
+
+    def remove_file(self, name):
+        with self.lock:
+            self.delete_file(name)
+            self.db.commit()
+
+    def delete_file(self, name):
+        # Caller holds self.lock
+        row = self.db.execute("SELECT row FROM file_rows WHERE name = ?", (name,)).fetchone()
+        if row:
+            self.db.execute("DELETE FROM files WHERE rowid = ?", (row[0],))
+            self.db.execute("DELETE FROM file_rows WHERE name = ?", (name,))
+
+    def sync_files(self, records):
+        # Brings the file entries in line with the metadata store at startup
+        with self.lock:
+            indexed = {name for name, in self.db.execute("SELECT name FROM file_rows")}
+        for name in indexed - set(records):
+            self.remove_file(name)
+        for name, record in records.items():
+            if name not in indexed:
+                self.add_file(record)
+
+    def search(self, text, username, channels, page=1, private=True):
+        # Returns (results, more) for the entries username may see: public
+        # messages in `channels`, their own private messages (unless
+        # private is False) and the files they can download
+        query = make_query(text)
+        if not query:
+            return [], False
+        self.flush()
+        page = max(page, 1)
+        channels = list(channels)
+        sql = f"""
+            SELECT kind, sender, recipient, channel, timestamp, body, snippet FROM (
+                SELECT kind, sender, recipient, channel, timestamp, body,
+                       snippet(entries, 0, '*', '*', '...', 16) AS snippet, bm25(entries) AS score
+                FROM entries
+                WHERE entries MATCH ? AND (
+                    (kind = '{MESSAGE}' AND channel IN ({', '.join('?' * len(channels))}))
+                    OR (kind = '{PRIVATE}' AND ? AND (sender = ? OR recipient = ?)))
+                UNION ALL
+                SELECT '{FILE}', sender, recipient, NULL, timestamp, body,
+                       snippet(files, 0, '*', '*', '...', 16), bm25(files)
+                FROM files
+                WHERE files MATCH ? AND (recipient = 'all' OR recipient = ?))
+            ORDER BY score, timestamp DESC
+            LIMIT ? OFFSET ?"""
+        params = [query] + channels + [int(private), username, username, query, username,
+                                       PAGE_SIZE + 1, (page - 1) * PAGE_SIZE]
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        results = [
+            {'kind': kind, 'sender': sender, 'recipient': recipient, 'channel': channel,
+             'timestamp': timestamp, 'text': body, 'snippet': snippet}
+            for kind, sender, recipient, channel, timestamp, body, snippet in rows[:PAGE_SIZE]
+        ]
+        return results, len(rows) > PAGE_SIZE
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
@@ -1,214 +1,1746 @@
 import socket
 import threading
+import asyncio
+import argparse
+import multiprocessing
 import os
+import signal
+import sys
 from datetime import datetime
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import json
+import tempfile
+import time
+import hashlib
+import hmac
+import math
+import secrets
+import selectors
+import zlib
+import re
+import sqlite3
 from urllib.parse import parse_qs, urlparse, unquote
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import protocol
+from protocol import DEFAULT_CHANNEL, PRESENCE_JOIN, PRESENCE_LEAVE, PRESENCE_AWAY, PRESENCE_BACK, normalize_channel
+from metadata import MetadataStore, RESERVED_NAMES, is_valid_hash, is_shared_file
+from history import MessageLog
+from search import SearchIndex
+from mailboxes import MailboxStore, MAILBOX_SIZE, MAILBOX_EXPIRY, STORED, UNKNOWN, FULL
+from retention import StorageManager, MAX_UPLOAD_SIZE
+from bus import MessageBus, BusClient
+from discovery import Announcer
+from metrics import Metrics, NullMetrics, NULL_INSTRUMENT, THROUGHPUT_BUCKETS, CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+# Slow-consumer policies for per-client outbound queues
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+COALESCE = 'coalesce'
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, DISCONNECT, COALESCE)
+
+# Block size used when streaming file transfers
+CHUNK_SIZE = 64 * 1024
+
+# Content-Encodings accepted for uploads
+UPLOAD_ENCODINGS = ('identity', 'gzip', 'deflate')
+
+# Parallel uploads are named by a client-chosen id; unfinished ones are
+# dropped after UPLOAD_EXPIRY seconds without a new part. Each user may
+# have MAX_OPEN_UPLOADS of them at once.
+UPLOAD_ID = re.compile(r'[0-9a-f]{32}')
+UPLOAD_EXPIRY = 3600
+MAX_OPEN_UPLOADS = 8
+
+# Part hash lists kept for recently downloaded files
+PART_HASH_CACHE_SIZE = 64
+
+# Keep-alive connections waiting for their next request are watched by one
+# selector thread instead of holding a pool worker. They are closed after
+# KEEPALIVE_TIMEOUT seconds, and the longest-idle ones first once there are
+# more than MAX_IDLE_CONNECTIONS.
+KEEPALIVE_TIMEOUT = 30
+MAX_IDLE_CONNECTIONS = 256
+
+# Longest time between two runs of the reaper (heartbeats, idle clients,
+# expired sessions)
+REAP_INTERVAL = 5
+
+def file_etag(stat):
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+def accepts_encoding(header, encoding):
+    # True if an Accept-Encoding header allows `encoding` (q=0 refuses it)
+    for part in (header or '').split(','):
+        name, _, params = part.partition(';')
+        if name.strip().lower() in (encoding, '*'):
+            for param in params.split(';'):
+                key, _, value = param.strip().partition('=')
+                if key.lower() == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+def enable_keepalive(sock, idle):
+    # Lets the kernel notice a vanished peer (lid closed, cable pulled)
+    # after `idle` seconds of silence, even for clients that never answer
+    # heartbeats
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', max(idle // 6, 1)), ('TCP_KEEPCNT', 3)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), int(value))
+
+def parse_byte_range(header, size):
+    # Returns the inclusive (start, end) of a single "bytes=" range, or None
+    # when the header should be ignored (malformed or multiple ranges).
+    # Raises ValueError when the range cannot be satisfied.
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep or not (first.isdigit() or last.isdigit()):
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
 
 class FileTransferHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
+    # HTTP/1.1 keeps connections open between requests. A request that
+    # stalls for `timeout` seconds is dropped to free its worker; between
+    # requests the connection is handed back to the server (keep_alive).
+    protocol_version = 'HTTP/1.1'
+    timeout = 30
+
+    def handle(self):
+        self.keep_alive = False
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self.next_request_ready():
+                self.keep_alive = True
+                return
+            self.handle_one_request()
+
+    def next_request_ready(self):
+        # True if the client already sent (part of) its next request, in
+        # the read buffer or on the socket; never waits
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def do_HEAD(self):
+        self.do_GET(send_body=False)
+
+    def do_GET(self, send_body=True):
         try:
             # Parse URL and query parameters
             parsed_url = urlparse(self.path)
             path = unquote(parsed_url.path)[1:]  # Remove leading '/' and decode
+            if parsed_url.path == '/metrics':
+                self.send_metrics(send_body)
+                return
             
             # Check if the file is meant for this user
             requesting_user = self.headers.get('X-Username')
             if not requesting_user:
-                self.send_response(403)
-                self.end_headers()
-                self.wfile.write(b'Username required')
+                self.send_text(403, b'Username required')
+                return
+
+            chat_server = self.server.chat_server
+            query = parse_qs(parsed_url.query, keep_blank_values=True)
+            if not path:
+                # The root lists the files this user may download; ?q= filters by name
+                query = query.get('q', [None])[0]
+                self.send_json(chat_server.metadata.list_files(requesting_user, query), send_body)
+                return
+            if parsed_url.path == '/search':
+                self.send_search_results(requesting_user, query, send_body)
                 return
                 
-            file_path = os.path.join('server_files', path)
-            
             # Check if file exists and user has permission
-            if os.path.exists(file_path):
-                # Read file metadata
-                meta_path = f"{file_path}.meta"
-                if os.path.exists(meta_path):
-                    with open(meta_path, 'r') as f:
-                        metadata = json.load(f)
-                        if metadata['recipient'] != 'all' and metadata['recipient'] != requesting_user:
-                            self.send_response(403)
-                            self.end_headers()
-                            self.wfile.write(b'Access denied')
-                            return
+            record = chat_server.metadata.get(path)
+            if record is None:
+                self.send_text(404, b'File not found')
+                return
+            if not chat_server.metadata.can_access(record, requesting_user):
+                self.send_text(403, b'Access denied')
+                return
+            file_path = chat_server.metadata.path_for(record)
                 
-                # Send the file if authorized
-                with open(file_path, 'rb') as f:
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/octet-stream')
-                    self.end_headers()
-                    self.wfile.write(f.read())
-            else:
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write(b'File not found')
+            # Send the file if authorized; HEAD streams nothing, so it
+            # doesn't wait for a transfer slot
+            with self.server.transfer_slot(needed=send_body) as acquired:
+                if not acquired:
+                    self.send_busy()
+                    return
+                try:
+                    if 'parts' in query:
+                        self.send_part_hashes(file_path, send_body)
+                    else:
+                        self.send_file(file_path, send_body, record['name'])
+                        if send_body:
+                            chat_server.metadata.touch(record['name'])
+                except FileNotFoundError:
+                    # Deleted behind the server's back; the name may have
+                    # been shared again meanwhile, so only drop this record
+                    chat_server.metadata.remove(path, record)
+                    self.send_text(404, b'File not found')
                 
+        except ConnectionError as e:
+            print(f"Error serving file: {e}")
         except Exception as e:
             print(f"Error serving file: {e}")
-            self.send_response(500)
+            self.send_text(500, b'Internal server error', close=True)
+
+    def send_json(self, data, send_body=True):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_search_results(self, username, query, send_body=True):
+        # ?q=<words>&page=<n> over public messages and the files the user
+        # may download. X-Username is not authenticated, so private
+        # messages are only searchable over the chat connection.
+        chat_server = self.server.chat_server
+        if chat_server.search_index is None:
+            self.send_text(404, b'Search disabled')
+            return
+        try:
+            page = int(query.get('page', ['1'])[0])
+        except ValueError:
+            self.send_text(400, b'Invalid page')
+            return
+        text = query.get('q', [''])[0]
+        results, more = chat_server.run_search(text, username, [DEFAULT_CHANNEL], page, private=False)
+        self.send_json({'query': text, 'page': page, 'more': more, 'results': results}, send_body)
+
+    def send_text(self, status, body, close=False):
+        # Every response carries a Content-Length so keep-alive connections
+        # can be reused for the next request. A HEAD response has no body,
+        # or the client would read it as the start of the next response.
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if close:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_metrics(self, send_body=True):
+        registry = self.server.chat_server.metrics
+        if not registry.enabled:
+            self.send_text(404, b'Metrics disabled')
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def record_transfer(self, direction, size, elapsed):
+        chat_server = self.server.chat_server
+        chat_server.transfer_bytes.labels(direction).inc(size)
+        if size and elapsed > 0:
+            chat_server.transfer_throughput.labels(direction).observe(size / elapsed)
+
+    def send_busy(self, close=False):
+        self.send_response(503)
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', '0')
+        if close:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def send_part_hashes(self, file_path, send_body=True):
+        # ?parts lists the SHA-256 of every TRANSFER_PART_SIZE block, so a
+        # parallel download can check (and resume) each range on its own
+        stat = os.stat(file_path)
+        etag = file_etag(stat)
+        body = json.dumps({
+            'size': stat.st_size,
+            'etag': etag,
+            'part_size': protocol.TRANSFER_PART_SIZE,
+            'parts': self.server.part_hashes(file_path, etag),
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_file(self, file_path, send_body=True, name=''):
+        with open(file_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            etag = file_etag(stat)
+            last_modified = self.date_time_string(stat.st_mtime)
+            start, end = 0, size - 1
+
+            # Compress whole-file responses of compressible types when the
+            # client accepts gzip. Byte ranges only exist on the stored
+            # (identity) bytes: a request with Range or If-Range, i.e. a
+            # resume, is always served as stored.
+            gzip_etag = f'"{size:x}-{stat.st_mtime_ns:x}-gzip"'
+            if (self.server.chat_server.compression and 'Range' not in self.headers
+                    and 'If-Range' not in self.headers
+                    and size >= protocol.MIN_COMPRESS_SIZE and protocol.is_compressible(name)
+                    and accepts_encoding(self.headers.get('Accept-Encoding'), 'gzip')):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.send_header('Vary', 'Accept-Encoding')
+                self.send_header('ETag', gzip_etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                if send_body:
+                    started = time.perf_counter()
+                    self.send_gzip(f)
+                    self.record_transfer('download', size, time.perf_counter() - started)
+                return
+
+            # Honour Range only if the client's copy is still current. A
+            # gzip download interrupted midway left the client the decoded,
+            # i.e. stored, bytes, so the gzip ETag of the same version
+            # validates resuming it from the stored file.
+            range_header = self.headers.get('Range')
+            if_range = self.headers.get('If-Range')
+            if range_header and if_range not in (None, etag, gzip_etag, last_modified):
+                range_header = None
+            byte_range = None
+            if range_header and size:
+                try:
+                    byte_range = parse_byte_range(range_header, size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+            if byte_range:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
             self.end_headers()
-            self.wfile.write(b'Internal server error')
+
+            if send_body and end >= start:
+                # Hand the copy to the kernel (os.sendfile where available)
+                # instead of reading the file into Python memory
+                self.wfile.flush()
+                started = time.perf_counter()
+                sent = self.connection.sendfile(f, offset=start, count=end - start + 1)
+                self.record_transfer('download', sent, time.perf_counter() - started)
+
+    def send_gzip(self, f):
+        compressor = zlib.compressobj(protocol.TRANSFER_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        encoded = 0
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            data = compressor.compress(block)
+            if data:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                encoded += len(data)
+        data = compressor.flush()
+        self.wfile.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(data), data))
+        self.server.chat_server.encoded_bytes.labels('download').inc(encoded + len(data))
+
+    def iter_decoded_body(self):
+        # The request body with any Content-Encoding removed, inflated in
+        # bounded steps
+        encoding = self.headers.get('Content-Encoding', 'identity').strip().lower()
+        if encoding == 'identity':
+            yield from self.iter_body()
+            return
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+        encoded = self.server.chat_server.encoded_bytes.labels('upload')
+        for chunk in self.iter_body():
+            encoded.inc(len(chunk))
+            while chunk:
+                data = decompressor.decompress(chunk, CHUNK_SIZE)
+                if data:
+                    yield data
+                chunk = decompressor.unconsumed_tail
+        if not decompressor.eof:
+            raise zlib.error("Compressed body is truncated")
+
+    def iter_body(self):
+        # Yields the request body in CHUNK_SIZE pieces so uploads never have
+        # to fit in memory. Supports both Content-Length and chunked bodies.
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size_line = self.rfile.readline(65537)
+                if not size_line:
+                    raise ConnectionError("Upload interrupted")
+                remaining = int(size_line.split(b';')[0].strip(), 16)
+                if remaining == 0:
+                    # Skip any trailer headers
+                    while self.rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+                    if not chunk:
+                        raise ConnectionError("Upload interrupted")
+                    remaining -= len(chunk)
+                    yield chunk
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers['Content-Length'])
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    raise ConnectionError("Upload interrupted")
+                remaining -= len(chunk)
+                yield chunk
+
+    def declared_size(self):
+        # Size of the file being shared as announced by the client: the
+        # whole file for parallel and newer uploads, else the body length.
+        # None for chunked bodies without X-Upload-Size.
+        for header in ('X-Upload-Size', 'Content-Length'):
+            try:
+                return int(self.headers[header])
+            except (KeyError, TypeError, ValueError):
+                pass
+        return None
+
+    def check_quota(self, username, size, digest=None, close=False, incoming=False):
+        # Sends 413 or 507 and returns False if username may not share
+        # size more bytes. incoming: the body is still to be received, so
+        # it must also fit on the disk.
+        storage = self.server.chat_server.storage
+        reserved = self.server.reserved_upload_bytes() if incoming else None
+        refusal = storage.check_upload(username, size, digest, reserved) if storage else None
+        if refusal is None:
+            return True
+        status, message = refusal
+        self.send_text(status, message.encode(), close=close)
+        return False
+
+    def save_upload(self, folder):
+        # Stream the body into a temporary file, hashing it on the way, so
+        # readers never see a half-written upload. Returns the temporary
+        # path, the SHA-256 hex digest and the size.
+        fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.upload-')
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in self.iter_decoded_body():
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return temp_path, digest.hexdigest(), size
 
     def do_POST(self):
         try:
-            content_length = int(self.headers['Content-Length'])
-            file_data = self.rfile.read(content_length)
-            
             filename = self.headers.get('X-Filename')
             username = self.headers.get('X-Username')
             recipient = self.headers.get('X-Recipient', 'all')  # 'all' for public files
+            channel = self.headers.get('X-Channel')
             
             if not filename or not username:
-                self.send_response(400)
-                self.end_headers()
-                self.wfile.write(b'Missing filename or username')
+                # The body is left unread, so the connection can't be reused
+                self.send_text(400, b'Missing filename or username', close=True)
+                return
+            if not is_shared_file(filename) and filename not in RESERVED_NAMES:
+                # Names are plain file names; "../x" or "/etc/x" could
+                # escape the folder of whoever downloads it. Reserved names
+                # are shared under another name.
+                self.send_text(400, b'Invalid filename', close=True)
                 return
 
-            # Save the file
-            file_path = os.path.join('server_files', filename)
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
-            
-            # Save metadata
-            meta_path = f"{file_path}.meta"
-            metadata = {
-                'sender': username,
-                'recipient': recipient,
-                'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            }
-            with open(meta_path, 'w') as f:
-                json.dump(metadata, f)
+            chat_server = self.server.chat_server
+            if channel is not None:
+                # Announce a public upload in one channel only; checked before
+                # the body is read
+                channel = normalize_channel(channel)
+                if channel is None or recipient != 'all':
+                    self.send_text(400, b'Invalid channel', close=True)
+                    return
+                if not chat_server.is_member(username, channel):
+                    self.send_text(403, b'Not a member of this channel', close=True)
+                    return
+
+            encoding = self.headers.get('Content-Encoding', 'identity').strip().lower()
+            if encoding not in UPLOAD_ENCODINGS:
+                self.send_text(415, b'Unsupported Content-Encoding', close=True)
+                return
+
+            store = chat_server.metadata
+            content_hash = self.headers.get('X-Content-Hash', '').lower() or None
+            if content_hash and not is_valid_hash(content_hash):
+                self.send_text(400, b'Invalid content hash', close=True)
+                return
+
+            upload_id = self.headers.get('X-Upload-Id')
+            if upload_id is not None and not UPLOAD_ID.fullmatch(upload_id):
+                self.send_text(400, b'Invalid upload id', close=True)
+                return
+
+            if upload_id is not None and not self.headers.get('X-Upload-Complete'):
+                # One part of a parallel upload; the file is shared once the
+                # client completes the upload
+                self.receive_part(upload_id, filename, username, store.blob_folder)
+                return
+            if upload_id is not None:
+                # Every part is in: share the assembled file
+                record = self.complete_upload(upload_id, username, recipient, content_hash)
+                if record is None:
+                    return
+            elif self.headers.get('X-Link-Only'):
+                # Hash-first upload: share content the server already holds
+                # without the client sending it again. An upload over quota
+                # is refused here, so the client doesn't send it at all.
+                known = bool(content_hash) and store.has_blob(content_hash)
+                size = os.path.getsize(store.blob_path(content_hash)) if known else self.declared_size()
+                if size is not None and not self.check_quota(username, size, content_hash):
+                    return
+                if not known:
+                    self.send_text(404, b'Unknown content hash')
+                    return
+                record = store.add(filename, username, recipient, content_hash, size)
+            else:
+                # Refuse before reading the body if the announced size is
+                # over quota, and check the real size once it is stored
+                declared = self.declared_size()
+                if declared is not None and not self.check_quota(username, declared, content_hash, close=True,
+                                                                 incoming=True):
+                    return
+                with self.server.transfer_slot() as acquired:
+                    if not acquired:
+                        self.send_busy(close=True)
+                        return
+                    started = time.perf_counter()
+                    temp_path, digest, size = self.save_upload(store.blob_folder)
+                    self.record_transfer('upload', size, time.perf_counter() - started)
+                if content_hash and content_hash != digest:
+                    os.remove(temp_path)
+                    self.send_text(400, b'Content hash mismatch')
+                    return
+                if not self.check_quota(username, size, digest):
+                    os.remove(temp_path)
+                    return
+                record = store.add(filename, username, recipient, digest, size, temp_path)
+            filename = record['name']
 
             # Notify appropriate users about the upload
             timestamp = datetime.now().strftime("%H:%M:%S")
             if recipient == 'all':
                 notification = f"\n[{timestamp}] SERVER: {username} uploaded file '{filename}' (click here to download {filename})"
-                self.server.chat_server.broadcast(notification)
+                if channel and channel != DEFAULT_CHANNEL:
+                    self.server.chat_server.send_to_channel(channel, notification)
+                else:
+                    self.server.chat_server.broadcast(notification)
             else:
                 notification = f"\n[{timestamp}] SERVER: {username} sent you a private file '{filename}' (click here to download {filename})"
-                self.server.chat_server.send_private_message(recipient, notification)
                 sender_notification = f"\n[{timestamp}] SERVER: File '{filename}' sent privately to {recipient}"
+                if not self.server.chat_server.send_private_message(recipient, notification):
+                    # Offline: they are told when they next connect
+                    if self.server.chat_server.store_offline(recipient, notification) == STORED:
+                        sender_notification += " (offline, they will be notified when they return)"
+                    else:
+                        sender_notification += " (offline, they could not be notified)"
                 self.server.chat_server.send_private_message(username, sender_notification)
             
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b'File uploaded successfully')
+            self.send_text(200, b'File uploaded successfully')
             
+        except ConnectionError as e:
+            print(f"Error handling file upload: {e}")
+        except zlib.error:
+            self.send_text(400, b'Invalid compressed body', close=True)
         except Exception as e:
             print(f"Error handling file upload: {e}")
-            self.send_response(500)
-            self.end_headers()
-            self.wfile.write(f'Error uploading file: {str(e)}'.encode())
+            self.send_text(500, f'Error uploading file: {str(e)}'.encode(), close=True)
+
+    def receive_part(self, upload_id, filename, username, folder):
+        try:
+            total = int(self.headers['X-Upload-Size'])
+            offset = int(self.headers['X-Part-Offset'])
+        except (KeyError, TypeError, ValueError):
+            self.send_text(400, b'Missing part headers', close=True)
+            return
+        part_hash = self.headers.get('X-Part-Hash', '').lower()
+        if not is_valid_hash(part_hash) or not 0 <= offset < total:
+            self.send_text(400, b'Invalid part', close=True)
+            return
+        # The first part creates the upload, checked against the quotas
+        # and the free disk space
+        upload, refusal = self.server.open_upload(upload_id, username, filename, total, folder)
+        if upload is None:
+            status, message = refusal
+            self.send_text(status, message.encode(), close=True)
+            return
+
+        with self.server.transfer_slot() as acquired:
+            if not acquired:
+                self.send_busy(close=True)
+                return
+            started = time.perf_counter()
+            try:
+                digest, size = upload.write_part(offset, self.iter_decoded_body())
+            except ValueError:
+                self.send_text(400, b'Part extends past the end of the file', close=True)
+                return
+            self.record_transfer('upload', size, time.perf_counter() - started)
+        if digest != part_hash:
+            self.send_text(400, b'Part hash mismatch')
+            return
+        upload.add_part(offset, size)
+        self.send_text(200, b'Part received')
+
+    def complete_upload(self, upload_id, username, recipient, content_hash):
+        # Returns the new record, or None after sending an error response
+        upload = self.server.get_upload(upload_id, username)
+        if upload is None:
+            self.send_text(404, b'Unknown upload')
+            return None
+        if not upload.is_complete():
+            self.send_text(400, b'Upload incomplete')
+            return None
+        self.server.discard_upload(upload_id)
+        # The whole file is hashed again: it is stored under its content hash
+        digest = upload.digest()
+        if content_hash and content_hash != digest:
+            os.remove(upload.path)
+            self.send_text(400, b'Content hash mismatch')
+            return None
+        if not self.check_quota(username, upload.size, digest):
+            os.remove(upload.path)
+            return None
+        return self.server.chat_server.metadata.add(upload.filename, username, recipient, digest,
+                                                    upload.size, upload.path)
+
+    def log_request(self, code='-', size='-'):
+        # Counted instead of logged
+        try:
+            status = int(code)
+        except (TypeError, ValueError):
+            return
+        self.server.chat_server.http_responses.labels(self.command, status).inc()
 
     def log_message(self, format, *args):
         pass
 
+class FileTransferServer(HTTPServer):
+    # HTTPServer that hands each connection to a bounded thread pool, so one
+    # large transfer no longer blocks every other user. Connections are kept
+    # alive between requests, and a semaphore caps how many file bodies are
+    # streamed at once; requests that can't get a slot in time receive 503.
+    def __init__(self, server_address, handler_class, max_workers=32, max_transfers=16,
+                 slot_timeout=10):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='http')
+        self.transfer_slots = threading.BoundedSemaphore(max_transfers)
+        self.slot_timeout = slot_timeout
+        self.lock = threading.Lock()
+        self.uploads = {}  # {upload id: PartialUpload}
+        self.part_hash_cache = OrderedDict()  # {(path, etag): [part hash, ...]}
+        self.connections = set()  # every open connection, busy or idle
+        self.idle = {}  # {connection: (client address, idle since)}, oldest first
+        self.closed = False
+        self.selector = selectors.DefaultSelector()
+        # Wakes the selector when a connection is parked
+        self.waker, self.wake_sender = socket.socketpair()
+        self.waker.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ)
+        idle_thread = threading.Thread(target=self.idle_loop)
+        idle_thread.daemon = True
+        idle_thread.start()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.add(request)
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def finish_request(self, request, client_address):
+        # True if the connection stays open for another request
+        return self.RequestHandlerClass(request, client_address, self).keep_alive
+
+    def process_request_thread(self, request, client_address):
+        keep_alive = False
+        try:
+            keep_alive = self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if keep_alive:
+                self.park(request, client_address)
+            else:
+                self.shutdown_request(request)
+
+    def shutdown_request(self, request):
+        with self.lock:
+            self.connections.discard(request)
+        super().shutdown_request(request)
+
+    def park(self, request, client_address):
+        evicted = None
+        with self.lock:
+            if self.closed:
+                evicted = request
+            else:
+                self.idle[request] = (client_address, time.monotonic())
+                self.selector.register(request, selectors.EVENT_READ)
+                if len(self.idle) > MAX_IDLE_CONNECTIONS:
+                    evicted = next(iter(self.idle))
+                    self.unpark(evicted)
+        if evicted is not None:
+            self.shutdown_request(evicted)
+        try:
+            self.wake_sender.send(b'\0')
+        except OSError:
+            pass
+
+    def unpark(self, request):
+        # Caller holds self.lock. Returns the client address.
+        address, _ = self.idle.pop(request)
+        self.selector.unregister(request)
+        return address
+
+    def idle_loop(self):
+        # Hands idle connections back to the pool when their next request
+        # arrives, and closes the ones that stay quiet too long
+        while True:
+            try:
+                events = self.selector.select(timeout=1)
+            except (OSError, ValueError):
+                return  # closed
+            ready, expired = [], []
+            now = time.monotonic()
+            with self.lock:
+                for key, _ in events:
+                    if key.fileobj in self.idle:
+                        ready.append((key.fileobj, self.unpark(key.fileobj)))
+                for request, (_, since) in list(self.idle.items()):
+                    if now - since > KEEPALIVE_TIMEOUT:
+                        self.unpark(request)
+                        expired.append(request)
+            try:
+                while self.waker.recv(4096):
+                    pass
+            except OSError:
+                pass
+            for request, client_address in ready:
+                try:
+                    self.executor.submit(self.process_request_thread, request, client_address)
+                except RuntimeError:
+                    # Shutting down
+                    self.shutdown_request(request)
+            for request in expired:
+                self.shutdown_request(request)
+            self.expire_uploads(now)
+
+    @contextmanager
+    def transfer_slot(self, needed=True):
+        # Yields False if no slot came free in time
+        acquired = needed and self.transfer_slots.acquire(timeout=self.slot_timeout)
+        try:
+            yield acquired or not needed
+        finally:
+            if acquired:
+                self.transfer_slots.release()
+
+    def part_hashes(self, file_path, etag):
+        key = (file_path, etag)
+        with self.lock:
+            hashes = self.part_hash_cache.get(key)
+            if hashes is not None:
+                self.part_hash_cache.move_to_end(key)
+                return hashes
+        hashes = []
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(protocol.TRANSFER_PART_SIZE), b''):
+                hashes.append(hashlib.sha256(block).hexdigest())
+        with self.lock:
+            self.part_hash_cache[key] = hashes
+            while len(self.part_hash_cache) > PART_HASH_CACHE_SIZE:
+                self.part_hash_cache.popitem(last=False)
+        return hashes
+
+    def open_upload(self, upload_id, username, filename, size, folder):
+        # Returns (upload, None) for the upload with this id, created by the
+        # first part to arrive, or (None, (HTTP status, message)) if the id
+        # belongs to another user or file or the upload is refused
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None:
+                if sum(1 for other in self.uploads.values() if other.username == username) >= MAX_OPEN_UPLOADS:
+                    return None, (429, "Too many uploads in progress")
+                storage = self.chat_server.storage
+                if storage:
+                    reserved = sum(other.size for other in self.uploads.values())
+                    refusal = storage.check_upload(username, size, reserved=reserved)
+                    if refusal is not None:
+                        return None, refusal
+                upload = self.uploads[upload_id] = PartialUpload(folder, username, filename, size)
+            elif (upload.username, upload.filename, upload.size) != (username, filename, size):
+                return None, (409, "Upload id in use")
+            upload.updated = time.monotonic()
+            return upload, None
+
+    def reserved_upload_bytes(self):
+        # Disk space promised to unfinished parallel uploads
+        with self.lock:
+            return sum(upload.size for upload in self.uploads.values())
+
+    def expire_uploads(self, now):
+        # Called by the idle loop about once a second
+        with self.lock:
+            stale = [upload_id for upload_id, upload in self.uploads.items()
+                     if now - upload.updated > UPLOAD_EXPIRY]
+            stale = [self.uploads.pop(upload_id) for upload_id in stale]
+        for upload in stale:
+            try:
+                upload.remove()
+            except OSError:
+                pass
+
+    def get_upload(self, upload_id, username):
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+        if upload is None or upload.username != username:
+            return None
+        return upload
+
+    def discard_upload(self, upload_id):
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+
+    def server_close(self):
+        super().server_close()
+        with self.lock:
+            self.closed = True
+            idle = list(self.idle)
+            self.idle.clear()
+            busy = [request for request in self.connections if request not in idle]
+        self.selector.close()
+        for request in idle:
+            self.shutdown_request(request)
+        # Unblocks workers waiting on a client, so the pool's threads (which
+        # the interpreter waits for at exit) finish promptly
+        for request in busy:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.waker.close()
+        self.wake_sender.close()
+
+class PartialUpload:
+    # A parallel upload in progress: parts are written in place into a
+    # temporary file, in whatever order they arrive. The file is only
+    # extended, not allocated, so space is used as parts come in.
+    def __init__(self, folder, username, filename, size):
+        self.username = username
+        self.filename = filename
+        self.size = size
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.parts = {}  # {offset: length} of the parts received so far
+        fd, self.path = tempfile.mkstemp(dir=folder, prefix='.upload-')
+        with os.fdopen(fd, 'wb') as f:
+            f.truncate(size)
+
+    def write_part(self, offset, chunks):
+        # Returns the part's SHA-256 hex digest and length. Raises
+        # ValueError if it runs past the end of the file.
+        digest = hashlib.sha256()
+        written = 0
+        with open(self.path, 'r+b') as f:
+            f.seek(offset)
+            for chunk in chunks:
+                written += len(chunk)
+                if offset + written > self.size:
+                    raise ValueError("Part extends past the end of the file")
+                f.write(chunk)
+                digest.update(chunk)
+        return digest.hexdigest(), written
+
+    def add_part(self, offset, length):
+        with self.lock:
+            self.parts[offset] = length
+
+    def is_complete(self):
+        # True once the received parts cover the whole file
+        with self.lock:
+            parts = sorted(self.parts.items())
+        covered = 0
+        for offset, length in parts:
+            if offset > covered:
+                return False
+            covered = max(covered, offset + length)
+        return covered >= self.size
+
+    def digest(self):
+        digest = hashlib.sha256()
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
 class ChatServer:
-    def __init__(self, chat_host='0.0.0.0', chat_port=5555, http_port=8000):
+    def __init__(self, chat_host='0.0.0.0', chat_port=5555, http_port=8000,
+                 queue_size=1024, slow_consumer_policy=DROP_OLDEST,
+                 http_workers=32, max_transfers=16, history_size=1000, max_replay=1000,
+                 enable_metrics=True, serve_http=True, reuse_port=False, history_folder='history',
+                 compression=True, presence_interval=300, heartbeat_interval=30, idle_timeout=90,
+                 resume_grace=60, tcp_keepalive=60, discovery_name=None, workers=1, enable_search=True,
+                 mailbox_folder='history', mailbox_size=MAILBOX_SIZE, mailbox_expiry=MAILBOX_EXPIRY,
+                 file_index_folder='history',
+                 user_quota=0, storage_quota=0, file_ttl=0, evict_lru=False,
+                 max_upload_size=MAX_UPLOAD_SIZE):
         self.chat_host = chat_host
         self.chat_port = chat_port
         self.http_port = http_port
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.compression = compression
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients = {}  # {client_socket: username}
-        self.username_to_socket = {}  # {username: client_socket}
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Several worker processes accept on the same port; the kernel
+            # spreads new connections between them
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.clients = {}  # {client_connection: username}
+        self.username_to_socket = {}  # {username: client_connection}
+        self.channels = {}  # {channel name: set of client connections}, DEFAULT_CHANNEL excluded
+        self.lock = threading.RLock()
+        self.away = set()  # usernames marked away, on any worker
+        self.presence_seq = 0
+        self.presence_interval = presence_interval  # seconds between full snapshots, 0 = never
+        # Held while presence updates are numbered and queued, so every
+        # client receives them in sequence order. Taken before self.lock.
+        self.presence_lock = threading.RLock()
+        # Clients that support heartbeats are pinged after heartbeat_interval
+        # seconds of silence and dropped after idle_timeout. A dropped
+        # session can be resumed for resume_grace seconds (0 disables both).
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.resume_grace = resume_grace
+        self.tcp_keepalive = tcp_keepalive
+        # Name announced to clients scanning the LAN, None to stay hidden
+        self.discovery_name = discovery_name
+        self.workers = workers
+        self.history = MessageLog(history_folder, memory_size=history_size)
+        # Full-text index next to the history log; needs SQLite with FTS5.
+        # File names are indexed in file_index_folder, shared by every worker.
+        self.search_index = None
+        if enable_search:
+            try:
+                self.search_index = SearchIndex(history_folder, file_index_folder)
+            except sqlite3.Error as e:
+                print(f"Search disabled: {e}")
+        self.started_at = time.time()
+        # Private messages for offline users; shared by every worker
+        self.mailboxes = None
+        if mailbox_size > 0:
+            self.mailboxes = MailboxStore(mailbox_folder, max_messages=mailbox_size, expiry=mailbox_expiry)
+        self.max_replay = max_replay
         self.upload_folder = 'server_files'
+        self.bus = None  # BusClient when running as one of several workers
+        self.metadata = None
+        self.http_server = None
         
-        if not os.path.exists(self.upload_folder):
-            os.makedirs(self.upload_folder)
+        if serve_http:
+            if not os.path.exists(self.upload_folder):
+                os.makedirs(self.upload_folder)
+            self.metadata = MetadataStore(self.upload_folder, self.search_index)
+
+            self.http_server = FileTransferServer((chat_host, http_port), FileTransferHandler,
+                                                  max_workers=http_workers, max_transfers=max_transfers)
+            self.http_server.chat_server = self
+
+        self.metrics = Metrics() if enable_metrics else NullMetrics()
+        self.setup_metrics()
 
-        self.http_server = HTTPServer((chat_host, http_port), FileTransferHandler)
-        self.http_server.chat_server = self
+        # Quotas and max_upload_size in bytes and file_ttl in seconds,
+        # 0 = unlimited
+        self.storage = None
+        if self.metadata:
+            self.storage = StorageManager(self.metadata, user_quota=user_quota, storage_quota=storage_quota,
+                                          ttl=file_ttl, evict_lru=evict_lru, removed_counter=self.files_removed,
+                                          max_upload_size=max_upload_size)
+
+    def setup_metrics(self):
+        # Gauges are computed when /metrics is scraped; everything else is
+        # updated where it happens
+        registry = self.metrics
+        registry.gauge('chat_connected_clients', "Chat clients currently connected",
+                       lambda: len(self.clients))
+        registry.gauge('chat_channels', "Channels with at least one member besides the default",
+                       lambda: len(self.channels))
+        registry.gauge('chat_outbound_queue_messages', "Messages waiting in all outbound queues",
+                       lambda: sum(len(client.queue.items) for client in list(self.clients)))
+        registry.gauge('chat_outbound_queue_max_messages', "Messages waiting in the longest outbound queue",
+                       lambda: max((len(client.queue.items) for client in list(self.clients)), default=0))
+        registry.gauge('chat_outbound_queue_bytes', "Bytes waiting in all outbound queues",
+                       lambda: sum(client.queue.pending_bytes for client in list(self.clients)))
+        received = registry.counter('chat_messages_received', "Messages received from clients", ['kind'])
+        self.public_received = received.labels('public')
+        self.private_received = received.labels('private')
+        self.channel_received = received.labels('channel')
+        self.messages_sent = registry.counter('chat_messages_sent', "Messages queued for delivery to clients")
+        self.messages_dropped = registry.counter('chat_messages_dropped',
+                                                 "Queued messages dropped by the slow-consumer policy")
+        self.bytes_sent = registry.counter('chat_bytes_sent', "Bytes written to chat connections")
+        registry.gauge('chat_parked_sessions', "Disconnected sessions waiting to be resumed",
+                       lambda: sum(1 for client in list(self.clients) if client.detached_at is not None))
+        self.clients_reaped = registry.counter('chat_clients_reaped',
+                                               "Connections dropped for not answering heartbeats")
+        self.broadcast_seconds = registry.histogram('chat_broadcast_seconds',
+                                                    "Time taken to queue a broadcast for every recipient")
+        self.http_responses = registry.counter('http_responses', "HTTP responses by method and status",
+                                               ['method', 'status'])
+        self.transfer_bytes = registry.counter('http_transfer_bytes', "File bytes uploaded and downloaded",
+                                               ['direction'])
+        self.encoded_bytes = registry.counter('http_encoded_bytes',
+                                              "Bytes on the wire for gzip/deflate-encoded transfers",
+                                              ['direction'])
+        self.search_seconds = registry.histogram('chat_search_seconds', "Time to answer a search")
+        registry.gauge('storage_bytes', "Bytes of shared files on disk, shared content counted once",
+                       lambda: self.metadata.stored_bytes if self.metadata else 0)
+        self.files_removed = registry.counter('storage_files_removed',
+                                              "Files deleted by the storage sweeper", ['reason'])
+        self.transfer_throughput = registry.histogram('http_transfer_bytes_per_second',
+                                                      "Throughput of individual file transfers",
+                                                      ['direction'], THROUGHPUT_BUCKETS)
 
     def start_http_server(self):
+        if self.http_server is None:
+            return
         print(f"HTTP server started on port {self.http_port}")
         self.http_server.serve_forever()
 
-    def broadcast(self, message, exclude_client=None):
-        for client in self.clients:
+    def attach_bus(self, path):
+        self.bus = BusClient(path, self.handle_bus_message)
+
+    def handle_bus_message(self, message):
+        # Deliver a relay from another worker to this worker's clients only
+        op = message['op']
+        if op == 'broadcast':
+            self.broadcast(message['message'], relay=False)
+        elif op == 'channel':
+            self.send_to_channel(message['channel'], message['message'], relay=False)
+        elif op == 'private':
+            if self.send_private_message(message['to'], message['message'], relay=False) and 'text' in message:
+                # A private message from a user on another worker
+                self.index_private(message['sender'], message['to'], message['text'])
+        elif op == 'user_joined':
+            self.publish_presence(PRESENCE_JOIN, message['name'], relay=False)
+        elif op == 'user_left':
+            self.publish_presence(PRESENCE_LEAVE, message['name'], relay=False)
+        elif op == 'presence':
+            self.publish_presence(message['status'], message['name'], relay=False)
+
+    def make_queue(self):
+        return OutboundQueue(self.queue_size, self.slow_consumer_policy,
+                             dropped_counter=self.messages_dropped)
+
+    def broadcast(self, message, exclude_client=None, relay=True):
+        # Snapshot the recipients so remove_client can run mid-broadcast.
+        # Logging under the lock keeps history replay and live delivery from
+        # overlapping for a client that is joining right now.
+        started = time.perf_counter()
+        with self.lock:
+            self.history.append(message)
+            clients = list(self.clients)
+        if self.search_index:
+            self.search_index.add_public(message, DEFAULT_CHANNEL)
+        if relay and self.bus:
+            self.bus.publish('broadcast', message=message)
+        self.fan_out(clients, message, exclude_client, started)
+
+    def send_to_channel(self, channel, message, exclude_client=None, relay=True):
+        # Only the channel's members are visited; DEFAULT_CHANNEL means everyone
+        if channel == DEFAULT_CHANNEL:
+            self.broadcast(message, exclude_client, relay)
+            return
+        started = time.perf_counter()
+        with self.lock:
+            clients = list(self.channels.get(channel, ()))
+        if self.search_index:
+            self.search_index.add_public(message, channel)
+        if relay and self.bus:
+            self.bus.publish('channel', channel=channel, message=message)
+        self.fan_out(clients, f"CHANNEL|{channel}|{message}", exclude_client, started)
+
+    def fan_out(self, clients, message, exclude_client, started):
+        # Encodes the message once per protocol version rather than per client
+        payloads = {}
+        sent = 0
+        for client in clients:
             if client != exclude_client:
+                payload = payloads.get(client.version)
+                if payload is None:
+                    payload = payloads[client.version] = protocol.encode_message(message, client.version)
                 try:
-                    client.send(message.encode())
+                    client.send_payload(payload)
+                    sent += 1
                 except:
                     self.remove_client(client)
+        self.messages_sent.inc(sent)
+        self.broadcast_seconds.observe(time.perf_counter() - started)
 
-    def send_private_message(self, recipient_username, message):
-        if recipient_username in self.username_to_socket:
+    def send_private_message(self, recipient_username, message, relay=True, pm=None):
+        # pm: (sender, text) of a user's private message, passed on with a
+        # relay so the recipient's worker can index it
+        client = self.username_to_socket.get(recipient_username)
+        if client is not None:
             try:
-                self.username_to_socket[recipient_username].send(message.encode())
+                client.send(message)
+                self.messages_sent.inc()
                 return True
             except:
+                self.remove_client(client)
                 return False
+        if relay and self.bus and self.bus.is_online(recipient_username):
+            # Connected to another worker
+            fields = {'sender': pm[0], 'text': pm[1]} if pm else {}
+            self.bus.publish('private', to=recipient_username, message=message, **fields)
+            return True
         return False
 
-    def handle_client(self, client_socket, address):
+    def store_offline(self, recipient, message):
+        # Keeps a private message for an offline user. Returns STORED,
+        # UNKNOWN (never connected, or mailboxes are off) or FULL.
+        if self.mailboxes is None:
+            return UNKNOWN
+        return self.mailboxes.deposit(recipient, message)
+
+    def deliver_mailbox(self, client, username):
+        # Everything left while the user was offline goes out in one write
+        if self.mailboxes is None:
+            return
+        waiting = self.mailboxes.take(username)
+        if not waiting:
+            return
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        count = len(waiting)
+        header = f"\n[{timestamp}] SERVER: {count} message{'s' if count != 1 else ''} arrived while you were offline:"
         try:
-            username = client_socket.recv(1024).decode()
-            
+            client.send_payload(b''.join(protocol.encode_message(message, client.version)
+                                         for message in [header] + [message for _, message in waiting]))
+        except ConnectionError:
+            # Still in the mailbox for the next login
+            return
+        self.mailboxes.discard(username, waiting[-1][0])
+        self.messages_sent.inc(count + 1)
+
+    def send_offline_pm(self, client, username, recipient, content, pm_message, timestamp):
+        stored = self.store_offline(recipient, pm_message)
+        if stored == STORED:
+            self.index_private(username, recipient, content)
+            client.send(f"[{timestamp}] [PM to {recipient} (offline, delivered when they return)]: {content}")
+        elif stored == FULL:
+            client.send(f"Error: {recipient} is offline and their mailbox is full.")
+        else:
+            client.send(f"Error: User '{recipient}' not found or offline.")
+
+    def index_private(self, sender, recipient, text):
+        if self.search_index:
+            self.search_index.add_private(sender, recipient, text)
+
+    def online_users(self):
+        # Caller holds self.lock
+        if self.bus:
+            return self.bus.names()
+        return list(self.username_to_socket)
+
+    def presence_snapshot(self):
+        # Caller holds self.lock
+        users = sorted(self.online_users())
+        away = sorted(self.away.intersection(users))
+        return f"PRESENCE_SNAPSHOT|{self.presence_seq}|{','.join(users)}|{','.join(away)}"
+
+    def publish_presence(self, op, username, relay=True):
+        # Numbers the change and sends it to every client that asked for
+        # structured presence
+        started = time.perf_counter()
+        with self.presence_lock:
+            with self.lock:
+                if op == PRESENCE_AWAY:
+                    self.away.add(username)
+                else:
+                    self.away.discard(username)
+                self.presence_seq += 1
+                message = f"PRESENCE|{self.presence_seq}|{op}|{username}"
+                clients = [client for client in self.clients if client.presence]
+            self.fan_out(clients, message, None, started)
+        if relay and self.bus and op in (PRESENCE_AWAY, PRESENCE_BACK):
+            # Joins and leaves reach the other workers through the directory
+            self.bus.publish('presence', status=op, name=username)
+
+    def send_presence_snapshot(self, clients=None):
+        # To the given clients, or to every client using structured presence
+        started = time.perf_counter()
+        with self.presence_lock:
+            with self.lock:
+                message = self.presence_snapshot()
+                if clients is None:
+                    clients = [client for client in self.clients if client.presence]
+            self.fan_out(clients, message, None, started)
+
+    def presence_snapshot_loop(self):
+        # Periodic resync, repairing any update a client lost to its
+        # slow-consumer policy
+        while True:
+            time.sleep(self.presence_interval)
+            self.send_presence_snapshot()
+
+    def start_presence_snapshots(self):
+        if self.presence_interval > 0:
+            thread = threading.Thread(target=self.presence_snapshot_loop)
+            thread.daemon = True
+            thread.start()
+
+    def start_search(self):
+        if self.search_index is None:
+            return
+        self.search_index.start()
+        # Public messages logged before this run are indexed in the background
+        thread = threading.Thread(target=self.search_index.catch_up,
+                                  args=(self.history, DEFAULT_CHANNEL, self.started_at))
+        thread.daemon = True
+        thread.start()
+
+    def run_search(self, text, username, channels, page=1, private=True):
+        started = time.perf_counter()
+        results = self.search_index.search(text, username, channels, page, private)
+        self.search_seconds.observe(time.perf_counter() - started)
+        return results
+
+    def search(self, client, username, text):
+        # "/search <words> [page=<n>]"; results go back as one
+        # SEARCH_RESULTS|<json> message
+        if self.search_index is None:
+            client.send("Error: Search is not available on this server.")
+            return
+        page = 1
+        words = []
+        for word in text.split():
+            if word.startswith("page=") and word[5:].isdigit():
+                page = int(word[5:])
+            else:
+                words.append(word)
+        query = " ".join(words)
+        with self.lock:
+            channels = [DEFAULT_CHANNEL] + sorted(client.channels)
+        self.run_blocking(self.answer_search, client, username, query, channels, page)
+
+    def answer_search(self, client, username, query, channels, page):
+        results, more = self.run_search(query, username, channels, page)
+        client.send("SEARCH_RESULTS|" + json.dumps({'query': query, 'page': page, 'more': more, 'results': results}))
+
+    def run_blocking(self, func, *args):
+        # For work that may wait on disk or SQLite locks; the threaded
+        # server runs it on the client's own thread
+        func(*args)
+
+    def start_discovery(self):
+        # With several workers, the one serving HTTP answers for all of them
+        if self.discovery_name and self.http_server:
+            try:
+                Announcer(self.discovery_name, self.discovery_info).start()
+            except OSError as e:
+                print(f"LAN discovery disabled: {e}")
+
+    def discovery_info(self):
+        with self.lock:
+            users = len(self.online_users())
+        return {'port': self.chat_port, 'http_port': self.http_port, 'users': users, 'workers': self.workers}
+
+    def reaper_loop(self):
+        interval = min(REAP_INTERVAL, self.heartbeat_interval) if self.heartbeat_interval > 0 else REAP_INTERVAL
+        while True:
+            time.sleep(interval)
+            self.reap()
+
+    def start_reaper(self):
+        if self.heartbeat_interval > 0 or self.resume_grace > 0:
+            thread = threading.Thread(target=self.reaper_loop)
+            thread.daemon = True
+            thread.start()
+
+    def reap(self):
+        # One pass over every client: ping the quiet ones, cut off the ones
+        # that stopped answering and drop parked sessions nobody resumed
+        now = time.monotonic()
+        with self.lock:
+            clients = list(self.clients)
+        ping, dead, expired = [], [], []
+        for client in clients:
+            if client.detached_at is not None:
+                if now - client.detached_at >= self.resume_grace:
+                    expired.append(client)
+            elif client.heartbeat and self.heartbeat_interval > 0:
+                quiet = now - client.last_seen
+                if quiet >= self.idle_timeout:
+                    dead.append(client)
+                elif quiet >= self.heartbeat_interval and now - client.pinged_at >= self.heartbeat_interval:
+                    ping.append(client)
+
+        payload = protocol.encode_frame("PING")
+        for client in ping:
+            client.pinged_at = now
+            try:
+                client.send_payload(payload)
+            except:
+                dead.append(client)
+
+        if dead:
+            self.clients_reaped.inc(len(dead))
+            gone = []
+            with self.lock:
+                for client in dead:
+                    if client.session_token and self.resume_grace > 0 and client in self.clients:
+                        self.park(client)
+                    else:
+                        gone.append(client)
+            for client in dead:
+                # Ends the connection's reader, which then finds it unregistered
+                client.abort()
+            expired.extend(gone)
+        if expired:
+            self.remove_clients(expired)
+
+    def park(self, client):
+        # Caller holds self.lock. Swaps a lost connection for a socketless
+        # stand-in that keeps its name, channels and everything it is sent
+        # until the session is resumed or expires.
+        username = self.clients.pop(client)
+        parked = ClientConnection(None, client.address, self.make_queue(), self.bytes_sent)
+        parked.set_version(client.version)
+        parked.presence = client.presence
+        parked.heartbeat = client.heartbeat
+        parked.session_token = client.session_token
+        parked.channels = client.channels
+        parked.detached_at = time.monotonic()
+        for channel in parked.channels:
+            members = self.channels.get(channel)
+            if members is not None:
+                members.discard(client)
+                members.add(parked)
+        self.clients[parked] = username
+        self.username_to_socket[username] = parked
+        return parked
+
+    def disconnect(self, client):
+        # Called when a connection ends. A resumable session is parked;
+        # everyone else (and anyone who said /quit) leaves right away.
+        with self.lock:
+            parked = (client in self.clients and client.session_token is not None
+                      and not client.quitting and self.resume_grace > 0)
+            if parked:
+                self.park(client)
+        if parked:
+            client.close()
+        else:
+            self.remove_client(client)
+
+    def resume_session(self, client, username, options):
+        # Hands the session named by "resume=<token>" over to the new
+        # connection, whether it was parked or its old connection has not
+        # been noticed as dead yet. Returns False if there is nothing to
+        # resume; the client then joins as usual.
+        token = options.get('resume')
+        if not token:
+            return False
+        with self.lock:
+            previous = self.username_to_socket.get(username)
+            if (previous is None or previous.session_token is None
+                    or not hmac.compare_digest(previous.session_token, token)):
+                return False
+            del self.clients[previous]
+            self.clients[client] = username
+            self.username_to_socket[username] = client
+            for channel in previous.channels:
+                members = self.channels.get(channel)
+                if members is not None:
+                    members.discard(previous)
+                    members.add(client)
+            client.channels = previous.channels
+            client.session_token = token
+            client.presence = previous.presence
+            self.send_server_info(client, self.online_users(), options)
+            # Then whatever was queued while the client was away
+            missed = previous.queue.take_batch()
+            if missed:
+                client.send_payload(missed)
+            client.send(f"SESSION|{token}|1|{self.resume_grace:g}")
+        previous.abort()
+        return True
+
+    def handshake(self, client, data):
+        version, username, options = protocol.parse_hello(data.decode())
+        client.set_version(version)
+        return username, options
+
+    def handle_pending(self, client, username, data):
+        # Messages the client sent right behind its HELLO
+        if data:
+            for message in client.decoder.feed(data):
+                self.handle_message(client, username, message)
+
+    def load_history(self, client, options):
+        # Reads the public history requested in the handshake with
+        # history=<count> or since=<unix timestamp>. Called before
+        # register_client takes the lock, as it may read the log on disk.
+        # Returns (entries, timestamp they cover up to, count), or None.
+        if client.version < 2:
+            return None
+        try:
+            if 'since' in options:
+                since = float(options['since'])
+                if not math.isfinite(since):
+                    return None
+                entries = self.history.since(since, self.max_replay)
+                return entries, entries[-1][0] if entries else since, self.max_replay
+            if 'history' in options:
+                count = max(min(int(options['history']), self.max_replay), 0)
+                entries = self.history.last(count)
+                if count:
+                    return entries, entries[-1][0] if entries else 0, count
+        except ValueError:
+            pass
+        return None
+
+    def send_history(self, client, history):
+        # Caller holds self.lock, so nothing can be logged meanwhile. Adds
+        # what was logged since load_history() from memory, so the replay
+        # ends where live delivery starts, and sends it as one batched write.
+        if history is None:
+            return
+        entries, until, count = history
+        entries = (entries + self.history.recent_since(until))[-count:]
+        if entries:
+            client.send_payload(protocol.encode_frames(
+                f"HISTORY|{timestamp!r}|{text}" for timestamp, text in entries))
+
+    def send_server_info(self, client, user_list, options):
+        # Caller holds self.lock, so SERVER_INFO is the first thing queued
+        # for the client
+        server_info = f"SERVER_INFO|{self.http_port}|{','.join(user_list)}"
+        compression = None
+        if client.version >= 2:
+            if self.compression:
+                compression = protocol.choose_compression(options)
+            heartbeat = f"{self.heartbeat_interval:g}" if client.heartbeat and self.heartbeat_interval > 0 else ''
+            server_info += f"|{client.version}|{compression or ''}|{heartbeat}"
+        payload = protocol.encode_message(server_info, client.version)
+        if compression:
+            client.enable_compression(len(payload))
+        client.send_payload(payload)
+
+    def register_client(self, client, username, options=None):
+        options = options or {}
+        client.heartbeat = client.version >= 2 and options.get('heartbeat') == '1'
+        if self.resume_grace > 0 and client.version >= 2 and self.resume_session(client, username, options):
+            return True
+
+        all_users = None
+        if self.bus:
+            # The hub decides uniqueness across workers. Asked before taking
+            # the lock, which the bus reader thread needs to deliver relays.
+            all_users = self.bus.claim(username)
+            if all_users is None:
+                client.send("USERNAME_TAKEN")
+                client.close()
+                return False
+
+        history = self.load_history(client, options)
+        with self.lock:
             # Check if username is already taken
             if username in self.username_to_socket:
-                client_socket.send("USERNAME_TAKEN".encode())
-                client_socket.close()
+                client.send("USERNAME_TAKEN")
+                client.close()
+                return False
+
+            self.clients[client] = username
+            self.username_to_socket[username] = client
+            user_list = all_users if all_users is not None else list(self.username_to_socket.keys())
+
+            # Send server info and user list, then any requested history,
+            # before a broadcast can be queued for this client
+            self.send_server_info(client, user_list, options)
+            self.send_history(client, history)
+
+            # Numbered updates start after this snapshot
+            client.presence = client.version >= 2 and options.get('presence') == '1'
+            if client.presence:
+                client.send(self.presence_snapshot())
+
+            if self.resume_grace > 0 and client.version >= 2 and ('session' in options or 'resume' in options):
+                client.session_token = secrets.token_hex(16)
+                client.send(f"SESSION|{client.session_token}|0|{self.resume_grace:g}")
+
+        self.deliver_mailbox(client, username)
+
+        # Announce new user
+        self.publish_presence(PRESENCE_JOIN, username)
+        announcement = f"\n{username} joined the chat!"
+        self.broadcast(announcement, client)
+        return True
+
+    def is_member(self, username, channel):
+        with self.lock:
+            client = self.username_to_socket.get(username)
+            if client is None and self.bus:
+                # Connected to another worker, whose channels aren't known
+                # here; being online is the best check available
+                return self.bus.is_online(username)
+            return client is not None and (channel == DEFAULT_CHANNEL or channel in client.channels)
+
+    def join_channel(self, client, username, name):
+        channel = normalize_channel(name)
+        if channel is None:
+            client.send(f"Error: Invalid channel name '{name}'.")
+            return
+        with self.lock:
+            if channel == DEFAULT_CHANNEL or channel in client.channels:
+                members = self.channel_members(channel)
+                client.send(f"CHANNEL_JOINED|{channel}|{','.join(members)}")
+                return
+            self.channels.setdefault(channel, set()).add(client)
+            client.channels.add(channel)
+            members = self.channel_members(channel)
+            client.send(f"CHANNEL_JOINED|{channel}|{','.join(members)}")
+        self.send_to_channel(channel, f"\n{username} joined #{channel}", client)
+
+    def leave_channel(self, client, username, name):
+        channel = normalize_channel(name)
+        if channel == DEFAULT_CHANNEL:
+            client.send(f"Error: You can't leave #{DEFAULT_CHANNEL}.")
+            return
+        with self.lock:
+            if channel not in client.channels:
+                client.send(f"Error: You are not in #{name.lstrip('#')}.")
+                return
+            self.discard_member(client, channel)
+            client.send(f"CHANNEL_LEFT|{channel}")
+        self.send_to_channel(channel, f"\n{username} left #{channel}")
+
+    def discard_member(self, client, channel):
+        # Caller holds self.lock
+        client.channels.discard(channel)
+        members = self.channels.get(channel)
+        if members is not None:
+            members.discard(client)
+            if not members:
+                del self.channels[channel]
+
+    def channel_members(self, channel):
+        # Caller holds self.lock
+        if channel == DEFAULT_CHANNEL:
+            return sorted(self.clients.values())
+        return sorted(self.clients[client] for client in self.channels.get(channel, ()) if client in self.clients)
+
+    def list_channels(self, client):
+        with self.lock:
+            counts = {DEFAULT_CHANNEL: len(self.clients)}
+            counts.update((channel, len(members)) for channel, members in self.channels.items())
+        client.send("CHANNELS|" + ",".join(f"{channel}:{count}" for channel, count in sorted(counts.items())))
+
+    def say_in_channel(self, client, username, text):
+        # "/say <channel> <text>"
+        parts = text.split(" ", 1)
+        if len(parts) != 2:
+            return
+        channel = normalize_channel(parts[0])
+        if channel is None or (channel != DEFAULT_CHANNEL and channel not in client.channels):
+            client.send(f"Error: You are not in #{parts[0].lstrip('#')}.")
+            return
+        self.channel_received.inc()
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        self.send_to_channel(channel, f"[{timestamp}] {username}: {parts[1]}", client)
+
+    def set_away(self, username, away):
+        with self.lock:
+            changed = away != (username in self.away)
+        if changed:
+            self.publish_presence(PRESENCE_AWAY if away else PRESENCE_BACK, username)
+
+    def handle_message(self, client, username, message):
+        if message.startswith("/say "):
+            self.say_in_channel(client, username, message[5:])
+        elif message.startswith("/join "):
+            self.join_channel(client, username, message[6:])
+        elif message.startswith("/leave "):
+            self.leave_channel(client, username, message[7:])
+        elif message.strip() == "/channels":
+            self.list_channels(client)
+        elif message.strip() in ("/away", "/back"):
+            self.set_away(username, message.strip() == "/away")
+        elif message.strip() == "/presence":
+            self.send_presence_snapshot([client])
+        elif message.startswith("/search "):
+            self.search(client, username, message[8:])
+        elif message.strip() == "/quit":
+            # Leaving on purpose: don't keep the session for a resume
+            client.quitting = True
+        elif client.heartbeat and message == "PING":
+            client.send("PONG")
+        elif client.heartbeat and message == "PONG":
+            pass
+        elif message.startswith("/pm "):
+            # Handle private message
+            self.private_received.inc()
+            parts = message[4:].split(" ", 1)
+            if len(parts) == 2:
+                recipient, content = parts
+                timestamp = datetime.now().strftime("%H:%M:%S")
+                pm_message = f"[{timestamp}] [PM from {username}]: {content}"
+
+                if self.send_private_message(recipient, pm_message, pm=(username, content)):
+                    self.index_private(username, recipient, content)
+                    # Send confirmation to sender
+                    sender_message = f"[{timestamp}] [PM to {recipient}]: {content}"
+                    client.send(sender_message)
+                else:
+                    # Offline: keep it until they connect again
+                    self.run_blocking(self.send_offline_pm, client, username, recipient, content, pm_message, timestamp)
+        else:
+            # Handle public message
+            self.public_received.inc()
+            timestamp = datetime.now().strftime("%H:%M:%S")
+            formatted_msg = f"[{timestamp}] {username}: {message}"
+            self.broadcast(formatted_msg, client)
+
+    def handle_client(self, client_socket, address):
+        client = ClientConnection(client_socket, address, self.make_queue(), self.bytes_sent)
+        if self.tcp_keepalive > 0:
+            enable_keepalive(client_socket, self.tcp_keepalive)
+        try:
+            hello = self.read_hello(client_socket)
+            if hello is None:
+                return
+            data, pending = hello
+            username, options = self.handshake(client, data)
+            if not self.register_client(client, username, options):
                 return
-                
-            self.clients[client_socket] = username
-            self.username_to_socket[username] = client_socket
-            
-            # Send server info and user list
-            user_list = list(self.username_to_socket.keys())
-            server_info = f"SERVER_INFO|{self.http_port}|{','.join(user_list)}"
-            client_socket.send(server_info.encode())
-            
-            # Announce new user
-            announcement = f"\n{username} joined the chat!"
-            self.broadcast(announcement, client_socket)
             print(f"New connection from {address} - Username: {username}")
+            try:
+                self.handle_pending(client, username, pending)
+            except ValueError:
+                return
 
             while True:
                 try:
-                    message = client_socket.recv(1024).decode()
-                    if message:
-                        if message.startswith("/pm "):
-                            # Handle private message
-                            parts = message[4:].split(" ", 1)
-                            if len(parts) == 2:
-                                recipient, content = parts
-                                timestamp = datetime.now().strftime("%H:%M:%S")
-                                pm_message = f"[{timestamp}] [PM from {username}]: {content}"
-                                
-                                if self.send_private_message(recipient, pm_message):
-                                    # Send confirmation to sender
-                                    sender_message = f"[{timestamp}] [PM to {recipient}]: {content}"
-                                    client_socket.send(sender_message.encode())
-                                else:
-                                    client_socket.send(f"Error: User '{recipient}' not found or offline.".encode())
-                        else:
-                            # Handle public message
-                            timestamp = datetime.now().strftime("%H:%M:%S")
-                            formatted_msg = f"[{timestamp}] {username}: {message}"
-                            print(formatted_msg)
-                            self.broadcast(formatted_msg, client_socket)
+                    data = client_socket.recv(65536)
+                    if not data:
+                        break
+                    client.last_seen = time.monotonic()
+                    for message in client.decoder.feed(data):
+                        self.handle_message(client, username, message)
                 except:
                     break
 
         finally:
-            self.remove_client(client_socket)
-
-    def remove_client(self, client_socket):
-        if client_socket in self.clients:
-            username = self.clients[client_socket]
-            del self.clients[client_socket]
-            del self.username_to_socket[username]
-            client_socket.close()
+            self.disconnect(client)
+            client.close()
+
+    def read_hello(self, client_socket):
+        # Returns (handshake, bytes received after it), or None if the
+        # client left or sent no valid handshake
+        buffer = bytearray()
+        try:
+            while True:
+                try:
+                    data = client_socket.recv(protocol.MAX_HELLO_SIZE)
+                except socket.timeout:
+                    # An older client's HELLO without a newline
+                    return bytes(buffer), b''
+                if not data:
+                    return None
+                buffer += data
+                hello = protocol.split_hello(buffer)
+                if hello is not None:
+                    return hello
+                client_socket.settimeout(protocol.HELLO_TIMEOUT)
+        except (OSError, ValueError):
+            return None
+        finally:
+            try:
+                client_socket.settimeout(None)
+            except OSError:
+                pass
+
+    def remove_client(self, client):
+        self.remove_clients([client])
+
+    def remove_clients(self, clients):
+        # Unregisters every client under one lock, then announces them
+        removed = []
+        with self.lock:
+            for client in clients:
+                username = self.clients.pop(client, None)
+                if username is None:
+                    continue
+                del self.username_to_socket[username]
+                for channel in list(client.channels):
+                    self.discard_member(client, channel)
+                removed.append((client, username))
+        for client, username in removed:
+            if self.bus:
+                self.bus.release(username)
+            client.close()
+            self.publish_presence(PRESENCE_LEAVE, username)
             self.broadcast(f"\n{username} left the chat!")
 
+    def start_background_tasks(self):
+        self.start_presence_snapshots()
+        self.start_reaper()
+        self.start_discovery()
+        self.start_search()
+        if self.mailboxes:
+            self.mailboxes.start()
+        if self.storage:
+            self.storage.start()
+
     def start(self):
         http_thread = threading.Thread(target=self.start_http_server)
         http_thread.daemon = True
         http_thread.start()
+        self.start_background_tasks()
 
         self.server_socket.bind((self.chat_host, self.chat_port))
         self.server_socket.listen()
@@ -221,11 +1753,432 @@ class ChatServer:
             thread.daemon = True
             thread.start()
 
-if __name__ == "__main__":
-    server = ChatServer()
+class OutboundQueue:
+    # Bounded queue of encoded payloads waiting to be written to one
+    # connection. Producers never block; when the peer falls behind, the
+    # slow-consumer policy decides whether to drop its oldest messages,
+    # disconnect it, or merge the backlog into a single write.
+    def __init__(self, max_messages=1024, policy=DROP_OLDEST, max_bytes=4 * 1024 * 1024, on_ready=None,
+                 dropped_counter=NULL_INSTRUMENT):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.on_ready = on_ready
+        self.items = deque()
+        self.pending_bytes = 0
+        self.dropped = 0
+        self.dropped_counter = dropped_counter
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def _is_full(self):
+        return len(self.items) >= self.max_messages or self.pending_bytes >= self.max_bytes
+
+    def put(self, payload):
+        # Returns False when the connection should be dropped instead.
+        with self.condition:
+            if self.closed:
+                return False
+            if self._is_full():
+                if self.policy == DROP_OLDEST:
+                    dropped = 0
+                    while self.items and self._is_full():
+                        self.pending_bytes -= len(self.items.popleft())
+                        dropped += 1
+                    self.dropped += dropped
+                    self.dropped_counter.inc(dropped)
+                elif self.policy == COALESCE and len(self.items) > 1 and self.pending_bytes < self.max_bytes:
+                    merged = b''.join(self.items)
+                    self.items.clear()
+                    self.items.append(merged)
+                else:
+                    return False
+            self.items.append(payload)
+            self.pending_bytes += len(payload)
+            self.condition.notify()
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+    def _take(self):
+        batch = b''.join(self.items)
+        self.items.clear()
+        self.pending_bytes = 0
+        return batch
+
+    def get_batch(self):
+        # Blocks until something is queued and returns everything pending as
+        # one buffer, or None once the queue is closed and drained.
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if not self.items:
+                return None
+            return self._take()
+
+    def take_batch(self):
+        # Non-blocking variant: b'' when empty, None when closed and drained.
+        with self.condition:
+            if not self.items:
+                return None if self.closed else b''
+            return self._take()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.on_ready:
+            self.on_ready()
+
+class ClientConnection:
+    # One chat connection. Messages are handed around as text, encoded for
+    # the peer's negotiated protocol version and queued; a dedicated writer
+    # thread drains the queue so senders never block on a slow peer.
+    def __init__(self, sock, address, queue, bytes_sent=NULL_INSTRUMENT):
+        self.sock = sock
+        self.address = address
+        self.queue = queue
+        self.bytes_sent = bytes_sent
+        self.channels = set()  # joined channels besides DEFAULT_CHANNEL
+        self.presence = False  # sent PRESENCE updates instead of relying on join/leave text
+        self.heartbeat = False  # answers PING, so it can be checked for liveness
+        self.session_token = None  # set for clients that can resume their session
+        self.detached_at = None  # when a parked session lost its connection
+        self.quitting = False
+        self.last_seen = time.monotonic()
+        self.pinged_at = 0
+        self.compressor = None
+        self.raw_remaining = 0
+        self.set_version(1)
+        if sock is not None:
+            writer = threading.Thread(target=self.write_loop)
+            writer.daemon = True
+            writer.start()
+
+    def set_version(self, version):
+        self.version = min(version, protocol.PROTOCOL_VERSION)
+        self.decoder = protocol.make_decoder(self.version)
+
+    def enable_compression(self, raw_bytes):
+        # The first raw_bytes of output (the SERVER_INFO frame naming the
+        # method) still go out as is; everything after is compressed, and
+        # so is everything the client sends from now on
+        self.raw_remaining = raw_bytes
+        self.compressor = protocol.Compressor()
+        self.decoder = protocol.DecompressingDecoder(self.decoder)
+
+    def prepare_output(self, batch):
+        # Called by the writer only, so the compression stream stays in order
+        if self.compressor is None:
+            return batch
+        head = b''
+        if self.raw_remaining:
+            head, batch = batch[:self.raw_remaining], batch[self.raw_remaining:]
+            self.raw_remaining -= len(head)
+        return head + self.compressor.compress(batch) if batch else head
+
+    def send(self, message):
+        self.send_payload(protocol.encode_message(message, self.version))
+
+    def send_payload(self, payload):
+        if not self.queue.put(payload):
+            self.abort()
+            raise ConnectionError("Client is not keeping up")
+
+    def write_loop(self):
+        while True:
+            batch = self.queue.get_batch()
+            if batch is None:
+                break
+            try:
+                data = self.prepare_output(batch)
+                self.sock.sendall(data)
+                self.bytes_sent.inc(len(data))
+            except OSError:
+                self.queue.close()
+                break
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def close(self):
+        # Anything already queued is still flushed before the socket closes.
+        self.queue.close()
+
+    def abort(self):
+        self.queue.close()
+        if self.sock is None:
+            # A parked session has no socket
+            return
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class AsyncClientConnection(ClientConnection):
+    # Queue is drained by a task on the event loop instead of a thread.
+    # Producers on other threads (e.g. HTTP upload notifications) wake the
+    # writer through call_soon_threadsafe.
+    def __init__(self, writer, loop, queue, bytes_sent=NULL_INSTRUMENT):
+        super().__init__(None, writer.get_extra_info('peername'), queue, bytes_sent)
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.ready = asyncio.Event()
+        queue.on_ready = self.wake
+        self.writer_task = loop.create_task(self.write_loop())
+
+    def _call(self, func, *args):
+        if threading.get_ident() == self.loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def wake(self):
+        self._call(self.ready.set)
+
+    async def write_loop(self):
+        try:
+            while True:
+                self.ready.clear()
+                batch = self.queue.take_batch()
+                if batch is None:
+                    break
+                if not batch:
+                    await self.ready.wait()
+                    continue
+                data = self.prepare_output(batch)
+                self.writer.write(data)
+                await self.writer.drain()
+                self.bytes_sent.inc(len(data))
+        except ConnectionError:
+            self.queue.close()
+        finally:
+            self.writer.close()
+
+    def abort(self):
+        self.queue.close()
+        self._call(self.writer.transport.abort)
+
+class AsyncChatServer(ChatServer):
+    # Serves every chat connection from a single asyncio event loop instead
+    # of one OS thread per client. The wire protocol is identical.
+    def __init__(self, *args, backlog=1024, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backlog = backlog
+
+    async def handle_connection(self, reader, writer):
+        client = AsyncClientConnection(writer, asyncio.get_running_loop(), self.make_queue(),
+                                       self.bytes_sent)
+        if self.tcp_keepalive > 0:
+            enable_keepalive(writer.get_extra_info('socket'), self.tcp_keepalive)
+        try:
+            hello = await self.read_hello(reader)
+            if hello is None:
+                return
+            data, pending = hello
+            username, options = self.handshake(client, data)
+            # Joining may read history from disk, wait on the mailbox
+            # database or ask the bus hub, so it runs off the loop
+            registered = await asyncio.get_running_loop().run_in_executor(
+                None, self.register_client, client, username, options)
+            if not registered:
+                return
+            print(f"New connection from {client.address} - Username: {username}")
+            self.handle_pending(client, username, pending)
+
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                client.last_seen = time.monotonic()
+                for message in client.decoder.feed(data):
+                    self.handle_message(client, username, message)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.disconnect(client)
+            client.close()
+
+    async def read_hello(self, reader):
+        # Returns (handshake, bytes received after it), or None if the
+        # client left. Raises ValueError for an oversized HELLO.
+        buffer = bytearray()
+        while True:
+            read = reader.read(protocol.MAX_HELLO_SIZE)
+            try:
+                data = await (asyncio.wait_for(read, protocol.HELLO_TIMEOUT) if buffer else read)
+            except asyncio.TimeoutError:
+                # An older client's HELLO without a newline
+                return bytes(buffer), b''
+            if not data:
+                return None
+            buffer += data
+            hello = protocol.split_hello(buffer)
+            if hello is not None:
+                return hello
+
+    def run_blocking(self, func, *args):
+        # Called from the event loop: run func on the loop's default
+        # executor so other clients are not held up
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            func(*args)
+            return
+        loop.run_in_executor(None, func, *args)
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection, sock=self.server_socket)
+        print(f"Chat server (asyncio) started on {self.chat_host}:{self.chat_port}")
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        http_thread = threading.Thread(target=self.start_http_server)
+        http_thread.daemon = True
+        http_thread.start()
+        self.start_background_tasks()
+
+        raise_file_limit()
+        self.server_socket.bind((self.chat_host, self.chat_port))
+        self.server_socket.listen(self.backlog)
+        self.server_socket.setblocking(False)
+        asyncio.run(self.serve())
+
+def raise_file_limit():
+    # Each idle connection holds a file descriptor; lift the soft limit so
+    # the event loop can hold thousands of them.
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+def build_server(args, **kwargs):
+    server_class = AsyncChatServer if args.mode == 'async' else ChatServer
+    return server_class(args.host, args.port, args.http_port,
+                        queue_size=args.queue_size, slow_consumer_policy=args.slow_consumer,
+                        http_workers=args.http_workers, max_transfers=args.max_transfers,
+                        history_size=args.history_size, enable_metrics=not args.no_metrics,
+                        compression=not args.no_compression, presence_interval=args.presence_interval,
+                        heartbeat_interval=args.heartbeat_interval, idle_timeout=args.idle_timeout,
+                        resume_grace=args.resume_grace, tcp_keepalive=args.tcp_keepalive,
+                        discovery_name=None if args.no_discovery else args.name, workers=args.workers,
+                        enable_search=not args.no_search, mailbox_size=args.mailbox_size,
+                        mailbox_expiry=args.mailbox_days * 24 * 3600,
+                        user_quota=int(args.user_quota * 1024 * 1024),
+                        storage_quota=int(args.storage_quota * 1024 * 1024),
+                        file_ttl=args.file_ttl * 24 * 3600, evict_lru=args.evict_lru,
+                        max_upload_size=int(args.max_upload_size * 1024 * 1024), **kwargs)
+
+def run_server(server):
     try:
         server.start()
     except KeyboardInterrupt:
         print("\nShutting down server...")
-        server.http_server.shutdown()
-        server.server_socket.close()
\ No newline at end of file
+        if server.http_server:
+            server.http_server.shutdown()
+    finally:
+        if server.http_server:
+            server.http_server.server_close()
+        server.server_socket.close()
+
+def run_worker(index, args, bus_path):
+    # Every worker accepts chat connections on the shared port and keeps
+    # its own history log; only the first one serves file transfers.
+    server = build_server(args, serve_http=index == 0, reuse_port=True,
+                          history_folder=os.path.join('history', f'worker-{index}'))
+    server.attach_bus(bus_path)
+    run_server(server)
+
+def run_workers(args):
+    # The parent process only hosts the message bus
+    bus_path = os.path.join(tempfile.mkdtemp(prefix='chat-bus-'), 'bus.sock')
+    bus = MessageBus(bus_path)
+    bus_thread = threading.Thread(target=bus.serve_forever)
+    bus_thread.daemon = True
+    bus_thread.start()
+
+    workers = [multiprocessing.Process(target=run_worker, args=(index, args, bus_path), daemon=True)
+               for index in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    # Exiting normally on SIGTERM lets multiprocessing stop the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # The workers got the same SIGINT and shut themselves down
+        for worker in workers:
+            worker.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LAN chat server")
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+                        help="threaded: one thread per client, async: single asyncio event loop")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--http-port', type=int, default=8000)
+    parser.add_argument('--queue-size', type=int, default=1024,
+                        help="Maximum messages queued for a client before the slow-consumer policy applies")
+    parser.add_argument('--slow-consumer', choices=SLOW_CONSUMER_POLICIES, default=DROP_OLDEST,
+                        help="What to do when a client's outbound queue is full")
+    parser.add_argument('--http-workers', type=int, default=32,
+                        help="Threads serving file transfer connections")
+    parser.add_argument('--max-transfers', type=int, default=16,
+                        help="Uploads and downloads allowed to stream at the same time")
+    parser.add_argument('--history-size', type=int, default=1000,
+                        help="Recent public messages kept in memory for replay")
+    parser.add_argument('--no-metrics', action='store_true',
+                        help="Disable the /metrics endpoint and all instrumentation")
+    parser.add_argument('--no-compression', action='store_true',
+                        help="Never compress chat connections or file transfers")
+    parser.add_argument('--presence-interval', type=float, default=300,
+                        help="Seconds between full presence snapshots (0 = only on join and request)")
+    parser.add_argument('--heartbeat-interval', type=float, default=30,
+                        help="Seconds of silence before a client is pinged (0 = no heartbeats)")
+    parser.add_argument('--idle-timeout', type=float, default=90,
+                        help="Seconds of silence before a client that supports heartbeats is dropped")
+    parser.add_argument('--resume-grace', type=float, default=60,
+                        help="Seconds a dropped session can be resumed before its user leaves (0 = never)")
+    parser.add_argument('--tcp-keepalive', type=int, default=60,
+                        help="Seconds of silence before TCP keepalive probes start (0 = off)")
+    parser.add_argument('--name', default=socket.gethostname(),
+                        help="Server name shown to clients that scan the LAN")
+    parser.add_argument('--no-discovery', action='store_true',
+                        help="Don't answer LAN discovery probes")
+    parser.add_argument('--no-search', action='store_true',
+                        help="Don't index messages and files for /search")
+    parser.add_argument('--mailbox-size', type=int, default=MAILBOX_SIZE,
+                        help="Private messages kept per offline user (0 = don't keep any)")
+    parser.add_argument('--mailbox-days', type=float, default=MAILBOX_EXPIRY / (24 * 3600),
+                        help="Days an undelivered private message is kept")
+    parser.add_argument('--user-quota', type=float, default=0,
+                        help="Megabytes of files each user may share (0 = no limit)")
+    parser.add_argument('--storage-quota', type=float, default=0,
+                        help="Megabytes of files the server keeps in total (0 = no limit)")
+    parser.add_argument('--max-upload-size', type=float, default=MAX_UPLOAD_SIZE / (1024 * 1024),
+                        help="Megabytes a single shared file may have (0 = no limit)")
+    parser.add_argument('--file-ttl', type=float, default=0,
+                        help="Days a shared file is kept before it is deleted (0 = forever)")
+    parser.add_argument('--evict-lru', action='store_true',
+                        help="Delete the least recently downloaded files when storage passes 90%% of --storage-quota")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Chat worker processes sharing the port (Linux/BSD, needs SO_REUSEPORT)")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        run_server(build_server(args))
\ No newline at end of file
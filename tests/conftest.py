@@ -0,0 +1,44 @@
+import hashlib
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metadata import MetadataStore  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path):
+    return MetadataStore(str(tmp_path))
+
+
+@pytest.fixture
+def share(store):
+    # Shares content the way the HTTP server does: a temporary file that
+    # becomes the blob unless the content is already stored
+    def share(name, content, sender='alice', recipient='all'):
+        temp_path = os.path.join(store.blob_folder, f'.upload-{name}')
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        digest = hashlib.sha256(content).hexdigest()
+        return store.add(name, sender, recipient, digest, len(content), temp_path)
+    return share
+
+
+@pytest.fixture
+def start_server():
+    # Starts server.py in a scratch directory, as the benchmarks do;
+    # returns the LocalServer (host, port, http_port, workdir)
+    from benchmark import LocalServer
+    servers = []
+
+    def start(*args):
+        server = LocalServer(args)
+        servers.append(server)
+        return server.__enter__()
+    yield start
+    for server in servers:
+        server.__exit__(None, None, None)
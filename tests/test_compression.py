@@ -0,0 +1,104 @@
+import gzip
+import os
+
+import requests
+
+import protocol
+from chat_client import download_file, partial_download_paths, upload_file
+
+TEXT = b'the quick brown fox jumps over the lazy dog\n' * 2000
+
+
+def test_chat_stream_round_trip():
+    compressor = protocol.Compressor()
+    decoder = protocol.DecompressingDecoder()
+    frames = protocol.encode_frame('hello') + protocol.encode_frame('x' * 100000)
+    data = compressor.compress(frames)
+    assert len(data) < len(frames)
+    # Every write is decodable on its own, whatever the read boundaries
+    messages = []
+    for i in range(0, len(data), 7):
+        messages.extend(decoder.feed(data[i:i + 7]))
+    assert messages == ['hello', 'x' * 100000]
+    assert decoder.feed(compressor.compress(protocol.encode_frame('bye'))) == ['bye']
+
+
+def test_choose_compression():
+    assert protocol.choose_compression({'compress': 'brotli,zlib'}) == 'zlib'
+    assert protocol.choose_compression({'compress': 'brotli'}) is None
+    assert protocol.choose_compression({}) is None
+
+
+def share(server, tmp_path, name, content, compress=False):
+    path = tmp_path / name
+    path.write_bytes(content)
+    upload_file(f'http://{server.host}:{server.http_port}', 'alice', str(path), compress=compress, streams=1)
+    return f'http://{server.host}:{server.http_port}/{name}'
+
+
+def test_downloads_are_gzipped_when_accepted(start_server, tmp_path):
+    server = start_server()
+    url = share(server, tmp_path, 'notes.txt', TEXT, compress=True)
+    headers = {'X-Username': 'bob', 'Accept-Encoding': 'gzip'}
+    with requests.get(url, headers=headers, stream=True) as response:
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['ETag'].endswith('-gzip"')
+        body = response.raw.read()
+    assert len(body) < len(TEXT) and gzip.decompress(body) == TEXT
+
+    response = requests.get(url, headers={'X-Username': 'bob', 'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Content-Length'] == str(len(TEXT)) and response.content == TEXT
+
+    # Already compressed types are sent as stored
+    url = share(server, tmp_path, 'notes.zip', TEXT)
+    response = requests.get(url, headers=headers)
+    assert 'Content-Encoding' not in response.headers and response.content == TEXT
+
+
+def test_no_gzip_when_compression_is_off(start_server, tmp_path):
+    server = start_server('--no-compression')
+    url = share(server, tmp_path, 'notes.txt', TEXT)
+    response = requests.get(url, headers={'X-Username': 'bob', 'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers and response.content == TEXT
+
+
+def test_gzip_download_resumes_from_the_stored_bytes(start_server, tmp_path):
+    server = start_server()
+    url = share(server, tmp_path, 'notes.txt', TEXT)
+    gzip_etag = requests.head(url, headers={'X-Username': 'bob', 'Accept-Encoding': 'gzip'}).headers['ETag']
+
+    # A gzip download cut off midway left the decoded bytes and the gzip ETag
+    headers = {'X-Username': 'bob', 'Accept-Encoding': 'identity', 'If-Range': gzip_etag, 'Range': 'bytes=1000-'}
+    response = requests.get(url, headers=headers)
+    assert response.status_code == 206 and 'Content-Encoding' not in response.headers
+    assert response.content == TEXT[1000:]
+
+    folder = tmp_path / 'downloads'
+    folder.mkdir()
+    partial_path, etag_path = partial_download_paths(str(folder), 'notes.txt')
+    with open(partial_path, 'wb') as f:
+        f.write(TEXT[:1000])
+    with open(etag_path, 'w') as f:
+        f.write(gzip_etag)
+    path = download_file(url.rsplit('/', 1)[0], 'bob', 'notes.txt', str(folder), streams=1)
+    assert open(path, 'rb').read() == TEXT
+    assert not os.path.exists(partial_path) and not os.path.exists(etag_path)
+
+
+def test_changed_file_is_sent_whole(start_server, tmp_path):
+    server = start_server()
+    url = share(server, tmp_path, 'notes.txt', TEXT)
+    headers = {'X-Username': 'bob', 'Accept-Encoding': 'identity', 'If-Range': '"stale"', 'Range': 'bytes=1000-'}
+    response = requests.get(url, headers=headers)
+    assert response.status_code == 200 and response.content == TEXT
+
+    folder = tmp_path / 'downloads'
+    folder.mkdir()
+    partial_path, etag_path = partial_download_paths(str(folder), 'notes.txt')
+    with open(partial_path, 'wb') as f:
+        f.write(b'an older version')
+    with open(etag_path, 'w') as f:
+        f.write('"stale"')
+    path = download_file(url.rsplit('/', 1)[0], 'bob', 'notes.txt', str(folder), streams=1)
+    assert open(path, 'rb').read() == TEXT
@@ -0,0 +1,79 @@
+import http.client
+import os
+
+import pytest
+
+from chat_client import upload_file
+from server import parse_byte_range
+
+CONTENT = os.urandom(300 * 1024)
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', (0, 99)),
+    ('bytes=100-', (100, 999)),
+    ('bytes=900-5000', (900, 999)),
+    ('bytes=-100', (900, 999)),
+    ('bytes=-5000', (0, 999)),
+    ('BYTES = 5-5', (5, 5)),
+])
+def test_valid_ranges(header, expected):
+    assert parse_byte_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header', ['items=0-9', 'bytes=0-9,20-29', 'bytes=abc', 'bytes=-', 'bytes=5'])
+def test_ignored_ranges(header):
+    assert parse_byte_range(header, 1000) is None
+
+
+@pytest.mark.parametrize('header', ['bytes=1000-', 'bytes=2000-3000', 'bytes=50-10', 'bytes=-0'])
+def test_unsatisfiable_ranges(header):
+    with pytest.raises(ValueError):
+        parse_byte_range(header, 1000)
+
+
+@pytest.fixture
+def shared_file(start_server, tmp_path):
+    # A live server sharing CONTENT as data.bin; returns an open connection
+    server = start_server()
+    path = tmp_path / 'data.bin'
+    path.write_bytes(CONTENT)
+    upload_file(f'http://{server.host}:{server.http_port}', 'alice', str(path), streams=1)
+    conn = http.client.HTTPConnection(server.host, server.http_port)
+    yield conn
+    conn.close()
+
+
+def request(conn, method, path, **headers):
+    conn.request(method, path, headers={'X-Username': 'bob', 'Accept-Encoding': 'identity', **headers})
+    response = conn.getresponse()
+    return response, response.read()
+
+
+def test_range_requests(shared_file):
+    response, body = request(shared_file, 'GET', '/data.bin', Range='bytes=100-199')
+    assert response.status == 206 and body == CONTENT[100:200]
+    assert response.getheader('Content-Range') == f'bytes 100-199/{len(CONTENT)}'
+
+    response, body = request(shared_file, 'GET', '/data.bin', Range='bytes=-10')
+    assert response.status == 206 and body == CONTENT[-10:]
+
+    response, body = request(shared_file, 'GET', '/data.bin', Range=f'bytes={len(CONTENT)}-')
+    assert response.status == 416 and body == b''
+    assert response.getheader('Content-Range') == f'bytes */{len(CONTENT)}'
+
+    # The connection is still usable after every response
+    response, body = request(shared_file, 'GET', '/data.bin')
+    assert response.status == 200 and body == CONTENT
+    assert response.getheader('Accept-Ranges') == 'bytes'
+
+
+def test_head_sends_no_body(shared_file):
+    response, body = request(shared_file, 'HEAD', '/data.bin')
+    assert response.status == 200 and body == b''
+    assert response.getheader('Content-Length') == str(len(CONTENT))
+    response, body = request(shared_file, 'HEAD', '/missing.bin')
+    assert response.status == 404 and body == b''
+    # A stray body would be read as the start of this response
+    response, body = request(shared_file, 'GET', '/data.bin', Range='bytes=0-9')
+    assert response.status == 206 and body == CONTENT[:10]
@@ -0,0 +1,136 @@
+import itertools
+import os
+import socket
+
+import pytest
+
+import protocol
+from chat_client import PRESENCE, ChatClient
+from history import INDEX_SUFFIX, SEGMENT_SUFFIX, MessageLog
+
+
+def fill(log, count, start=1000.0):
+    entries = []
+    for i in range(count):
+        timestamp = start + i
+        log.append(f'message {i}', timestamp)
+        entries.append((timestamp, f'message {i}'))
+    return entries
+
+
+def as_tuples(entries):
+    return [tuple(entry) for entry in entries]
+
+
+def test_segments_roll_over_with_sparse_indexes(tmp_path):
+    log = MessageLog(str(tmp_path), memory_size=5, segment_bytes=500, index_bytes=100)
+    fill(log, 100)
+    names = os.listdir(tmp_path)
+    segments = [name for name in names if name.endswith(SEGMENT_SUFFIX)]
+    assert len(segments) == len(log.segments) > 1
+    assert len([name for name in names if name.endswith(INDEX_SUFFIX)]) == len(segments)
+    for segment in segments:
+        assert os.path.getsize(tmp_path / segment) <= 500
+    assert all(len(log.indexes[segment]) > 1 for segment in log.segments[:-1])
+
+
+def test_since_matches_a_full_scan(tmp_path):
+    log = MessageLog(str(tmp_path), memory_size=5, segment_bytes=500, index_bytes=100)
+    entries = fill(log, 100)
+    for timestamp in (0, 999.5, 1000, 1010.5, 1050, 1097, 1099, 5000):
+        for count in (0, 1, 3, 10, 1000):
+            expected = [entry for entry in entries if entry[0] > timestamp]
+            expected = expected[-count:] if count else []
+            assert as_tuples(log.since(timestamp, count)) == expected, (timestamp, count)
+
+
+def test_last_reads_past_the_memory_tail(tmp_path):
+    log = MessageLog(str(tmp_path), memory_size=5, segment_bytes=500, index_bytes=100)
+    entries = fill(log, 100)
+    assert as_tuples(log.last(3)) == entries[-3:]
+    assert as_tuples(log.last(40)) == entries[-40:]
+    assert as_tuples(log.last(500)) == entries
+    assert log.last(0) == []
+
+
+def test_recent_since_only_uses_memory(tmp_path):
+    log = MessageLog(str(tmp_path), memory_size=5, segment_bytes=500, index_bytes=100)
+    entries = fill(log, 20)
+    assert as_tuples(log.recent_since(1017)) == entries[-2:]
+    assert as_tuples(log.recent_since(0)) == entries[-5:]
+
+
+def test_reopened_log_keeps_everything(tmp_path):
+    log = MessageLog(str(tmp_path), memory_size=5, segment_bytes=500, index_bytes=100)
+    entries = fill(log, 60)
+    log.close()
+    log = MessageLog(str(tmp_path), memory_size=5, segment_bytes=500, index_bytes=100)
+    assert as_tuples(log.recent) == entries[-5:]
+    assert as_tuples(log.since(1020, 1000)) == entries[21:]
+    entries += fill(log, 10, start=2000.0)
+    assert as_tuples(log.since(1055, 1000)) == entries[56:]
+    assert as_tuples(log.iter_since(1055)) == entries[56:]
+
+
+readers = itertools.count()
+
+
+def replay(server, **options):
+    # The HISTORY lines a version 2 client is sent on joining. Each call
+    # joins under a new name: the last one may not have left yet.
+    username = f'reader{next(readers)}'
+    # The PONG to a PING sent after the handshake comes after the replay
+    sock = socket.create_connection((server.host, server.port))
+    sock.sendall(protocol.make_hello(username, heartbeat=1, **options).encode() + protocol.encode_frame('PING'))
+    sock.settimeout(5)
+    decoder = protocol.FrameDecoder()
+    messages = []
+    while 'PONG' not in messages:
+        data = sock.recv(65536)
+        assert data, messages
+        messages.extend(decoder.feed(data))
+    sock.close()
+    assert messages[0].startswith('SERVER_INFO|')
+    return [message.split('|', 2)[1:] for message in messages if message.startswith('HISTORY|')]
+
+
+@pytest.mark.parametrize('mode', ['threaded', 'async'])
+def test_public_messages_are_replayed_on_join(start_server, mode):
+    server = start_server('--mode', mode)
+    alice = ChatClient(server.host, server.port, 'alice', history=0)
+    alice.connect()
+    bob = ChatClient(server.host, server.port, 'bob', history=0)
+    bob.connect()
+    # bob's join notice is logged before alice's messages
+    while 'bob joined' not in alice.events.get(timeout=5).text:
+        pass
+    alice.send_private('bob', 'not logged')
+    for i in range(3):
+        alice.send(f'hello {i}')
+    while 'hello 2' not in bob.events.get(timeout=5).text:
+        pass
+
+    # Join and leave notices are logged too
+    history = replay(server, history=2)
+    assert [text.split('] ', 1)[1] for _, text in history] == ['alice: hello 1', 'alice: hello 2']
+    everything = replay(server, history=100)
+    assert [text for _, text in everything if 'alice: ' in text][0].endswith('hello 0')
+    assert not any('not logged' in text for _, text in everything)
+    since = [timestamp for timestamp, text in everything if text.endswith('hello 1')][0]
+    assert [text for _, text in replay(server, since=since)][0].endswith('hello 2')
+    assert replay(server, since=0)[:len(everything)] == everything
+
+    # Bad values join without a replay
+    for options in ({'since': 'nan'}, {'since': 'inf'}, {'history': 'all'}, {'history': 0}):
+        assert replay(server, **options) == []
+
+    # The client marks replayed lines as history
+    carol = ChatClient(server.host, server.port, 'carol', history=100)
+    carol.connect()
+    event = carol.events.get(timeout=5)
+    while not event.text.endswith('hello 2'):
+        assert event.kind == PRESENCE or not event.live
+        event = carol.events.get(timeout=5)
+    assert not event.live
+    for client in (alice, bob, carol):
+        client.close()
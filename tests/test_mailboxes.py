@@ -0,0 +1,63 @@
+from mailboxes import FULL, STORED, UNKNOWN, MailboxStore
+
+
+def messages(mailbox, username):
+    return [message for _, message in mailbox.take(username)]
+
+
+def test_only_known_users_get_a_mailbox(tmp_path):
+    mailbox = MailboxStore(str(tmp_path))
+    assert mailbox.deposit('alice', 'hi') == UNKNOWN
+    assert messages(mailbox, 'alice') == []
+    assert mailbox.deposit('alice', 'hi') == STORED
+    mailbox.close()
+
+
+def test_messages_stay_until_discarded(tmp_path):
+    mailbox = MailboxStore(str(tmp_path))
+    mailbox.take('alice')
+    for text in ('one', 'two', 'three'):
+        mailbox.deposit('alice', text)
+    waiting = mailbox.take('alice')
+    assert [message for _, message in waiting] == ['one', 'two', 'three']
+    # Not delivered yet: still there on the next login
+    assert messages(mailbox, 'alice') == ['one', 'two', 'three']
+    mailbox.deposit('alice', 'four')
+    mailbox.discard('alice', waiting[-1][0])
+    assert messages(mailbox, 'alice') == ['four']
+    mailbox.close()
+
+
+def test_mailboxes_are_capped(tmp_path):
+    mailbox = MailboxStore(str(tmp_path), max_messages=2, max_bytes=10)
+    mailbox.take('alice')
+    mailbox.take('bob')
+    assert mailbox.deposit('alice', 'a') == STORED
+    assert mailbox.deposit('alice', 'b') == STORED
+    assert mailbox.deposit('alice', 'c') == FULL
+    assert mailbox.deposit('bob', 'x' * 11) == FULL
+    assert mailbox.deposit('bob', 'x' * 10) == STORED
+    mailbox.close()
+
+
+def test_old_messages_expire(tmp_path):
+    mailbox = MailboxStore(str(tmp_path), max_messages=1, expiry=60)
+    mailbox.take('alice')
+    mailbox.deposit('alice', 'old')
+    mailbox.db.execute("UPDATE messages SET timestamp = timestamp - 120")
+    # Expired messages are neither delivered nor counted
+    assert messages(mailbox, 'alice') == []
+    assert mailbox.deposit('alice', 'new') == STORED
+    mailbox.purge()
+    assert mailbox.db.execute("SELECT message FROM messages").fetchall() == [('new',)]
+    mailbox.close()
+
+
+def test_workers_share_the_mailboxes(tmp_path):
+    first = MailboxStore(str(tmp_path))
+    second = MailboxStore(str(tmp_path))
+    first.take('alice')
+    assert second.deposit('alice', 'from another worker') == STORED
+    assert messages(first, 'alice') == ['from another worker']
+    first.close()
+    second.close()
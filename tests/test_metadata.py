@@ -0,0 +1,122 @@
+import json
+import os
+
+import pytest
+
+from metadata import MetadataStore, is_shared_file
+
+
+def blobs(folder):
+    return sorted(name for name in os.listdir(os.path.join(folder, '.blobs')) if not name.startswith('.'))
+
+
+@pytest.mark.parametrize('name', ['report.pdf', 'notes (2).txt', 'résumé.docx'])
+def test_plain_names_are_shared(name):
+    assert is_shared_file(name)
+
+
+@pytest.mark.parametrize('name', ['', '.metadata.db', '.upload-x', 'a.txt.meta', '../secret', 'a/b.txt',
+                                  '/etc/passwd', 'x\0y', '..'])
+def test_other_names_are_not(name):
+    assert not is_shared_file(name)
+
+
+def test_files_copied_in_by_hand_are_picked_up(tmp_path, store):
+    (tmp_path / 'manual.txt').write_bytes(b'hello')
+    (tmp_path / 'manual.txt.meta').write_text(json.dumps({'sender': 'bob', 'recipient': 'carol'}))
+    record = store.get('manual.txt')
+    assert (record['sender'], record['recipient'], record['size'], record['hash']) == ('bob', 'carol', 5, None)
+    assert store.path_for(record) == os.path.join(str(tmp_path), 'manual.txt')
+    assert [record['name'] for record in store.list_files('carol')] == ['manual.txt']
+    assert store.list_files('dave') == []
+
+
+def test_nothing_outside_the_folder_is_shared(tmp_path):
+    folder = tmp_path / 'shared'
+    folder.mkdir()
+    (tmp_path / 'secret.txt').write_bytes(b'secret')
+    (folder / 'link.txt').symlink_to(tmp_path / 'secret.txt')
+    store = MetadataStore(str(folder))
+    assert store.get('../secret.txt') is None
+    assert store.get('link.txt') is None
+    assert store.files == {}
+
+
+def test_invalid_names_from_older_versions_are_dropped(tmp_path, store):
+    store.write([{'name': '../secret.txt', 'sender': None, 'recipient': 'all', 'timestamp': None,
+                  'size': 6, 'hash': None, 'accessed': None}])
+    store.db.close()
+    reopened = MetadataStore(str(tmp_path))
+    assert reopened.files == {}
+    assert reopened.db.execute("SELECT COUNT(*) FROM files").fetchone() == (0,)
+
+
+def test_identical_content_is_stored_once(tmp_path, store, share):
+    first = share('a.txt', b'same bytes')
+    second = share('b.txt', b'same bytes', sender='bob')
+    assert first['hash'] == second['hash']
+    assert blobs(str(tmp_path)) == [first['hash']]
+    assert store.refcounts[first['hash']] == 2
+    assert store.stored_bytes == len(b'same bytes')
+    assert store.usage == {'alice': 10, 'bob': 10}
+
+    store.remove('a.txt')
+    assert blobs(str(tmp_path)) == [first['hash']]
+    store.remove('b.txt')
+    assert blobs(str(tmp_path)) == []
+    assert store.stored_bytes == 0 and not store.usage
+
+
+def test_replacing_a_name_releases_the_old_content(tmp_path, store, share):
+    old = share('notes.txt', b'first version')
+    new = share('notes.txt', b'second version!')
+    assert store.files['notes.txt'] is new
+    assert blobs(str(tmp_path)) == [new['hash']]
+    assert old['hash'] not in store.refcounts
+    assert store.stored_bytes == store.usage['alice'] == len(b'second version!')
+
+
+def test_other_users_get_a_new_name(store, share):
+    share('report.pdf', b'alice')
+    record = share('report.pdf', b'bob', sender='bob')
+    assert record['name'] == 'report (2).pdf'
+    assert store.files['report.pdf']['sender'] == 'alice'
+
+
+def test_state_survives_a_restart(tmp_path, store, share):
+    record = share('a.txt', b'content')
+    share('b.txt', b'content')
+    store.db.close()
+    reopened = MetadataStore(str(tmp_path))
+    assert set(reopened.files) == {'a.txt', 'b.txt'}
+    assert reopened.refcounts[record['hash']] == 2
+    assert reopened.stored_bytes == len(b'content')
+
+
+def test_stale_remove_keeps_a_newer_upload(tmp_path, store, share):
+    stale = share('a.txt', b'old')
+    current = share('a.txt', b'new')
+    assert not store.remove('a.txt', stale)
+    assert store.files['a.txt'] is current
+    assert blobs(str(tmp_path)) == [current['hash']]
+    assert store.remove('a.txt', current)
+    assert 'a.txt' not in store.files
+    assert not store.remove('a.txt')
+
+
+def test_reserved_names_are_shared_under_another_name(tmp_path, store, share):
+    assert share('metrics', b'not the metrics')['name'] == 'metrics (2)'
+    assert store.get('metrics') is None
+    (tmp_path / 'metrics').write_bytes(b'copied by hand')
+    assert store.get('metrics') is None
+
+
+def test_reserved_names_from_older_versions_are_renamed(tmp_path):
+    (tmp_path / 'metrics').write_bytes(b'legacy')
+    store = MetadataStore(str(tmp_path))
+    store.write([{'name': 'metrics', 'sender': 'alice', 'recipient': 'all', 'timestamp': None,
+                  'size': 6, 'hash': None, 'accessed': None}])
+    store.db.close()
+    reopened = MetadataStore(str(tmp_path))
+    assert list(reopened.files) == ['metrics (2)']
+    assert (tmp_path / 'metrics (2)').read_bytes() == b'legacy'
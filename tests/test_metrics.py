@@ -0,0 +1,51 @@
+from metrics import Metrics, NullMetrics
+
+
+def test_counters_are_named_after_their_samples():
+    metrics = Metrics()
+    sent = metrics.counter('messages_sent', 'Messages sent')
+    sent.inc()
+    sent.inc(2)
+    assert metrics.render().splitlines() == [
+        '# HELP messages_sent_total Messages sent',
+        '# TYPE messages_sent_total counter',
+        'messages_sent_total 3',
+    ]
+
+
+def test_labels_are_escaped():
+    metrics = Metrics()
+    responses = metrics.counter('http_responses_total', 'Responses', ('method', 'path'))
+    responses.labels('GET', 'a"b\\c\nd').inc()
+    assert 'http_responses_total{method="GET",path="a\\"b\\\\c\\nd"} 1' in metrics.render()
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = Metrics()
+    latency = metrics.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5):
+        latency.observe(value)
+    lines = metrics.render().splitlines()
+    assert lines[1] == '# TYPE latency_seconds histogram'
+    assert lines[2:] == [
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 6.05',
+        'latency_seconds_count 4',
+    ]
+
+
+def test_gauges_are_read_when_scraped():
+    metrics = Metrics()
+    clients = []
+    metrics.gauge('connected_clients', 'Clients', lambda: len(clients))
+    clients.append('alice')
+    assert metrics.render().endswith('connected_clients 1\n')
+
+
+def test_null_metrics_accept_every_update():
+    metrics = NullMetrics()
+    metrics.counter('a', 'a', ('x',)).labels('y').inc()
+    metrics.histogram('b', 'b').observe(1)
+    assert metrics.render() == ''
@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+from server import COALESCE, DISCONNECT, DROP_OLDEST, OutboundQueue
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        OutboundQueue(policy='block')
+
+
+def test_batches_everything_queued():
+    queue = OutboundQueue()
+    assert queue.put(b'a') and queue.put(b'bc')
+    assert queue.take_batch() == b'abc'
+    assert queue.take_batch() == b''
+    queue.close()
+    assert queue.take_batch() is None
+    assert not queue.put(b'late')
+
+
+def test_closed_queue_is_drained_first():
+    queue = OutboundQueue()
+    queue.put(b'last words')
+    queue.close()
+    assert queue.get_batch() == b'last words'
+    assert queue.get_batch() is None
+
+
+def test_get_batch_waits_for_a_put():
+    queue = OutboundQueue()
+    batches = []
+    writer = threading.Thread(target=lambda: batches.append(queue.get_batch()))
+    writer.start()
+    queue.put(b'hello')
+    writer.join(5)
+    assert batches == [b'hello']
+
+
+def test_drop_oldest():
+    queue = OutboundQueue(max_messages=3, policy=DROP_OLDEST)
+    for payload in (b'1', b'2', b'3', b'4', b'5'):
+        assert queue.put(payload)
+    assert queue.dropped == 2
+    assert queue.take_batch() == b'345'
+
+
+def test_drop_oldest_by_bytes():
+    queue = OutboundQueue(max_bytes=10, policy=DROP_OLDEST)
+    queue.put(b'x' * 6)
+    queue.put(b'y' * 6)
+    queue.put(b'z' * 2)
+    assert queue.take_batch() == b'y' * 6 + b'z' * 2
+    assert queue.pending_bytes == 0
+
+
+def test_disconnect():
+    queue = OutboundQueue(max_messages=2, policy=DISCONNECT)
+    assert queue.put(b'1') and queue.put(b'2')
+    assert not queue.put(b'3')
+    assert queue.take_batch() == b'12'
+
+
+def test_coalesce_merges_the_backlog():
+    queue = OutboundQueue(max_messages=3, policy=COALESCE)
+    for payload in (b'1', b'2', b'3', b'4'):
+        assert queue.put(payload)
+    assert len(queue.items) == 2
+    assert queue.dropped == 0
+    assert queue.take_batch() == b'1234'
+
+
+def test_coalesce_disconnects_past_the_byte_limit():
+    queue = OutboundQueue(max_messages=100, max_bytes=8, policy=COALESCE)
+    assert queue.put(b'1234') and queue.put(b'5678')
+    assert not queue.put(b'9')
+
+
+def test_on_ready_is_called_for_every_put_and_close():
+    calls = []
+    queue = OutboundQueue(on_ready=lambda: calls.append(1))
+    queue.put(b'a')
+    queue.close()
+    assert len(calls) == 2
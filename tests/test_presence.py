@@ -0,0 +1,93 @@
+import socket
+
+import protocol
+from chat_client import PRESENCE, PRESENCE_SNAPSHOT, BaseChatClient, ChatClient
+
+
+def make_client():
+    client = BaseChatClient('127.0.0.1', username='alice')
+    client.handle_server_info('SERVER_INFO|8000|alice,bob')
+    return client
+
+
+def test_updates_apply_in_sequence():
+    client = make_client()
+    assert client.users() == ['bob']
+    event = client.make_event('PRESENCE_SNAPSHOT|5|alice,bob|')
+    assert (event.kind, event.data) == (PRESENCE, PRESENCE_SNAPSHOT)
+    client.make_event('PRESENCE|6|join|carol')
+    client.make_event('PRESENCE|7|away|bob')
+    assert client.users() == ['bob', 'carol'] and client.is_away('bob')
+    client.make_event('PRESENCE|8|back|bob')
+    client.make_event('PRESENCE|9|leave|carol')
+    assert client.users() == ['bob'] and not client.is_away('bob')
+    assert client.take_replies() == []
+
+
+def test_stale_updates_are_ignored():
+    client = make_client()
+    client.make_event('PRESENCE_SNAPSHOT|5|alice,bob|')
+    assert client.make_event('PRESENCE|5|leave|bob') is None
+    assert client.make_event('PRESENCE_SNAPSHOT|4|alice|') is None
+    assert client.users() == ['bob']
+
+
+def test_a_gap_asks_for_a_snapshot():
+    client = make_client()
+    client.make_event('PRESENCE_SNAPSHOT|5|alice,bob|')
+    client.make_event('PRESENCE|7|join|dave')  # 6 was lost
+    assert client.users() == ['bob', 'dave']
+    assert client.take_replies() == ['/presence']
+    assert client.take_replies() == []
+    client.make_event('PRESENCE_SNAPSHOT|7|alice,bob,carol,dave|carol')
+    assert client.users() == ['bob', 'carol', 'dave'] and client.is_away('carol')
+
+
+def read_presence(sock, decoder, until):
+    # PRESENCE messages as (seq, op, user) up to and including `until` (op, user)
+    updates = []
+    sock.settimeout(5)
+    while True:
+        data = sock.recv(65536)
+        assert data, updates
+        for message in decoder.feed(data):
+            if message.startswith('PRESENCE|'):
+                _, seq, op, user = message.split('|')
+                updates.append((int(seq), op, user))
+                if (op, user) == until:
+                    return updates
+
+
+def test_server_numbers_every_change(start_server):
+    server = start_server()
+    watcher = socket.create_connection((server.host, server.port))
+    watcher.sendall(protocol.make_hello('watcher', presence=1).encode())
+    decoder = protocol.FrameDecoder()
+    bob = ChatClient(server.host, server.port, 'bob')
+    bob.connect()
+    read_presence(watcher, decoder, ('join', 'bob'))
+    bob.set_away()
+    read_presence(watcher, decoder, ('away', 'bob'))
+    bob.close()
+    updates = read_presence(watcher, decoder, ('leave', 'bob'))
+    watcher.close()
+    assert [op for _, op, _ in updates] == ['leave']
+
+    # Every change takes the next number
+    watcher = socket.create_connection((server.host, server.port))
+    watcher.sendall(protocol.make_hello('watcher2', presence=1).encode())
+    decoder = protocol.FrameDecoder()
+    carol = ChatClient(server.host, server.port, 'carol')
+    carol.connect()
+    updates = read_presence(watcher, decoder, ('join', 'carol'))
+    carol.set_away()
+    updates += read_presence(watcher, decoder, ('away', 'carol'))
+    carol.set_away(False)
+    updates += read_presence(watcher, decoder, ('back', 'carol'))
+    carol.close()
+    updates += read_presence(watcher, decoder, ('leave', 'carol'))
+    watcher.close()
+    carol_updates = [(seq, op) for seq, op, user in updates if user == 'carol']
+    assert [op for _, op in carol_updates] == ['join', 'away', 'back', 'leave']
+    seqs = [seq for seq, _, _ in updates]
+    assert seqs == list(range(seqs[0], seqs[0] + len(seqs)))
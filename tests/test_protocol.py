@@ -0,0 +1,81 @@
+import pytest
+
+import protocol
+from protocol import FrameDecoder, encode_frame, encode_frames
+
+
+def test_whole_frames():
+    decoder = FrameDecoder()
+    assert decoder.feed(encode_frames(['hello', 'world'])) == ['hello', 'world']
+    assert decoder.buffer == bytearray()
+
+
+def test_partial_frame_is_kept_until_complete():
+    data = encode_frame('héllo wörld')
+    decoder = FrameDecoder()
+    # Split inside the header, then inside a multibyte character
+    assert decoder.feed(data[:2]) == []
+    assert decoder.feed(data[2:7]) == []
+    assert decoder.feed(data[7:]) == ['héllo wörld']
+
+
+def test_byte_at_a_time():
+    data = encode_frames(['a', '', 'bc'])
+    decoder = FrameDecoder()
+    messages = []
+    for i in range(len(data)):
+        messages += decoder.feed(data[i:i + 1])
+    assert messages == ['a', '', 'bc']
+
+
+def test_max_messages_leaves_the_rest_buffered():
+    decoder = FrameDecoder()
+    data = encode_frames(['one', 'two', 'three'])
+    assert decoder.feed(data, max_messages=1) == ['one']
+    assert bytes(decoder.buffer) == encode_frames(['two', 'three'])
+    assert decoder.feed(b'') == ['two', 'three']
+
+
+def test_oversized_frame_is_rejected():
+    decoder = FrameDecoder()
+    header = protocol.HEADER.pack(protocol.MAX_FRAME_SIZE + 1)
+    with pytest.raises(ValueError):
+        decoder.feed(header)
+
+
+def test_frame_at_the_limit_is_accepted():
+    decoder = FrameDecoder()
+    message = 'x' * protocol.MAX_FRAME_SIZE
+    assert decoder.feed(encode_frame(message)) == [message]
+
+
+def test_legacy_messages_are_not_framed():
+    assert protocol.encode_message('hi', 1) == b'hi'
+    assert protocol.encode_message('hi', 2) == encode_frame('hi')
+
+
+def test_hello_round_trip():
+    hello = protocol.make_hello('alice', history=50, compress='zlib')
+    assert hello.endswith('\n')
+    handshake, rest = protocol.split_hello(hello.encode())
+    assert rest == b''
+    assert protocol.parse_hello(handshake.decode()) == (2, 'alice', {'history': '50', 'compress': 'zlib'})
+
+
+def test_hello_is_buffered_until_its_newline():
+    data = protocol.make_hello('alice').encode() + encode_frame('first message')
+    for cut in (1, 6, 12):
+        assert protocol.split_hello(data[:cut]) is None
+    handshake, rest = protocol.split_hello(data)
+    assert protocol.parse_hello(handshake.decode())[1] == 'alice'
+    assert FrameDecoder().feed(rest) == ['first message']
+
+
+def test_older_handshakes():
+    # A version 1 username is complete as it is; a HELLO without a newline
+    # waits for the server's timeout
+    assert protocol.split_hello(b'bob') == (b'bob', b'')
+    assert protocol.parse_hello('bob') == (1, 'bob', {})
+    assert protocol.split_hello(b'HELLO|2|bob') is None
+    with pytest.raises(ValueError):
+        protocol.split_hello(b'HELLO|2|' + b'x' * protocol.MAX_HELLO_SIZE)
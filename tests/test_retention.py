@@ -0,0 +1,76 @@
+import os
+import time
+
+from metadata import TIMESTAMP_FORMAT
+from retention import StorageManager
+
+
+def age(record, seconds):
+    record['timestamp'] = time.strftime(TIMESTAMP_FORMAT, time.localtime(time.time() - seconds))
+
+
+def test_user_quota(store, share):
+    manager = StorageManager(store, user_quota=100)
+    share('a.txt', b'x' * 60)
+    assert manager.check_upload('alice', 40) is None
+    status, message = manager.check_upload('alice', 41)
+    assert status == 413 and 'Quota exceeded' in message
+    assert manager.check_upload('bob', 100) is None
+
+
+def test_storage_quota_counts_shared_content_once(store, share):
+    manager = StorageManager(store, storage_quota=100)
+    record = share('a.txt', b'x' * 80)
+    assert manager.check_upload('bob', 30)[0] == 507
+    # The server already holds this content
+    assert manager.check_upload('bob', 80, record['hash']) is None
+
+
+def test_sweep_removes_expired_files(store, share):
+    manager = StorageManager(store, ttl=3600)
+    age(share('old.txt', b'old'), 7200)
+    share('new.txt', b'new')
+    assert manager.sweep()
+    assert set(store.files) == {'new.txt'}
+
+
+def test_sweep_skips_names_shared_again(store, share):
+    manager = StorageManager(store, ttl=3600)
+    age(share('a.txt', b'old'), 7200)
+    expired = manager.expired()
+    current = share('a.txt', b'new')
+    assert manager.remove(expired, 'ttl', 10) == 0
+    assert store.files['a.txt'] is current
+
+
+def test_lru_eviction_down_to_high_water(store, share):
+    manager = StorageManager(store, storage_quota=100, evict_lru=True)
+    for i, name in enumerate(['a', 'b', 'c']):
+        share(name, bytes([i]) * 40)
+        store.files[name]['accessed'] = 1000 + i
+    # 120 bytes stored, 90 allowed: the least recently used file goes
+    manager.sweep()
+    assert set(store.files) == {'b', 'c'}
+
+
+def test_contains_rejects_paths_outside_the_folders(tmp_path, store):
+    assert store.contains(os.path.join(store.folder, 'a.txt'))
+    assert store.contains(os.path.join(store.blob_folder, 'a' * 64))
+    assert not store.contains(os.path.join(store.folder, '..', 'a.txt'))
+    assert not store.contains(os.path.join(store.folder, 'sub', 'a.txt'))
+    link = tmp_path / 'link.txt'
+    link.symlink_to(tmp_path.parent / 'outside.txt')
+    assert not store.contains(str(link))
+
+
+def test_release_never_deletes_outside_the_folder(tmp_path, store):
+    outside = tmp_path.parent / f'{tmp_path.name}-outside.txt'
+    outside.write_text('keep me')
+    try:
+        record = {'name': f'../{outside.name}', 'sender': 'alice', 'recipient': 'all',
+                  'size': 7, 'hash': None}
+        store.retain(record)
+        store.release(record)
+        assert outside.exists()
+    finally:
+        outside.unlink()
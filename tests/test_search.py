@@ -0,0 +1,95 @@
+import sqlite3
+
+from search import DB_NAME, FILE, MESSAGE, PAGE_SIZE, PRIVATE, SearchIndex, make_query, parse_chat_line
+
+
+def file_record(name, sender='alice', recipient='all'):
+    return {'name': name, 'sender': sender, 'recipient': recipient, 'timestamp': None}
+
+
+def kinds(results):
+    return sorted(result['kind'] for result in results)
+
+
+def test_chat_lines_and_queries():
+    assert parse_chat_line('[12:34:56] alice: hello there') == ('alice', 'hello there')
+    assert parse_chat_line('[12:34:56] SERVER: alice joined the chat!') is None
+    assert make_query('budget "report" OR x*') == '"budget"* "report"* "OR"* "x"*'
+    assert make_query('***') == ''
+
+
+def test_results_are_limited_to_what_the_user_may_see(tmp_path):
+    index = SearchIndex(str(tmp_path))
+    index.add_public('[10:00:00] alice: budget in general', 'general')
+    index.add_public('[10:00:01] alice: budget in ops', 'ops')
+    index.add_private('alice', 'bob', 'budget for bob')
+    index.add_file(file_record('budget.xlsx'))
+    index.add_file(file_record('budget-carol.xlsx', recipient='carol'))
+
+    results, more = index.search('budget', 'bob', ['general'])
+    assert kinds(results) == [FILE, MESSAGE, PRIVATE] and not more
+    assert kinds(index.search('budget', 'carol', ['general', 'ops'])[0]) == [FILE, FILE, MESSAGE, MESSAGE]
+    index.close()
+
+
+def test_http_search_leaves_out_private_messages(tmp_path):
+    # The file server's X-Username header is not authenticated
+    index = SearchIndex(str(tmp_path))
+    index.add_private('alice', 'bob', 'secret plans')
+    index.add_public('[10:00:00] bob: plans for lunch', 'general')
+    assert kinds(index.search('plans', 'bob', ['general'])[0]) == [MESSAGE, PRIVATE]
+    assert kinds(index.search('plans', 'bob', ['general'], private=False)[0]) == [MESSAGE]
+    index.close()
+
+
+def test_removed_files_drop_out(tmp_path):
+    index = SearchIndex(str(tmp_path))
+    index.add_file(file_record('notes.txt'))
+    index.sync_files({'todo.txt': file_record('todo.txt')})
+    assert index.search('notes', 'alice', [])[0] == []
+    assert [result['text'] for result in index.search('todo', 'alice', [])[0]] == ['todo.txt']
+    index.remove_file('todo.txt')
+    assert index.search('todo', 'alice', [])[0] == []
+    index.close()
+
+
+def test_pages(tmp_path):
+    index = SearchIndex(str(tmp_path))
+    for i in range(PAGE_SIZE + 5):
+        index.add_public(f'[10:00:00] alice: lunch {i}', 'general')
+    first, more = index.search('lunch', 'bob', ['general'])
+    second, last = index.search('lunch', 'bob', ['general'], page=2)
+    assert len(first) == PAGE_SIZE and more
+    assert len(second) == 5 and not last
+    index.close()
+
+
+def test_workers_share_the_file_index(tmp_path):
+    for folder in ('worker-0', 'worker-1'):
+        (tmp_path / folder).mkdir()
+    first = SearchIndex(str(tmp_path / 'worker-0'), str(tmp_path))
+    second = SearchIndex(str(tmp_path / 'worker-1'), str(tmp_path))
+    first.add_file(file_record('slides.pdf'))
+    first.add_public('[10:00:00] alice: slides are up', 'general')
+    assert kinds(second.search('slides', 'bob', ['general'])[0]) == [FILE]
+    assert kinds(first.search('slides', 'bob', ['general'])[0]) == [FILE, MESSAGE]
+    first.close()
+    second.close()
+
+
+def test_files_move_out_of_the_message_index(tmp_path):
+    # As indexed by earlier versions: files and messages in one table
+    db = sqlite3.connect(str(tmp_path / DB_NAME))
+    db.execute("CREATE VIRTUAL TABLE entries USING fts5(body, kind UNINDEXED, sender UNINDEXED, "
+               "recipient UNINDEXED, channel UNINDEXED, timestamp UNINDEXED)")
+    db.execute("CREATE TABLE file_rows (name TEXT PRIMARY KEY, row INTEGER)")
+    db.execute("INSERT INTO entries VALUES ('old.txt', 'file', 'alice', 'all', NULL, 1)")
+    db.execute("INSERT INTO entries VALUES ('old news', 'message', 'alice', NULL, 'general', 1)")
+    db.execute("INSERT INTO file_rows VALUES ('old.txt', 1)")
+    db.commit()
+    db.close()
+    index = SearchIndex(str(tmp_path))
+    assert kinds(index.search('old', 'bob', ['general'])[0]) == [MESSAGE]
+    index.sync_files({'old.txt': file_record('old.txt')})
+    assert kinds(index.search('old', 'bob', ['general'])[0]) == [FILE, MESSAGE]
+    index.close()
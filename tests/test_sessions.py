@@ -0,0 +1,110 @@
+import socket
+import time
+
+import pytest
+
+import protocol
+from chat_client import LEAVE, PRIVATE, SERVER, BaseChatClient, ChatClient
+
+SERVER_ARGS = ('--heartbeat-interval', '0.5', '--idle-timeout', '1.5', '--resume-grace', '3')
+
+
+def wait_for(events, match, timeout=10):
+    # The first queued event match() accepts; skips the others
+    deadline = time.monotonic() + timeout
+    while True:
+        event = events.get(timeout=max(deadline - time.monotonic(), 0))
+        if event is not None and match(event):
+            return event
+
+
+def test_session_events():
+    client = BaseChatClient('127.0.0.1', username='alice')
+    client.channels.add('dev')
+    assert client.make_event('SESSION|abc|0|60') is None
+    assert (client.session_token, client.resume_grace) == ('abc', 60)
+
+    client.rejoining = True
+    assert client.make_event('SESSION|abc|1|60').text == "Reconnected"
+    assert client.take_replies() == []
+
+    # The session had expired: back into our channels
+    client.rejoining = True
+    event = client.make_event('SESSION|def|0|60')
+    assert (event.kind, event.text) == (SERVER, "Reconnected (session expired, rejoined)")
+    assert client.session_token == 'def' and not client.rejoining
+    assert client.take_replies() == ['/join dev']
+
+
+def test_pings_are_answered():
+    client = BaseChatClient('127.0.0.1', username='alice')
+    assert client.make_event('PING') is None
+    assert client.make_event('PONG') is None
+    assert client.take_replies() == ['PONG']
+
+
+def test_hello_asks_to_resume():
+    client = BaseChatClient('127.0.0.1', username='alice')
+    client.resumable = True
+    client.session_token = 'abc'
+    options = protocol.parse_hello(client.hello().decode())[2]
+    assert (options['heartbeat'], options['session'], options['resume']) == ('1', '1', 'abc')
+
+
+@pytest.mark.parametrize('mode', ['threaded', 'async'])
+def test_dropped_connection_is_resumed(start_server, mode):
+    server = start_server('--mode', mode, *SERVER_ARGS)
+    alice = ChatClient(server.host, server.port, 'alice')
+    alice.connect()
+    bob = ChatClient(server.host, server.port, 'bob')
+    bob.connect()
+    wait_for(alice.events, lambda event: event.user == 'bob')
+    token = alice.session_token
+
+    alice.socket.shutdown(socket.SHUT_RDWR)
+    wait_for(alice.events, lambda event: event.text == "Connection lost, reconnecting...")
+    # Messages are held once the server has seen the connection go (alice
+    # retries after RECONNECT_DELAY)
+    time.sleep(0.2)
+    bob.send_private('alice', 'while you were out')
+    # What was held for alice is replayed along with the new session
+    texts = []
+    while "Reconnected" not in texts or not any('while you were out' in text for text in texts):
+        texts.append(wait_for(alice.events, lambda event: event.kind in (SERVER, PRIVATE)).text)
+    assert alice.session_token == token
+    # Nobody saw alice leave
+    time.sleep(0.5)
+    assert 'alice' in bob.users()
+    assert not any(event.kind == LEAVE for event in list(bob.events.queue) if event)
+    alice.close()
+    bob.close()
+
+
+@pytest.mark.parametrize('mode', ['threaded', 'async'])
+def test_silent_connections_are_reaped(start_server, mode):
+    server = start_server('--mode', mode, *SERVER_ARGS)
+    sock = socket.create_connection((server.host, server.port))
+    # Asks for heartbeats, then never answers a PING
+    sock.sendall(protocol.make_hello('mute', heartbeat=1).encode())
+    sock.settimeout(10)
+    started = time.monotonic()
+    while sock.recv(65536):
+        pass
+    assert time.monotonic() - started < 5
+    sock.close()
+
+
+@pytest.mark.parametrize('mode', ['threaded', 'async'])
+def test_held_session_expires_after_the_grace_period(start_server, mode):
+    server = start_server('--mode', mode, *SERVER_ARGS)
+    bob = ChatClient(server.host, server.port, 'bob')
+    bob.connect()
+    sock = socket.create_connection((server.host, server.port))
+    sock.sendall(protocol.make_hello('ghost', session=1).encode())
+    wait_for(bob.events, lambda event: event.user == 'ghost')
+    dropped = time.monotonic()
+    sock.close()
+    wait_for(bob.events, lambda event: event.kind == LEAVE and event.user == 'ghost')
+    assert time.monotonic() - dropped >= 2.5
+    assert 'ghost' not in bob.users()
+    bob.close()
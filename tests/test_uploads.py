@@ -0,0 +1,72 @@
+import hashlib
+import os
+import time
+from http.server import BaseHTTPRequestHandler
+from types import SimpleNamespace
+
+import pytest
+
+from retention import StorageManager
+from server import MAX_OPEN_UPLOADS, UPLOAD_EXPIRY, FileTransferServer, PartialUpload
+
+
+@pytest.fixture
+def http_server(store):
+    server = FileTransferServer(('127.0.0.1', 0), BaseHTTPRequestHandler)
+    server.chat_server = SimpleNamespace(storage=StorageManager(store, max_upload_size=1000))
+    yield server
+    server.server_close()
+
+
+def test_parts_in_any_order_complete_the_upload(tmp_path):
+    upload = PartialUpload(str(tmp_path), 'alice', 'a.bin', 10)
+    # Not allocated up front
+    assert os.stat(upload.path).st_blocks == 0
+    assert upload.write_part(5, [b'fghij']) == (hashlib.sha256(b'fghij').hexdigest(), 5)
+    upload.add_part(5, 5)
+    assert not upload.is_complete()
+    upload.write_part(0, [b'ab', b'cde'])
+    upload.add_part(0, 5)
+    assert upload.is_complete()
+    assert upload.digest() == hashlib.sha256(b'abcdefghij').hexdigest()
+
+
+def test_gaps_and_overruns(tmp_path):
+    upload = PartialUpload(str(tmp_path), 'alice', 'a.bin', 10)
+    upload.add_part(0, 4)
+    upload.add_part(6, 4)
+    assert not upload.is_complete()
+    with pytest.raises(ValueError):
+        upload.write_part(8, [b'xyz'])
+
+
+def test_open_upload_checks_owner_and_size(http_server, store):
+    upload, refusal = http_server.open_upload('a' * 32, 'alice', 'a.bin', 100, store.blob_folder)
+    assert refusal is None
+    assert http_server.open_upload('a' * 32, 'alice', 'a.bin', 100, store.blob_folder) == (upload, None)
+    assert http_server.open_upload('a' * 32, 'bob', 'a.bin', 100, store.blob_folder)[1][0] == 409
+    assert http_server.open_upload('b' * 32, 'bob', 'b.bin', 1001, store.blob_folder)[1][0] == 413
+
+
+def test_open_uploads_are_capped_per_user(http_server, store):
+    for i in range(MAX_OPEN_UPLOADS):
+        assert http_server.open_upload(f'{i:032x}', 'alice', 'a.bin', 10, store.blob_folder)[1] is None
+    assert http_server.open_upload('f' * 32, 'alice', 'a.bin', 10, store.blob_folder)[1][0] == 429
+    assert http_server.open_upload('f' * 32, 'bob', 'a.bin', 10, store.blob_folder)[1] is None
+
+
+def test_uploads_must_fit_on_disk(store):
+    manager = StorageManager(store, max_upload_size=0)
+    free = os.statvfs(store.blob_folder).f_bavail * os.statvfs(store.blob_folder).f_frsize
+    assert manager.check_upload('alice', free * 2) is None  # the body is already on disk
+    assert manager.check_upload('alice', free * 2, reserved=0)[0] == 507
+    assert manager.check_upload('alice', 10, reserved=free)[0] == 507
+
+
+def test_stale_uploads_expire(http_server, store):
+    upload, _ = http_server.open_upload('a' * 32, 'alice', 'a.bin', 10, store.blob_folder)
+    http_server.expire_uploads(time.monotonic())
+    assert http_server.get_upload('a' * 32, 'alice') is upload
+    http_server.expire_uploads(time.monotonic() + UPLOAD_EXPIRY + 1)
+    assert http_server.get_upload('a' * 32, 'alice') is None
+    assert not os.path.exists(upload.path)
@@ -0,0 +1,212 @@
+import itertools
+import os
+import queue
+import threading
+import time
+from chat_client import partial_download_paths
+
+# Background uploads and downloads for a ChatClient. Transfers wait in a
+# queue until one of `concurrency` worker threads picks them up; each one
+# can be paused, resumed, cancelled and retried. Every change is reported
+# through on_update(transfer), called from the worker threads, so a GUI
+# should hand it over to its own thread (e.g. through a queue.Queue).
+
+TRANSFER_CONCURRENCY = 2
+
+# Progress is reported at most this often per transfer; state changes are
+# always reported
+PROGRESS_INTERVAL = 0.1
+
+# Transfer kinds
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+# Transfer states
+QUEUED = 'queued'
+RUNNING = 'running'
+PAUSED = 'paused'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class TransferStopped(Exception):
+    # Raised from the progress callback to stop a running transfer
+    pass
+
+
+class Transfer:
+    # One upload or download. `result` is the saved path of a finished
+    # download and `error` the exception that failed the last attempt.
+    def __init__(self, transfer_id, kind, name, func, args):
+        self.id = transfer_id
+        self.kind = kind
+        self.name = name
+        self.func = func
+        self.args = args
+        self.state = QUEUED
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.stop_requested = None  # PAUSED or CANCELLED while running
+        self.reported = 0
+
+    @property
+    def fraction(self):
+        if self.state == DONE:
+            return 1.0
+        return self.done / self.total if self.total else 0.0
+
+    def __repr__(self):
+        return f"Transfer({self.id}, {self.kind!r}, {self.name!r}, state={self.state!r})"
+
+
+class TransferManager:
+    def __init__(self, client, concurrency=TRANSFER_CONCURRENCY, on_update=None):
+        self.client = client
+        self.on_update = on_update
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.transfers = {}  # {transfer id: Transfer}
+        self.ids = itertools.count(1)
+        self.workers = []
+        for _ in range(concurrency):
+            worker = threading.Thread(target=self.run_worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def upload(self, filepath, recipient='all', channel=None):
+        return self.submit(UPLOAD, os.path.basename(filepath), self.client.upload, (filepath, recipient, channel))
+
+    def download(self, filename, folder=None):
+        return self.submit(DOWNLOAD, filename, self.client.download, (filename, folder))
+
+    def submit(self, kind, name, func, args):
+        transfer = Transfer(next(self.ids), kind, name, func, args)
+        with self.lock:
+            self.transfers[transfer.id] = transfer
+        self.enqueue(transfer)
+        return transfer
+
+    def enqueue(self, transfer):
+        with self.lock:
+            transfer.state = QUEUED
+            transfer.stop_requested = None
+            transfer.error = None
+        self.notify(transfer)
+        self.pending.put(transfer)
+
+    def list_transfers(self):
+        with self.lock:
+            return list(self.transfers.values())
+
+    def pause(self, transfer):
+        # A queued transfer is held back; a running one stops at its next
+        # progress report. Downloads resume from the data already received,
+        # uploads start over.
+        with self.lock:
+            if transfer.state == QUEUED:
+                transfer.state = PAUSED
+            elif transfer.state == RUNNING:
+                transfer.stop_requested = PAUSED
+                return
+            else:
+                return
+        self.notify(transfer)
+
+    def resume(self, transfer):
+        if transfer.state == PAUSED:
+            self.enqueue(transfer)
+
+    def cancel(self, transfer):
+        with self.lock:
+            if transfer.state in (QUEUED, PAUSED):
+                transfer.state = CANCELLED
+            elif transfer.state == RUNNING:
+                transfer.stop_requested = CANCELLED
+                return
+            else:
+                return
+        self.discard_partial(transfer)
+        self.notify(transfer)
+
+    def retry(self, transfer):
+        if transfer.state in (FAILED, CANCELLED):
+            transfer.done = 0
+            self.enqueue(transfer)
+
+    def forget(self, transfer):
+        # Drops a finished transfer from the list
+        with self.lock:
+            if transfer.state in FINISHED_STATES:
+                self.transfers.pop(transfer.id, None)
+
+    def discard_partial(self, transfer):
+        if transfer.kind != DOWNLOAD:
+            return
+        filename, folder = transfer.args
+        for path in partial_download_paths(folder or self.client.download_folder, filename):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def notify(self, transfer, force=True):
+        now = time.monotonic()
+        if not force and now - transfer.reported < PROGRESS_INTERVAL:
+            return
+        transfer.reported = now
+        if self.on_update:
+            self.on_update(transfer)
+
+    def report(self, transfer, done, total):
+        # Progress callback handed to the client; also where a pause or
+        # cancel request reaches the running transfer
+        if transfer.stop_requested:
+            raise TransferStopped()
+        transfer.done = done
+        transfer.total = total
+        self.notify(transfer, force=False)
+
+    def run_worker(self):
+        while True:
+            transfer = self.pending.get()
+            if transfer is None:
+                return
+            with self.lock:
+                if transfer.state != QUEUED:
+                    # Paused or cancelled while waiting
+                    continue
+                transfer.state = RUNNING
+            self.notify(transfer)
+            self.run(transfer)
+            self.notify(transfer)
+
+    def run(self, transfer):
+        progress = lambda done, total: self.report(transfer, done, total)
+        try:
+            result = transfer.func(*transfer.args, progress=progress)
+        except TransferStopped:
+            if transfer.stop_requested == CANCELLED:
+                self.discard_partial(transfer)
+            with self.lock:
+                transfer.state = transfer.stop_requested
+        except Exception as e:
+            with self.lock:
+                transfer.state = FAILED
+                transfer.error = e
+        else:
+            with self.lock:
+                transfer.state = DONE
+                transfer.result = result
+
+    def close(self):
+        # Stops the workers; running transfers are paused so downloads can
+        # be resumed by a later session
+        with self.lock:
+            for transfer in self.transfers.values():
+                if transfer.state == RUNNING:
+                    transfer.stop_requested = PAUSED
+        for _ in self.workers:
+            self.pending.put(None)